@@ -1,21 +1,210 @@
+import io
+import os
+import marshal
+import cProfile
+import pstats
 import re
+import sys
 import time
+import gzip
+import zlib
 import json
-from urllib.parse import urljoin
+import pickle
+import hashlib
+import bisect
+import calendar
+import shutil
+import zipfile
+import argparse
+import sqlite3
+import inspect
+import signal
+import socket
+import unicodedata
+import email.utils
+import functools
+import threading
+import contextvars
+import queue
+import asyncio
+import multiprocessing
+from array import array
+from collections import OrderedDict, deque
+from collections.abc import Sequence
+from concurrent.futures import ThreadPoolExecutor, ProcessPoolExecutor, as_completed
+from datetime import datetime, timedelta, timezone
+from urllib.parse import urljoin, parse_qs
+from html.parser import HTMLParser
 
 import requests
-from bs4 import BeautifulSoup
-from flask import Flask, render_template_string, request, redirect, url_for
+from requests.adapters import HTTPAdapter
+from urllib3.connection import HTTPConnection, HTTPSConnection
+from urllib3.connectionpool import HTTPConnectionPool, HTTPSConnectionPool
+from urllib3.util.request import ACCEPT_ENCODING
+from bs4 import BeautifulSoup, Tag
+from bs4.dammit import EncodingDetector, UnicodeDammit, EntitySubstitution
+from flask import (Flask, Response, render_template, request, redirect, url_for, jsonify, g,
+                   has_request_context, stream_with_context, before_render_template, template_rendered)
+from jinja2 import DictLoader
+from werkzeug.exceptions import HTTPException
+from werkzeug.serving import BaseWSGIServer, WSGIRequestHandler
+
+try:
+    import fcntl  # ワーカー間のレート制限共有に使用（POSIXのみ）
+except ImportError:
+    fcntl = None
+
+try:
+    import orjson  # インストールされていれば目次JSONの解析に使用
+except ImportError:
+    orjson = None
+
+try:
+    import httpx  # 非同期(ASGI)モードの上流取得に使用
+except ImportError:
+    httpx = None
+
+try:
+    import lxml  # HTML_PARSER = 'lxml' の場合にBeautifulSoupのパーサーに使用
+    from lxml import etree as lxml_etree  # ランキング・検索ページはBeautifulSoupを介さず直接解析する
+except ImportError:
+    lxml = lxml_etree = None
+
+try:
+    import brotli  # インストールされていれば描画済みページのbrotli圧縮版も用意する
+except ImportError:
+    brotli = None
 
 # --- Flaskアプリケーションの初期化 ---
 app = Flask(__name__)
 
 # --- グローバル設定 ---
-BASE_URL = "https://kakuyomu.jp/"
-SEARCH_URL = "https://kakuyomu.jp/search"
-RANKING_URL_BASE = "https://kakuyomu.jp/rankings"
+# 環境変数KAKUYOMU_BASE_URLで取得先を変更できる（ベンチマークでは bench/standin.py の代替サーバーを指定する）
+BASE_URL = os.environ.get('KAKUYOMU_BASE_URL', "https://kakuyomu.jp/")
+SEARCH_URL = urljoin(BASE_URL, "search")
+RANKING_URL_BASE = urljoin(BASE_URL, "rankings")
 USER_AGENT = "Mozilla/5.0 (Windows NT 10.0; Win64; x64) AppleWebKit/537.36 (KHTML, like Gecko) Chrome/91.0.4472.124 Safari/537.36"
 HEADERS = {"User-Agent": USER_AGENT}
+RANKING_GENRES = ['all', 'fantasy', 'action', 'sf', 'love_story', 'romance', 'drama', 'horror', 'mystery', 'nonfiction', 'history', 'criticism', 'others']
+RANKING_PERIODS = ['daily', 'weekly', 'monthly', 'yearly', 'entire']
+
+# --- HTTP接続設定 ---
+HTTP_POOL_SIZE = 10  # カクヨムへの同時接続数の上限
+HTTP_MAX_RETRIES = 3  # 429/5xx応答・通信エラー時の再試行回数（再試行もレート制限と回路遮断器に従う）
+HTTP_RETRY_BACKOFF = 0.5  # 再試行間隔の基準秒数（指数的に増加）
+HTTP_RETRY_STATUSES = (429, 500, 502, 503, 504)
+HTTP_RETRY_AFTER_MAX = 30  # Retry-Afterに従って待つ最大秒数（これより長い指定なら再試行しない）
+HTTP_TIMEOUT = 15
+# 上流の障害時は、連続してこの回数失敗（タイムアウト・接続エラー・429/5xx）すると取得を止める
+CIRCUIT_FAILURE_THRESHOLD = 5
+CIRCUIT_COOLDOWN = 30  # 取得を止める秒数。経過後に1件だけ試し、成功すれば再開する
+
+# --- キャッシュ設定 ---
+CACHE_MAX_BYTES = 64 * 1024 * 1024  # メモリキャッシュの上限（バイト）
+CACHE_DISK_PATH = None  # ディスクキャッシュ(SQLite)のパス。Noneの場合はメモリのみ
+# ページ種別ごとの有効期限（秒）
+CACHE_TTL = {
+    'ranking': 60 * 60,           # ランキングは日次で入れ替わる
+    'search': 10 * 60,
+    'toc': 10 * 60,               # 目次は更新時のみ変わる
+    'episode': 7 * 24 * 60 * 60,  # 本文はほぼ不変
+}
+CACHE_STALE_KEEP = 30 * 24 * 60 * 60  # 期限切れ後も条件付きGETの再検証用に保持する秒数
+# 期限切れ後この秒数までは、前回の結果をすぐ返して裏で取り直す（0で無効）
+CACHE_STALE_WHILE_REVALIDATE = 60 * 60
+REVALIDATE_WORKERS = 2  # 裏で取り直すスレッド数
+CACHE_COMPRESS_TYPES = ()  # zlibで圧縮して保持するページ種別（例: ('episode',)。取り出すたびに展開する）
+CACHE_COMPRESS_LEVEL = 6
+
+# --- レート制限設定 ---
+RATE_LIMIT_RATE = 1.0  # カクヨムへの1秒あたりの平均リクエスト数
+RATE_LIMIT_BURST = 3  # アイドル後に待機なしで送れるリクエスト数
+RATE_LIMIT_STATE_PATH = None  # ワーカー間で共有する状態ファイルのパス。Noneの場合はプロセス内のみ
+
+# --- 先読み設定 ---
+PREFETCH_ENABLED = True  # 本文表示後に続きのエピソードと目次を先読みする
+PREFETCH_EPISODES = 2  # 先読みする後続エピソード数
+PREFETCH_WORKERS = 1  # 先読み用のスレッド数
+
+# --- 一括エクスポート設定 ---
+EXPORT_WORKERS = 4  # 作品の一括エクスポートで本文を並行取得するスレッド数（取得頻度はレート制限に従う）
+
+# --- データ保存先設定 ---
+# ライブラリなどのSQLiteファイルを置くディレクトリ（環境変数KAKUYOMU_DATA_DIRで変更できる）。各ファイルの相対パスはここからのパス
+DATA_DIR = os.environ.get('KAKUYOMU_DATA_DIR', os.path.join(os.path.expanduser('~'), '.kakuyomu-reader'))
+
+# --- ライブラリ設定 ---
+LIBRARY_PATH = 'library.sqlite'  # 作品・エピソード・本文を保存するSQLiteファイルのパス（最初の使用時に作成）
+
+# --- 更新情報設定 ---
+FEED_WORKERS = 8  # 複数作品の目次を並行取得するスレッド数（取得頻度はレート制限に従う）
+FEED_DEFAULT_DAYS = 7  # sinceを省略した場合に遡る日数
+FEED_MAX_WORKS = 500  # 1回に指定できる作品数の上限
+
+# --- JSON API設定 ---
+API_BATCH_MAX_EPISODES = 100  # /api/v1/works/<作品ID>/episodes で一度に指定できる話数の上限
+API_BATCH_WORKERS = 4  # まとめて指定された本文を並行取得するスレッド数（取得頻度はレート制限に従う）
+
+# --- 本番サーバー設定（python app.py serve） ---
+SERVER_HOST = '0.0.0.0'
+SERVER_PORT = 8000
+SERVER_WORKERS = os.cpu_count() or 1  # 起動時にフォークするワーカープロセス数
+SERVER_THREADS = 8  # ワーカーごとにリクエストを処理するスレッド数
+# ワーカー間で共有する状態（ディスクキャッシュ・レート制限・取得中のページの表）を置くディレクトリ（起動時の作業ディレクトリによらない）
+SERVER_SHARED_DIR = os.path.join(DATA_DIR, 'shared')
+WARM_START_WORKS = 50  # 起動時にディスクキャッシュから読み込む作品数（ライブラリの作品、ランキング上位の順）
+WARM_START_MAX_BYTES = CACHE_MAX_BYTES // 2  # 起動時にメモリへ読み込む量の上限
+
+# --- ランキングの定期取得設定 ---
+# サーバー起動中、全ジャンル×期間のランキングを定期的に取得してスナップショットを保存する（python app.py serve では有効になる）
+RANKING_WARM_ENABLED = False
+RANKING_WARM_INTERVAL = 60 * 60  # 定期取得の間隔（秒）
+RANKING_WARM_PAGES = 1  # ジャンル×期間ごとに取得するページ数
+RANKING_SNAPSHOT_PATH = 'rankings.sqlite'  # スナップショットと順位の履歴を保存するSQLiteファイルのパス。Noneの場合は保存しない
+RANKING_SNAPSHOT_MAX_AGE = 2 * 60 * 60  # これより古いスナップショットは使わず、その場で取得する（秒）
+RANKING_HISTORY_KEEP = 8 * 24 * 60 * 60  # 順位の履歴を保持する秒数
+RANKING_DELTA_WINDOW = 24 * 60 * 60  # 順位の変動は、この秒数より前の最新の順位と比較する
+
+# --- 検索設定 ---
+SEARCH_PER_PAGE = 20  # カクヨムの検索結果1ページの件数
+SEARCH_RESULT_SETS_MAX = 1000  # 検索結果の件数を記録しておく検索語（正規化後）の数
+SEARCH_TOTAL_MISS_TTL = 5  # 件数が不明だった検索語について、ディスクキャッシュを確認し直さない秒数
+
+# --- ローカル検索設定 ---
+SEARCH_INDEX_PATH = None  # 取得した目次・本文の全文検索索引(SQLite FTS5)のパス（例: 'search_index.sqlite'）。Noneの場合は索引を作らない
+SEARCH_LOCAL_PER_PAGE = 20  # ローカル検索で1ページに表示する件数
+SEARCH_SNIPPET_CHARS = 40  # 検索結果の抜粋で、一致箇所の前後に表示する文字数
+
+# --- HTML解析設定 ---
+HTML_PARSER = 'html.parser'  # BeautifulSoupのパーサー。'lxml'にすると高速になる（lxmlのインストールが必要。解析結果が一部異なる場合がある）
+PARSE_PROCESSES = 0  # HTML解析を行うプロセス数。0の場合はリクエストを処理するスレッドで解析する
+
+# --- 目次表示設定 ---
+TOC_COLLAPSE_THRESHOLD = 300  # この話数を超える作品は、目次を章ごとに折りたたんで表示する
+TOC_SECTION_SIZE = 100  # 章ごと表示で1つの区切りに含める最大話数（長い章は分割する）
+
+# --- 描画設定 ---
+STREAM_CHUNK_CHARS = 8192  # ストリーミング描画で一度に送信する文字数の目安
+
+# --- 描画済みページのキャッシュ設定 ---
+PAGE_CACHE_MAX_BYTES = 32 * 1024 * 1024  # 描画済みページ（圧縮版を含む）を保持する上限（バイト）
+PAGE_GZIP_LEVEL = 6
+PAGE_BROTLI_QUALITY = 5
+# ページ種別ごとのCache-Control（期限後はETagで再検証される）
+PAGE_CACHE_CONTROL = {
+    'toc': 'public, max-age=60',         # 更新を早く反映するため短め
+    'episode': 'public, max-age=3600',
+}
+
+# --- 非同期(ASGI)モード設定 ---
+ASYNC_PARSE_WORKERS = 4  # 非同期モードでHTML解析に使うスレッド数
+
+# --- 計測設定 ---
+METRICS_PREFIX = 'kakuyomu_reader'
+# /metricsのヒストグラムの区切り（秒）。キャッシュ済みページの描画から上流の再試行までを含む範囲
+METRICS_BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30)
+PROFILE_ENABLED = False  # Trueにすると ?__profile=1 でリクエスト処理のcProfile結果を返す（開発用）
+PROFILE_LIMIT = 40  # ?__profile=1 の結果に表示する関数の数
 
 # ==============================================================================
 # --- HTMLテンプレート ---
@@ -93,6 +282,7 @@ INDEX_TEMPLATE = BASE_TEMPLATE.replace(
             <input type="text" name="q" placeholder="作品名、作者名など" required>
             <input type="submit" value="検索">
         </div>
+        {% if local_search %}<label><input type="checkbox" name="mode" value="local"> 取得済みの作品・本文から検索</label>{% endif %}
     </form>
     <hr>
     <h2>ランキング</h2>
@@ -129,7 +319,7 @@ RANKING_TEMPLATE = BASE_TEMPLATE.replace(
         <div>
         {% for novel in results %}
             <div class="ranking-item">
-                <h3>{{ novel.rank }}. <a href="{{ url_for('table_of_contents', work_id=novel.work_id) }}">{{ novel.title }}</a></h3>
+                <h3>{{ novel.rank }}. <a href="{{ url_for('table_of_contents', work_id=novel.work_id) }}">{{ novel.title }}</a>{% if novel.work_id in deltas %} <small title="{{ delta_since }}からの変動">{{ deltas[novel.work_id] }}</small>{% endif %}</h3>
                 <p>作者: {{ novel.author }}</p>
                 <small>{{ novel.meta }}</small>
                 <div class="summary">{{ novel.summary }}</div>
@@ -161,7 +351,8 @@ SEARCH_RESULTS_TEMPLATE = BASE_TEMPLATE.replace(
 ).replace(
     "{% block content %}{% endblock %}",
     """{% block content %}
-    <h2>「{{ query }}」の検索結果 ({{ total }}件)</h2>
+    <h2>「{{ query }}」の検索結果 ({{ total }}件)</h2>{% if fallback %}
+    <p><small>取得済みの作品・本文に一致するものがなかったため、カクヨムで検索しました。</small></p>{% endif %}
 
     {% if results %}
         <ol>
@@ -191,6 +382,45 @@ SEARCH_RESULTS_TEMPLATE = BASE_TEMPLATE.replace(
     {% endblock %}"""
 )
 
+# --- ローカル検索結果ページ ---
+LOCAL_SEARCH_TEMPLATE = BASE_TEMPLATE.replace(
+    "{% block title %}軽量カクヨムリーダー{% endblock %}",
+    "{% block title %}{{ query }} のローカル検索結果{% endblock %}"
+).replace(
+    "{% block content %}{% endblock %}",
+    """{% block content %}
+    <h2>「{{ query }}」のローカル検索結果 ({{ total }}件)</h2>
+    <p><small>取得済みの作品・本文から検索しています。<a href="{{ url_for('search', q=query) }}">カクヨムで検索</a></small></p>
+
+    <ol start="{{ (current_page - 1) * per_page + 1 }}">
+    {% for item in results %}
+        <li>
+            {% if item.episode_id %}
+            <strong><a href="{{ url_for('viewer', work_id=item.work_id, episode_id=item.episode_id) }}">{{ item.title }}</a></strong>
+            （<a href="{{ url_for('table_of_contents', work_id=item.work_id) }}">{{ item.work_title }}</a>）<br>
+            {% else %}
+            <strong><a href="{{ url_for('table_of_contents', work_id=item.work_id) }}">{{ item.title }}</a></strong><br>
+            作者: {{ item.author }}<br>
+            {% endif %}
+            <div class="summary">{% for text, matched in item.snippet %}{% if matched %}<mark>{{ text }}</mark>{% else %}{{ text }}{% endif %}{% endfor %}</div>
+        </li>
+    {% endfor %}
+    </ol>
+
+    <div class="pagination">
+        {% if pagination.prev %}
+            <a href="{{ url_for('search', q=query, mode='local', page=pagination.prev) }}">< 前のページ</a>
+        {% endif %}
+        {% if pagination.prev or pagination.next %}
+            <span>- {{ current_page }} -</span>
+        {% endif %}
+        {% if pagination.next %}
+            <a href="{{ url_for('search', q=query, mode='local', page=pagination.next) }}">次のページ ></a>
+        {% endif %}
+    </div>
+    {% endblock %}"""
+)
+
 # --- 目次ページ ---
 TOC_TEMPLATE = BASE_TEMPLATE.replace(
     "{% block title %}軽量カクヨムリーダー{% endblock %}",
@@ -204,8 +434,65 @@ TOC_TEMPLATE = BASE_TEMPLATE.replace(
     <h3>あらすじ</h3>
     <div class="summary">{{ novel.summary | safe }}</div>
 
+    <p>ダウンロード:
+        <a href="{{ url_for('export_work', work_id=novel.work_id, fmt='epub') }}">EPUB</a>
+        <a href="{{ url_for('export_work', work_id=novel.work_id, fmt='txt') }}">テキスト</a>
+    </p>
+    <form action="{{ url_for('library_sync') }}" method="post">
+        <input type="hidden" name="work_id" value="{{ novel.work_id }}">
+        <input type="submit" value="ライブラリに保存">
+    </form>
+
     <h3>目次</h3>
-    {% if novel.episodes %}
+    {% if sections %}
+        <p>
+            <strong>章ごとに表示</strong>
+            <a href="{{ url_for('table_of_contents', work_id=novel.work_id, view='full') }}">すべて表示</a>
+        </p>
+        {% for section in sections %}
+            <details class="toc-section"{% if loop.index0 == current %} open data-loaded="1"{% endif %}
+                     data-src="{{ url_for('toc_section', work_id=novel.work_id, index=loop.index0) }}">
+                <summary class="chapter-title">{{ section.title or '本編' }}（{{ section.first }}〜{{ section.last }}話目）</summary>
+                {% if loop.index0 == current %}
+                    <ul style="list-style-type: none; padding-left: 10px;">
+                    {% for item in section.episodes %}
+                        <li><a href="{{ url_for('viewer', work_id=novel.work_id, episode_id=item.episode_id) }}">{{ item.title }}</a></li>
+                    {% endfor %}
+                    </ul>
+                {% else %}
+                    <p><a href="{{ url_for('table_of_contents', work_id=novel.work_id, chapter=loop.index0) }}">この章を開く</a></p>
+                {% endif %}
+            </details>
+        {% endfor %}
+        <div class="pagination">
+            {% if current > 0 %}<a href="{{ url_for('table_of_contents', work_id=novel.work_id, chapter=current - 1) }}">＜ 前の章</a>{% endif %}
+            {% if current + 1 < sections | length %}<a href="{{ url_for('table_of_contents', work_id=novel.work_id, chapter=current + 1) }}">次の章 ＞</a>{% endif %}
+        </div>
+        <script>
+            // 閉じている章は、開いたときにエピソード一覧を読み込む
+            document.querySelectorAll('details.toc-section').forEach(function (section) {
+                section.addEventListener('toggle', function () {
+                    if (!section.open || section.dataset.loaded) return;
+                    section.dataset.loaded = '1';
+                    fetch(section.dataset.src).then(function (response) { return response.json(); }).then(function (data) {
+                        var list = document.createElement('ul');
+                        list.style.cssText = 'list-style-type: none; padding-left: 10px;';
+                        data.episodes.forEach(function (episode) {
+                            var link = document.createElement('a');
+                            link.href = episode.url;
+                            link.textContent = episode.title;
+                            list.appendChild(document.createElement('li')).appendChild(link);
+                        });
+                        section.replaceChild(list, section.querySelector('p'));
+                    });
+                });
+            });
+        </script>
+    {% elif novel.episodes %}{% if collapsible %}
+        <p>
+            <a href="{{ url_for('table_of_contents', work_id=novel.work_id, view='chapters') }}">章ごとに表示</a>
+            <strong>すべて表示</strong>
+        </p>{% endif %}
         <div>
         {% for item in novel.episodes %}
             {% if item.is_chapter %}
@@ -253,6 +540,45 @@ VIEWER_TEMPLATE = BASE_TEMPLATE.replace(
     {% endblock %}"""
 )
 
+# --- ライブラリページ ---
+LIBRARY_TEMPLATE = BASE_TEMPLATE.replace(
+    "{% block title %}軽量カクヨムリーダー{% endblock %}",
+    "{% block title %}ライブラリ{% endblock %}"
+).replace(
+    "{% block content %}{% endblock %}",
+    """{% block content %}
+    <h2>ライブラリ</h2>
+    <form action="{{ url_for('library_sync') }}" method="post">
+        <input type="submit" value="すべての作品の更新を確認">
+    </form>
+    {% if status.current or status.queued %}
+        <p>更新を確認中です（残り {{ status.queued + (1 if status.current else 0) }} 作品）。</p>
+    {% endif %}
+
+    {% for work in works %}
+        <div class="ranking-item">
+            <h3><a href="{{ url_for('table_of_contents', work_id=work.work_id) }}">{{ work.title or work.work_id }}</a></h3>
+            <p>作者: {{ work.author or '不明' }} / 保存済み {{ work.stored }} / {{ work.episodes }}話</p>
+            {% if work.last_sync %}
+                <small>前回の確認: 取得 {{ work.last_sync.fetched }}話、キャッシュ {{ work.last_sync.cached }}話、
+                    変更なし {{ work.last_sync.skipped }}話、削除 {{ work.last_sync.removed }}話、
+                    失敗 {{ work.last_sync.failed }}件、受信 {{ (work.last_sync.bytes / 1024) | round(1) }}KB</small>
+            {% endif %}
+        </div>
+    {% else %}
+        <p>保存された作品はありません。目次ページの「ライブラリに保存」から追加できます。</p>
+    {% endfor %}
+    {% endblock %}"""
+)
+
+# --- 取得失敗時のメッセージ（ページ種別ごと） ---
+FETCH_ERROR_MESSAGES = {
+    'ranking': "ランキングページの取得に失敗しました。",
+    'search': "検索結果の取得に失敗しました。時間をおいて再試行してください。",
+    'toc': "目次ページの取得に失敗しました。作品IDが正しいか、サイトの構造が変更されていないか確認してください。",
+    'episode': "本文ページの取得に失敗しました。",
+}
+
 # --- エラーページ ---
 ERROR_TEMPLATE = BASE_TEMPLATE.replace(
     "{% block title %}軽量カクヨムリーダー{% endblock %}",
@@ -266,347 +592,4480 @@ ERROR_TEMPLATE = BASE_TEMPLATE.replace(
     {% endblock %}"""
 )
 
+# --- EPUBエクスポート用テンプレート ---
+EPUB_CONTAINER_XML = """<?xml version="1.0" encoding="UTF-8"?>
+<container version="1.0" xmlns="urn:oasis:names:tc:opendocument:xmlns:container">
+    <rootfiles>
+        <rootfile full-path="OEBPS/content.opf" media-type="application/oebps-package+xml"/>
+    </rootfiles>
+</container>
+"""
+
+EPUB_EPISODE_TEMPLATE = """<?xml version="1.0" encoding="UTF-8"?>
+<!DOCTYPE html>
+<html xmlns="http://www.w3.org/1999/xhtml" xml:lang="ja" lang="ja">
+<head>
+    <meta charset="UTF-8"/>
+    <title>{{ heading }}</title>
+</head>
+<body>
+    {% if chapter %}<h2>{{ chapter }}</h2>{% endif %}
+    <h3>{{ heading }}</h3>
+    {% for line in lines %}
+    <p>{% for segment in line %}{% if segment is string %}{% for part in segment.split('\n') %}{% if not loop.first %}<br/>{% endif %}{{ part }}{% endfor %}{% else %}<ruby>{{ segment[0] }}<rp>(</rp><rt>{{ segment[1] }}</rt><rp>)</rp></ruby>{% endif %}{% endfor %}</p>
+    {% endfor %}
+</body>
+</html>
+"""
 
-# ==============================================================================
-# --- ヘルパー関数 ---
-# ==============================================================================
+EPUB_TITLE_TEMPLATE = """<?xml version="1.0" encoding="UTF-8"?>
+<!DOCTYPE html>
+<html xmlns="http://www.w3.org/1999/xhtml" xml:lang="ja" lang="ja">
+<head>
+    <meta charset="UTF-8"/>
+    <title>{{ novel.title }}</title>
+</head>
+<body>
+    <h1>{{ novel.title }}</h1>
+    <p>作者: {{ novel.author }}</p>
+    {% for line in novel.summary.splitlines() %}<p>{{ line }}</p>
+    {% endfor %}
+</body>
+</html>
+"""
 
-def get_page_content(url, params=None):
-    """指定されたURLのHTMLコンテンツを取得する"""
-    try:
-        time.sleep(1) # サーバー負荷軽減のため1秒待機
-        response = requests.get(url, headers=HEADERS, params=params, timeout=15)
-        response.raise_for_status()
-        return BeautifulSoup(response.content, 'html.parser')
-    except requests.exceptions.RequestException as e:
-        print(f"Error fetching {url}: {e}")
-        return None
+EPUB_NAV_TEMPLATE = """<?xml version="1.0" encoding="UTF-8"?>
+<!DOCTYPE html>
+<html xmlns="http://www.w3.org/1999/xhtml" xmlns:epub="http://www.idpf.org/2007/ops" xml:lang="ja" lang="ja">
+<head>
+    <meta charset="UTF-8"/>
+    <title>目次</title>
+</head>
+<body>
+    <nav epub:type="toc" id="toc">
+        <h1>目次</h1>
+        <ol>
+            <li><a href="text/title.xhtml">{{ novel.title }}</a></li>
+            {% for group in groups %}
+                {% if group.title %}
+            <li><span>{{ group.title }}</span>
+                <ol>
+                    {% for entry in group.entries %}<li><a href="text/{{ entry.file }}">{{ entry.title }}</a></li>
+                    {% endfor %}
+                </ol>
+            </li>
+                {% else %}
+                    {% for entry in group.entries %}<li><a href="text/{{ entry.file }}">{{ entry.title }}</a></li>
+                    {% endfor %}
+                {% endif %}
+            {% endfor %}
+        </ol>
+    </nav>
+</body>
+</html>
+"""
 
-def get_work_id_from_url(url):
-    """URLから作品IDを抽出する"""
-    if not url: return None
-    match = re.search(r'/works/(\d+)', url)
-    return match.group(1) if match else None
+EPUB_PACKAGE_TEMPLATE = """<?xml version="1.0" encoding="UTF-8"?>
+<package xmlns="http://www.idpf.org/2007/opf" version="3.0" unique-identifier="book-id" xml:lang="ja">
+    <metadata xmlns:dc="http://purl.org/dc/elements/1.1/">
+        <dc:identifier id="book-id">urn:kakuyomu:{{ novel.work_id }}</dc:identifier>
+        <dc:title>{{ novel.title }}</dc:title>
+        <dc:creator>{{ novel.author }}</dc:creator>
+        <dc:language>ja</dc:language>
+        <meta property="dcterms:modified">{{ modified }}</meta>
+    </metadata>
+    <manifest>
+        <item id="nav" href="nav.xhtml" media-type="application/xhtml+xml" properties="nav"/>
+        <item id="title" href="text/title.xhtml" media-type="application/xhtml+xml"/>
+        {% for file in files %}<item id="episode-{{ loop.index }}" href="text/{{ file }}" media-type="application/xhtml+xml"/>
+        {% endfor %}
+    </manifest>
+    <spine>
+        <itemref idref="title"/>
+        {% for file in files %}<itemref idref="episode-{{ loop.index }}"/>
+        {% endfor %}
+    </spine>
+</package>
+"""
+
+# --- テンプレートの登録 ---
+# 起動時に一度だけコンパイルしておき、各ルートはテンプレート名で描画する
+# （拡張子が.html/.xhtml/.xmlのテンプレートは自動エスケープされる）
+TEMPLATES = {
+    'index.html': INDEX_TEMPLATE,
+    'ranking.html': RANKING_TEMPLATE,
+    'search.html': SEARCH_RESULTS_TEMPLATE,
+    'search_local.html': LOCAL_SEARCH_TEMPLATE,
+    'toc.html': TOC_TEMPLATE,
+    'viewer.html': VIEWER_TEMPLATE,
+    'library.html': LIBRARY_TEMPLATE,
+    'error.html': ERROR_TEMPLATE,
+    'epub/title.xhtml': EPUB_TITLE_TEMPLATE,
+    'epub/episode.xhtml': EPUB_EPISODE_TEMPLATE,
+    'epub/nav.xhtml': EPUB_NAV_TEMPLATE,
+    'epub/package.xml': EPUB_PACKAGE_TEMPLATE,
+}
+app.jinja_loader = DictLoader(TEMPLATES)
+for template_name in TEMPLATES:
+    app.jinja_env.get_template(template_name)
 
-def get_episode_id_from_url(url):
-    """URLからエピソードIDを抽出する"""
-    if not url: return None
-    match = re.search(r'/episodes/(\d+)', url)
-    return match.group(1) if match else None
 
 # ==============================================================================
-# --- スクレイピング関数 ---
+# --- レート制限・リクエスト集約 ---
 # ==============================================================================
 
-def scrape_ranking_page(genre, period, page=1):
-    """ランキングページをスクレイピングする"""
-    url = f"{RANKING_URL_BASE}/{genre}/{period}"
-    params = {'page': page}
-    soup = get_page_content(url, params)
-    if not soup:
-        return None
+class TokenBucket:
+    """プロセス内の全スレッドで共有するトークンバケット方式のレート制限"""
 
-    results = []
-    # 広告枠などを除外し、純粋なランキングアイテム(`.widget-work.float-parent`)のみを選択
-    ranking_items = soup.select('div.widget-work.float-parent')
-    
-    for item in ranking_items:
-        # find_parentで広告枠内の要素でないことを確認
-        if item.find_parent(class_='widget-workRankingBoxForNext'):
-            continue
+    def __init__(self, rate, burst):
+        self.rate = rate
+        self.burst = burst
+        self._tokens = float(burst)
+        self._updated = time.monotonic()
+        self._lock = threading.Lock()
 
-        rank_tag = item.select_one('p.widget-work-rank')
-        title_tag = item.select_one('h3.widget-workCard-title a.widget-workCard-titleLabel')
-        author_tag = item.select_one('a.widget-workCard-authorLabel')
-        summary_tag = item.select_one('p.widget-workCard-introduction a')
-        meta_tag = item.select_one('p.widget-workCard-meta')
+    def acquire(self, background=False):
+        """送信枠を1つ予約し、枠が来るまで待機する。待機した秒数を返す
 
-        # 必須要素がなければスキップ
-        if not (rank_tag and title_tag and title_tag.get('href')):
-            continue
+        background=Trueの取得（先読みなど）は空きトークンがある時だけ送信し、
+        ユーザーのリクエスト用に1つ分の余裕を残す。
+        """
+        start = time.monotonic()
+        while True:
+            delay, acquired = self._reserve(background)
+            if delay > 0:
+                time.sleep(delay)
+            if acquired:
+                return time.monotonic() - start
 
-        work_id = get_work_id_from_url(title_tag['href'])
-        if work_id:
-            meta_text = ""
-            if meta_tag:
-                # get_text() を使ってシンプルに取得し、不要な空白や改行を整理
-                meta_text_raw = meta_tag.get_text(separator=' | ', strip=True)
-                # ' | ' で分割し、空でない要素だけを再結合
-                meta_text = ' | '.join(part for part in meta_text_raw.split(' | ') if part)
+    async def acquire_async(self, background=False):
+        """acquireの非同期版。イベントループを止めずに待機する"""
+        start = time.monotonic()
+        while True:
+            delay, acquired = self._reserve(background)
+            if delay > 0:
+                await asyncio.sleep(delay)
+            if acquired:
+                return time.monotonic() - start
 
-            results.append({
-                'rank': rank_tag.get_text(strip=True),
-                'title': title_tag.get_text(strip=True),
-                'work_id': work_id,
-                'author': author_tag.get_text(strip=True) if author_tag else '作者不明',
-                'summary': summary_tag.get_text(strip=True) if summary_tag else 'あらすじなし',
-                'meta': meta_text
-            })
+    def release(self):
+        """予約したが使わなかった送信枠を返す（バーストの上限を超えては貯めない）"""
+        self._update(self._give_back)
 
-    pagination = {'prev': None, 'next': None}
-    next_page_tag = soup.select_one('p.widget-pagerNext a')
-    if next_page_tag and next_page_tag.get('href'):
-        pagination['next'] = page + 1
-        
-    if page > 1:
-        pagination['prev'] = page - 1
-        
-    title_tag = soup.select_one('header.widget-media-genresWorkList-listTitle h3')
-    title = title_tag.get_text(strip=True) if title_tag else 'ランキング'
+    def _reserve(self, background):
+        return self._update(lambda tokens, updated, now: self._take(tokens, updated, now, background))
 
-    return {'results': results, 'pagination': pagination, 'title': title}
+    def _update(self, step):
+        # step(tokens, updated, now) -> (tokens, updated, *結果)。結果を返す
+        with self._lock:
+            self._tokens, self._updated, *result = step(self._tokens, self._updated, time.monotonic())
+            return result
 
+    def _give_back(self, tokens, updated, now):
+        return min(self.burst, tokens + (now - updated) * self.rate + 1), now
 
-def scrape_search_page(query, page=1):
-    """検索結果ページをスクレイピングする"""
-    params = {'q': query, 'page': page}
-    soup = get_page_content(SEARCH_URL, params)
-    if not soup:
-        return None
+    def _take(self, tokens, updated, now, background):
+        tokens = min(self.burst, tokens + (now - updated) * self.rate)
+        if background:
+            threshold = 2 if self.burst > 1 else 1
+            if tokens < threshold:
+                return tokens, now, (threshold - tokens) / self.rate, False
+        # トークンが足りない場合は負債として予約し、到着順に待機時間を割り当てる
+        tokens -= 1
+        delay = -tokens / self.rate if tokens < 0 else 0.0
+        return tokens, now, delay, True
 
-    results = []
-    # Next.jsの動的クラス名に対応するため、より一般的なセレクタを使用
-    search_results = soup.select('#search-result-main div[class*="WorkListItem_container"]')
-    if not search_results:
-        # 代替セレクタ
-        title_links = soup.select('h3[class*="Heading_heading"] a[href^="/works/"]')
-        search_results = [tag.find_parent('div', class_=lambda c: c and 'NewBox_box' in c and 'padding-py-m' in c) for tag in title_links]
-
-
-    for item in search_results:
-        if not item: continue
-        title_tag = item.select_one('h3[class*="Heading_heading"] a')
-        author_tag = item.select_one('span[class*="WorkTitle_workLabelAuthor"] a')
-        summary_tag = item.select_one('a[href^="/works/"] > div[class*="partialGiftWidgetWeakText"]')
-
-        if title_tag and title_tag.get('href'):
-            work_id = get_work_id_from_url(title_tag['href'])
-            if work_id:
-                results.append({
-                    'title': title_tag.get_text(strip=True),
-                    'work_id': work_id,
-                    'author': author_tag.get_text(strip=True) if author_tag else '作者不明',
-                    'summary': summary_tag.get_text(strip=True, separator='\n') if summary_tag else 'あらすじなし'
-                })
 
-    pagination = {'prev': None, 'next': None}
-    total_text_container = soup.select_one('div[class*="Typography_align-right"]')
-    total_text = total_text_container.get_text(strip=True) if total_text_container else ""
-    total_count_match = re.search(r'全(\d+)件', total_text)
-    total = total_count_match.group(1) if total_count_match else '多数'
-    
-    # ページネーションの有無を判定
-    # 検索結果が20件（1ページの最大数）あれば、次のページがある可能性があるとみなす
-    if len(results) >= 20:
-        pagination['next'] = page + 1
-    if page > 1:
-        pagination['prev'] = page - 1
+class FileTokenBucket(TokenBucket):
+    """状態ファイルをfcntlでロックし、複数ワーカープロセス間で共有するトークンバケット"""
 
-    return {'results': results, 'pagination': pagination, 'total': total}
+    def __init__(self, rate, burst, path):
+        super().__init__(rate, burst)
+        self.path = path
 
-def scrape_toc_page(work_id):
-    """作品の目次ページをスクレイピングする（__NEXT_DATA__ JSONを解析する方式）"""
-    url = urljoin(BASE_URL, f"works/{work_id}")
-    soup = get_page_content(url)
-    if not soup:
-        return None
+    def _update(self, step):
+        with self._lock, open(self.path, 'a+') as f:
+            fcntl.flock(f, fcntl.LOCK_EX)  # closeで解放される
+            f.seek(0)
+            raw = f.read()
+            now = time.time()
+            tokens, updated = json.loads(raw) if raw else (float(self.burst), now)
+            tokens, updated, *result = step(tokens, updated, now)
+            f.seek(0)
+            f.truncate()
+            f.write(json.dumps([tokens, updated]))
+            return result
 
-    script_tag = soup.find('script', id='__NEXT_DATA__')
-    if not script_tag:
-        return None
 
-    try:
-        data = json.loads(script_tag.string)
-        apollo_state = data['props']['pageProps']['__APOLLO_STATE__']
-    except (json.JSONDecodeError, KeyError) as e:
-        print(f"Error parsing JSON data: {e}")
-        return None
+def create_rate_limiter():
+    """設定に応じたレート制限を生成する"""
+    if RATE_LIMIT_STATE_PATH:
+        if fcntl is not None:
+            return FileTokenBucket(RATE_LIMIT_RATE, RATE_LIMIT_BURST, RATE_LIMIT_STATE_PATH)
+        print("fcntl is unavailable; falling back to a per-process rate limiter")
+    return TokenBucket(RATE_LIMIT_RATE, RATE_LIMIT_BURST)
 
-    work_key = f'Work:{work_id}'
-    if work_key not in apollo_state:
-        return None
-    work_data = apollo_state[work_key]
 
-    author_key = work_data.get('author', {}).get('__ref')
-    author_name = apollo_state.get(author_key, {}).get('activityName', '作者不明')
+rate_limiter = create_rate_limiter()
 
-    novel_info = {
-        'title': work_data.get('title', 'タイトル不明'),
-        'work_id': work_id,
-        'author': author_name,
-        'summary': work_data.get('introduction', '').replace('\\n', '\n'),
-        'episodes': []
-    }
 
-    toc_refs = work_data.get('tableOfContents', [])
-    for toc_ref in toc_refs:
-        chapter_key = toc_ref.get('__ref')
-        chapter_data = apollo_state.get(chapter_key)
-        
-        if not chapter_data:
-            continue
-            
-        # 章タイトルを追加 (章が存在する場合のみ)
-        # 'chapter'キーの値がnull (PythonではNone) の場合があるため、チェックを強化
-        chapter_ref = chapter_data.get('chapter')
-        if chapter_ref and chapter_ref.get('__ref'):
-            chapter_info_key = chapter_ref.get('__ref')
-            chapter_info = apollo_state.get(chapter_info_key)
-            if chapter_info:
-                novel_info['episodes'].append({
-                    'is_chapter': True,
-                    'title': chapter_info.get('title', '章タイトル不明')
-                })
+class SingleFlight:
+    """同一キーに対する同時実行を1回にまとめ、後続の呼び出しには同じ結果を返す"""
 
-        # エピソードリストを追加
-        episode_refs = chapter_data.get('episodeUnions', [])
-        for episode_ref in episode_refs:
-            episode_key = episode_ref.get('__ref')
-            episode_data = apollo_state.get(episode_key)
-            if episode_data:
-                episode_id = episode_data.get('id')
-                if episode_id:
-                    novel_info['episodes'].append({
-                        'is_chapter': False,
-                        'title': episode_data.get('title', 'エピソード不明'),
-                        'episode_id': episode_id
-                    })
-                
-    return novel_info
+    class _Call:
+        def __init__(self):
+            self.done = threading.Event()
+            self.result = None
 
-def scrape_viewer_page(work_id, episode_id):
-    """小説の本文ページをスクレイピングする"""
-    url = urljoin(BASE_URL, f"works/{work_id}/episodes/{episode_id}")
-    soup = get_page_content(url)
-    if not soup:
-        return None
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._calls = {}
 
-    title_tag = soup.select_one('#worksEpisodesEpisodeHeader-breadcrumbs h1 a')
-    subtitle_tag = soup.select_one('.widget-episodeTitle, p[class*="WorkEpisode_title__"]')
+    def do(self, key, func, recheck=None):
+        """recheckは、他のプロセスの取得を待った後に共有キャッシュを確認する関数（プロセス内だけの場合は使わない）"""
+        with self._lock:
+            call = self._calls.get(key)
+            leader = call is None
+            if leader:
+                call = self._calls[key] = self._Call()
 
-    title = title_tag.get_text(strip=True) if title_tag else '作品タイトル不明'
-    subtitle = subtitle_tag.get_text(strip=True) if subtitle_tag else 'サブタイトル不明'
-    
-    novel_honbun = soup.select_one('div.widget-episodeBody, div[class*="Viewer_viewer__"]')
-
-    if novel_honbun:
-        for ruby in novel_honbun.find_all('ruby'):
-            rt = ruby.find('rt')
-            if not rt: continue
-            for rp in ruby.find_all('rp'): rp.decompose()
-            rt_text = rt.get_text(strip=True)
-            rt.decompose()
-            rb_text = ruby.get_text(strip=True)
-            ruby.replace_with(f'{rb_text}({rt_text})')
-        
-        body_lines = [p.get_text('\n', strip=True) for p in novel_honbun.find_all('p') if p.get_text(strip=True)]
-    else:
-        body_lines = ['本文が取得できませんでした。']
+        if not leader:
+            start = time.monotonic()
+            call.done.wait()
+            record_upstream_timing('coalesce', time.monotonic() - start)
+            return call.result
 
-    novel = {
-        'title': title,
-        'subtitle': subtitle,
-        'body': body_lines
-    }
+        try:
+            call.result = func()
+        finally:
+            with self._lock:
+                del self._calls[key]
+            call.done.set()
+        return call.result
 
-    nav = {'prev': None, 'toc': url_for('table_of_contents', work_id=work_id), 'next': None}
-    
-    prev_tag = soup.select_one('link[rel="prev"], a[class*="ChapterLink_prev__"]')
-    if prev_tag and prev_tag.get('href'):
-        prev_episode_id = get_episode_id_from_url(prev_tag['href'])
-        if prev_episode_id:
-            nav['prev'] = url_for('viewer', work_id=work_id, episode_id=prev_episode_id)
-
-    next_tag = soup.select_one('link[rel="next"], a[class*="ChapterLink_next__"]')
-    if next_tag and next_tag.get('href'):
-        next_episode_id = get_episode_id_from_url(next_tag['href'])
-        if next_episode_id:
-            nav['next'] = url_for('viewer', work_id=work_id, episode_id=next_episode_id)
+    def pending(self, key):
+        """このプロセスでkeyを取得中か"""
+        with self._lock:
+            return key in self._calls
 
-    return novel, nav
 
+class FileSingleFlight(SingleFlight):
+    """SingleFlightを、ロックファイル(flock)で複数ワーカープロセス間に広げたもの
 
-# ==============================================================================
-# --- Flask ルート定義 ---
-# ==============================================================================
+    プロセス内の同時呼び出しはSingleFlightでまとめ、代表のスレッドだけがキーのロックを取る。
+    他のプロセスが取得中だった場合は、その完了を待ってからrecheck（共有のディスクキャッシュの確認）を行い、
+    結果があれば取得せずにそれを返す。
+    """
 
-@app.route('/')
-def index():
-    """トップページ: 検索フォームを表示"""
-    return render_template_string(INDEX_TEMPLATE)
+    LOCK_BUCKETS = 256  # キーのハッシュで割り当てるロックファイルの数
 
-@app.route('/ranking/<genre>/<period>')
-def ranking(genre, period):
-    """ランキングを表示"""
-    page = request.args.get('page', 1, type=int)
-    
-    allowed_genres = ['all', 'fantasy', 'action', 'sf', 'love_story', 'romance', 'drama', 'horror', 'mystery', 'nonfiction', 'history', 'criticism', 'others']
-    allowed_periods = ['daily', 'weekly', 'monthly', 'yearly', 'entire']
-    if genre not in allowed_genres or period not in allowed_periods:
-        return render_template_string(ERROR_TEMPLATE, message="無効なランキングの指定です。")
+    def __init__(self, directory):
+        super().__init__()
+        self.directory = directory
+        os.makedirs(directory, exist_ok=True)
 
-    data = scrape_ranking_page(genre, period, page)
-    if data is None:
-        return render_template_string(ERROR_TEMPLATE, message="ランキングページの取得に失敗しました。")
+    def do(self, key, func, recheck=None):
+        return super().do(key, lambda: self._locked(key, func, recheck))
 
-    return render_template_string(
-        RANKING_TEMPLATE,
-        title=data['title'],
-        results=data['results'],
-        pagination=data['pagination'],
-        current_page=page,
-        genre=genre,
-        period=period
-    )
+    def _locked(self, key, func, recheck):
+        bucket = int.from_bytes(hashlib.blake2b(key.encode('utf-8'), digest_size=8).digest(), 'big') % self.LOCK_BUCKETS
+        # flockは開いたファイルごとのロックのため、取得のたびに開けば同じプロセスの別スレッドとも排他になる
+        # （fcntlの範囲ロックはプロセス単位で、スレッド間の待ち合わせをデッドロックと誤検出する）
+        with open(os.path.join(self.directory, f'{bucket:02x}.lock'), 'a') as lock_file:
+            try:
+                waited = self._acquire(lock_file)
+            except OSError as e:
+                # ロックを取れない場合（NFS上のENOLCKなど）は、まとめずに取得する
+                print(f"in-flight lock unavailable ({e}); fetching without coalescing")
+                return func()
+            try:
+                if waited and recheck is not None:
+                    value = recheck()
+                    if value is not None:
+                        return value
+                return func()
+            finally:
+                fcntl.flock(lock_file, fcntl.LOCK_UN)
 
-@app.route('/search')
-def search():
-    """検索結果を表示"""
-    query = request.args.get('q')
-    page = request.args.get('page', 1, type=int)
-    if not query:
-        return redirect(url_for('index'))
+    @staticmethod
+    def _acquire(lock_file):
+        """ロックを取る。他のプロセス（またはスレッド）の完了を待った場合はTrue"""
+        try:
+            fcntl.flock(lock_file, fcntl.LOCK_EX | fcntl.LOCK_NB)
+            return False
+        except BlockingIOError:
+            start = time.monotonic()
+            fcntl.flock(lock_file, fcntl.LOCK_EX)
+            record_upstream_timing('coalesce', time.monotonic() - start)
+            return True
 
-    data = scrape_search_page(query, page)
-    if data is None:
-        return render_template_string(ERROR_TEMPLATE, message="検索結果の取得に失敗しました。時間をおいて再試行してください。")
 
-    return render_template_string(
-        SEARCH_RESULTS_TEMPLATE,
-        query=query,
-        results=data['results'],
-        total=data['total'],
-        pagination=data['pagination'],
-        current_page=page
-    )
+def create_in_flight(path=None):
+    """取得中のページの表を生成する。pathを指定すると、そのディレクトリのロックファイルでワーカープロセス間でも共有する"""
+    if path:
+        if fcntl is not None:
+            return FileSingleFlight(path)
+        print("fcntl is unavailable; falling back to a per-process in-flight table")
+    return SingleFlight()
 
-@app.route('/novel/<work_id>')
-def table_of_contents(work_id):
-    """作品の目次を表示"""
-    novel_data = scrape_toc_page(work_id)
-    if novel_data is None or not novel_data.get('episodes'):
-        return render_template_string(ERROR_TEMPLATE, message="目次ページの取得に失敗しました。作品IDが正しいか、サイトの構造が変更されていないか確認してください。")
-    
-    return render_template_string(
-        TOC_TEMPLATE,
-        novel=novel_data
-    )
+
+in_flight = create_in_flight()
+
+
+class CircuitBreaker:
+    """上流の障害が続く間、取得を待たずに失敗させる回路遮断器
+
+    closed: 通常どおり取得する。failure_threshold回連続で失敗するとopenになる。
+    open: cooldown秒の間は上流に送らずに失敗とする。経過後はhalf_openになる。
+    half_open: 1件だけ試しに取得し、成功すればclosed、失敗すれば再びopenになる。
+    """
+
+    STATES = ('closed', 'half_open', 'open')
+
+    def __init__(self, failure_threshold, cooldown):
+        self.failure_threshold = failure_threshold
+        self.cooldown = cooldown
+        self.state = 'closed'
+        self._failures = 0
+        self._opened_at = 0.0
+        self._trial = False  # half_openで試しの取得を送り出したか
+        self._lock = threading.Lock()
+        self.counters = {'failures': 0, 'trips': 0, 'short_circuits': 0}
+
+    def allow(self):
+        """上流へ送ってよいかを返す（half_openの試しの取得なら 'trial'）
+
+        真の場合は結果をrecord_success/record_failureで報告し、報告できずに終わった場合は
+        戻り値をrelease_trialに渡すこと。
+        """
+        with self._lock:
+            if self.state == 'open' and time.monotonic() - self._opened_at >= self.cooldown:
+                self.state = 'half_open'
+                self._trial = False
+            if self.state == 'closed':
+                return True
+            if self.state == 'half_open' and not self._trial:
+                self._trial = True
+                return 'trial'
+            self.counters['short_circuits'] += 1
+            return False
+
+    def release_trial(self, allowed):
+        """結果を報告せずに終わった取得（キャンセルや上流と無関係の例外）の試しの枠を返す"""
+        with self._lock:
+            if allowed == 'trial' and self.state == 'half_open':
+                self._trial = False
+
+    def record_success(self):
+        with self._lock:
+            self._failures = 0
+            self.state = 'closed'
+
+    def record_failure(self):
+        with self._lock:
+            self.counters['failures'] += 1
+            self._failures += 1
+            if self.state == 'half_open' or (self.state == 'closed' and self._failures >= self.failure_threshold):
+                self.state = 'open'
+                self._opened_at = time.monotonic()
+                self.counters['trips'] += 1
+
+    def stats(self):
+        """現在の状態と連続失敗数、失敗・遮断の回数"""
+        with self._lock:
+            return dict(self.counters, state=self.state, consecutive_failures=self._failures)
+
+
+upstream_breaker = CircuitBreaker(CIRCUIT_FAILURE_THRESHOLD, CIRCUIT_COOLDOWN)
+
+def upstream_failed(status_code):
+    """回路遮断器で上流の障害として数える応答か（404などはページの問題なので数えない）"""
+    return status_code == 429 or status_code >= 500
+
+# 先読みなどバックグラウンドの取得中はTrue（レート制限で低優先度として扱う）
+background_fetch = contextvars.ContextVar('background_fetch', default=False)
+
+# 呼び出し側が先に取得した送信枠 {'used': 使用済みか}。設定されている間、fetch_pageの最初の送信はこの枠を使う
+rate_limit_reserved = contextvars.ContextVar('rate_limit_reserved', default=None)
+
+# 設定されている間、上流から受信した本文のバイト数を追記するリスト（ライブラリ同期の統計用）
+transferred_bytes = contextvars.ContextVar('transferred_bytes', default=None)
+
+def record_transfer(content):
+    """上流から受信したバイト数を記録する"""
+    transferred = transferred_bytes.get()
+    if transferred is not None:
+        transferred.append(len(content))
+
+
+def record_upstream_timing(name, seconds):
+    """リクエスト処理中の上流待ち・解析の時間を記録する（Server-Timingヘッダーで返す）"""
+    if has_request_context():
+        timings = g.setdefault('upstream_timings', {})
+        timings[name] = timings.get(name, 0.0) + seconds
+
+
+@app.before_request
+def start_background_tasks():
+    """最初のリクエストでランキングの定期取得を開始する（リクエストを処理しないプロセスでは動かさない）"""
+    ranking_warmer.start()
+
+@app.after_request
+def add_server_timing(response):
+    """上流の待ち時間と解析時間をServer-Timingヘッダーとして付与する"""
+    timings = g.get('upstream_timings')
+    if timings:
+        response.headers['Server-Timing'] = ', '.join(
+            f"{name};dur={seconds * 1000:.1f}" for name, seconds in timings.items()
+        )
+    return response
+
+# ==============================================================================
+# --- 計測（/metricsとプロファイル） ---
+# ==============================================================================
+
+def escape_label(value):
+    """Prometheusのラベル値をエスケープする"""
+    return str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+
+def format_labels(labels):
+    """ラベルの組をPrometheusのテキスト形式に変換する"""
+    if not labels:
+        return ''
+    return '{' + ','.join(f'{name}="{escape_label(value)}"' for name, value in labels) + '}'
+
+
+def series_order(line):
+    """出力する行の並び順（le以外のラベル。ラベル値は数値と文字列が混在するため文字列として比べる）"""
+    return [(label, str(value)) for label, value in line[0] if label != 'le']
+
+
+class Metrics:
+    """ラベルの組ごとに集計するカウンタとヒストグラム（/metricsでPrometheusのテキスト形式として返す）"""
+
+    def __init__(self, prefix, buckets):
+        self.prefix = prefix
+        self.buckets = tuple(buckets)
+        self._lock = threading.Lock()
+        self._descriptions = {}
+        self._counters = {}
+        self._histograms = {}  # キー -> [区切りごとの件数（累積前）, 合計]
+
+    def describe(self, name, kind, description):
+        """系列の種類(counter/gauge/histogram)と説明を登録する"""
+        self._descriptions[name] = (kind, description)
+
+    def inc(self, name, amount=1, **labels):
+        key = (name, tuple(sorted(labels.items())))
+        with self._lock:
+            self._counters[key] = self._counters.get(key, 0) + amount
+
+    def observe(self, name, seconds, **labels):
+        key = (name, tuple(sorted(labels.items())))
+        index = bisect.bisect_left(self.buckets, seconds)
+        with self._lock:
+            histogram = self._histograms.get(key)
+            if histogram is None:
+                histogram = self._histograms[key] = [[0] * (len(self.buckets) + 1), 0.0]
+            histogram[0][index] += 1
+            histogram[1] += seconds
+
+    def render(self, samples=()):
+        """全系列をテキスト形式で返す。samplesは出力時に読み取る値の (名前, ラベルの辞書, 値) の並び"""
+        with self._lock:
+            counters = list(self._counters.items())
+            histograms = [(key, list(counts), total) for key, (counts, total) in self._histograms.items()]
+        families = {}
+        for (name, labels), value in counters:
+            families.setdefault(name, []).append((labels, '', value))
+        for name, labels, value in samples:
+            families.setdefault(name, []).append((tuple(sorted(labels.items())), '', value))
+        for (name, labels), counts, total in histograms:
+            lines = families.setdefault(name, [])
+            cumulative = 0
+            for bound, count in zip(self.buckets + (None,), counts):
+                cumulative += count
+                le = '+Inf' if bound is None else f'{bound:g}'
+                lines.append((labels + (('le', le),), '_bucket', cumulative))
+            lines.append((labels, '_sum', total))
+            lines.append((labels, '_count', cumulative))
+        output = []
+        for name in sorted(families):
+            full_name = f'{self.prefix}_{name}'
+            kind, description = self._descriptions.get(name, ('untyped', None))
+            if description:
+                output.append(f'# HELP {full_name} {description}')
+            output.append(f'# TYPE {full_name} {kind}')
+            # 同じラベルの組の_bucket/_sum/_countが並ぶよう、安定ソートでラベルごとにまとめる
+            for labels, suffix, value in sorted(families[name], key=series_order):
+                output.append(f'{full_name}{suffix}{format_labels(labels)} {value}')
+        return '\n'.join(output) + '\n'
+
+
+metrics = Metrics(METRICS_PREFIX, METRICS_BUCKETS)
+metrics.describe('http_request_duration_seconds', 'histogram', 'ルートごとのリクエスト処理時間（ストリーミングの送信完了まで）')
+metrics.describe('http_responses_total', 'counter', 'ルート・ステータスコードごとのレスポンス数')
+metrics.describe('upstream_duration_seconds', 'histogram',
+                 '上流取得の段階(queue/connect/ttfb/download/total)・ページ種別ごとの所要時間')
+metrics.describe('upstream_responses_total', 'counter', '上流のステータスコード（通信の失敗はerror）・ページ種別ごとの応答数')
+metrics.describe('parse_duration_seconds', 'histogram', '解析関数ごとの解析時間（解析プロセスとの受け渡しを含む）')
+metrics.describe('render_duration_seconds', 'histogram', 'テンプレートごとの描画時間（ストリーミング描画は送信待ちを除く）')
+metrics.describe('cache_events_total', 'counter', 'キャッシュ(response/page)ごとのヒット・ミス・追い出しなどの回数')
+metrics.describe('cache_entries', 'gauge', 'キャッシュごとのメモリ上のエントリ数')
+metrics.describe('cache_bytes', 'gauge', 'キャッシュごとのメモリ使用量（バイト）')
+metrics.describe('stale_events_total', 'counter',
+                 '期限切れの値を返した回数(served_stale/served_on_error)と、裏での取り直しの結果ごとの回数')
+metrics.describe('circuit_state', 'gauge', '上流の回路遮断器の状態（現在の状態が1）')
+metrics.describe('circuit_events_total', 'counter', '回路遮断器が数えた失敗・遮断の開始・取得を止めた回数')
+metrics.describe('search_events_total', 'counter',
+                 'カクヨムの検索の回数と、正規化で書き換えた・キャッシュにあった・なかった・最終ページより後として取得を省いた回数')
+
+# 取得中のページ種別（上流取得の計測のラベル）。キャッシュ層が設定する
+fetch_page_type = contextvars.ContextVar('fetch_page_type', default='other')
+
+# 設定されている間、新しく確立した上流への接続の所要時間（名前解決・TCP接続・TLS）を追記するリスト
+connect_timings = contextvars.ContextVar('connect_timings', default=None)
+
+
+def observe_upstream(page_type, phase, seconds):
+    """上流取得の段階ごとの所要時間を/metricsとServer-Timingに記録する"""
+    metrics.observe('upstream_duration_seconds', seconds, page_type=page_type, phase=phase)
+    record_upstream_timing(phase, seconds)
+
+def observe_parse(parse, seconds):
+    """解析関数の実行時間を/metricsとServer-Timingに記録する"""
+    metrics.observe('parse_duration_seconds', seconds, function=parse.__name__)
+    record_upstream_timing('parse', seconds)
+
+
+class TimedConnectionMixin:
+    """接続の確立にかかった時間をconnect_timingsに記録するurllib3の接続"""
+
+    def connect(self):
+        start = time.perf_counter()
+        try:
+            super().connect()
+        finally:
+            timings = connect_timings.get()
+            if timings is not None:
+                timings.append(time.perf_counter() - start)
+
+
+class TimedHTTPConnection(TimedConnectionMixin, HTTPConnection):
+    pass
+
+
+class TimedHTTPSConnection(TimedConnectionMixin, HTTPSConnection):
+    pass
+
+
+class TimedHTTPConnectionPool(HTTPConnectionPool):
+    ConnectionCls = TimedHTTPConnection
+
+
+class TimedHTTPSConnectionPool(HTTPSConnectionPool):
+    ConnectionCls = TimedHTTPSConnection
+
+
+class TimedHTTPAdapter(HTTPAdapter):
+    """接続の確立時間を計測する接続プールを使うHTTPAdapter"""
+
+    def init_poolmanager(self, *args, **kwargs):
+        super().init_poolmanager(*args, **kwargs)
+        self.poolmanager.pool_classes_by_scheme = {'http': TimedHTTPConnectionPool, 'https': TimedHTTPSConnectionPool}
+
+
+@app.before_request
+def start_request_timer():
+    g.request_started = time.perf_counter()
+
+@app.after_request
+def observe_request(response):
+    """ルートごとの処理時間とステータスコードを、レスポンスを送り終えた時点で記録する"""
+    started = g.get('request_started')
+    if started is not None:
+        route = request.endpoint or 'unmatched'
+        status = response.status_code
+
+        def observe():
+            metrics.observe('http_request_duration_seconds', time.perf_counter() - started, route=route)
+            metrics.inc('http_responses_total', route=route, status=status)
+        response.call_on_close(observe)
+    return response
+
+
+def start_render_timer(sender, template, context, **extra):
+    g.setdefault('render_started', []).append(time.perf_counter())
+
+def observe_render(sender, template, context, **extra):
+    started = g.get('render_started')
+    if started:
+        metrics.observe('render_duration_seconds', time.perf_counter() - started.pop(), template=template.name)
+
+# render_templateによる一括描画の時間（ストリーミング描画はrender_chunksで計測する）
+before_render_template.connect(start_render_timer, app)
+template_rendered.connect(observe_render, app)
+
+
+def cache_samples():
+    """/metricsの出力時に読み取るキャッシュの統計"""
+    samples = []
+    for name, stats in (('response', response_cache.stats()), ('page', page_cache.stats())):
+        for event, count in stats.items():
+            if event not in ('entries', 'bytes', 'max_bytes'):
+                samples.append(('cache_events_total', {'cache': name, 'event': event}, count))
+        samples.append(('cache_entries', {'cache': name}, stats['entries']))
+        samples.append(('cache_bytes', {'cache': name}, stats['bytes']))
+    for event, count in revalidator.stats().items():
+        if event != 'pending':
+            samples.append(('stale_events_total', {'event': event}, count))
+    return samples
+
+def search_samples():
+    """/metricsの出力時に読み取るカクヨムの検索結果のキャッシュの統計"""
+    return [('search_events_total', {'event': event}, count)
+            for event, count in search_result_sets.stats().items() if event not in ('entries', 'hit_rate')]
+
+def circuit_samples():
+    """/metricsの出力時に読み取る回路遮断器の状態"""
+    stats = upstream_breaker.stats()
+    samples = [('circuit_state', {'state': state}, int(stats['state'] == state)) for state in CircuitBreaker.STATES]
+    for event in ('failures', 'trips', 'short_circuits'):
+        samples.append(('circuit_events_total', {'event': event}, stats[event]))
+    return samples
+
+
+class RequestProfiler:
+    """?__profile=1 を付けたリクエストの処理をcProfileで計測し、結果をページの代わりに返すWSGIミドルウェア
+
+    ストリーミングされる本文も読み切るまで計測する。?__profile=raw ならpstatsで読めるダンプを返す。
+    計測するのはリクエストを処理するスレッドだけで、先読みや解析プロセスの処理は含まない。
+    """
+
+    def __init__(self, wsgi_app):
+        self.wsgi_app = wsgi_app
+
+    def __call__(self, environ, start_response):
+        mode = parse_qs(environ.get('QUERY_STRING', '')).get('__profile', [None])[0]
+        if not PROFILE_ENABLED or mode is None:
+            return self.wsgi_app(environ, start_response)
+
+        started = {}
+
+        def capture_response(status, headers, exc_info=None):
+            started['status'] = status
+            return lambda data: None
+
+        profiler = cProfile.Profile()
+        start = time.perf_counter()
+        profiler.enable()
+        try:
+            iterable = self.wsgi_app(environ, capture_response)
+            try:
+                size = sum(len(chunk) for chunk in iterable)
+            finally:
+                if hasattr(iterable, 'close'):
+                    iterable.close()
+        finally:
+            profiler.disable()
+        elapsed = time.perf_counter() - start
+
+        headers = [('X-Profiled-Status', started.get('status', '')), ('X-Profiled-Bytes', str(size)),
+                   ('X-Profiled-Seconds', f'{elapsed:.4f}')]
+        if mode == 'raw':
+            profiler.create_stats()
+            body = marshal.dumps(profiler.stats)
+            headers.append(('Content-Type', 'application/octet-stream'))
+        else:
+            output = io.StringIO()
+            pstats.Stats(profiler, stream=output).sort_stats('cumulative').print_stats(PROFILE_LIMIT)
+            body = output.getvalue().encode('utf-8')
+            headers.append(('Content-Type', 'text/plain; charset=utf-8'))
+        headers.append(('Content-Length', str(len(body))))
+        start_response('200 OK', headers)
+        return [body]
+
+
+app.wsgi_app = RequestProfiler(app.wsgi_app)
+
+# ==============================================================================
+# --- ヘルパー関数 ---
+# ==============================================================================
+
+def data_path(path):
+    """データファイルのパスを返す（相対パスはDATA_DIRからのパスとし、置き場所のディレクトリを作成する）"""
+    path = os.path.join(DATA_DIR, path)
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    return path
+
+def create_http_session():
+    """接続プールを設定した、全スレッド共有のHTTPセッションを生成する（再試行はfetch_pageで行う）"""
+    adapter = TimedHTTPAdapter(pool_connections=2, pool_maxsize=HTTP_POOL_SIZE)
+    session = requests.Session()
+    session.mount('https://', adapter)
+    session.mount('http://', adapter)
+    session.headers.update(HEADERS)
+    # urllib3が展開できる形式（brotliモジュールがあればbrも）だけを要求する
+    session.headers['Accept-Encoding'] = ACCEPT_ENCODING
+    return session
+
+
+http_session = create_http_session()
+
+
+class NotModified(Exception):
+    """条件付きGETに304が返されたことを示す"""
+
+
+# 条件付きGETの検証子をキャッシュ層とget_page_contentの間で受け渡す
+# {'request': 送信する検証子, 'response': 受信した検証子, 'upstream_failed': 上流の障害で取得できなかったか}
+conditional_exchange = contextvars.ContextVar('conditional_exchange', default=None)
+
+
+def conditional_headers(exchange):
+    """保存済みの検証子から条件付きGETのヘッダーを組み立てる"""
+    headers = {}
+    if exchange and exchange['request']:
+        if exchange['request'].get('etag'):
+            headers['If-None-Match'] = exchange['request']['etag']
+        if exchange['request'].get('last_modified'):
+            headers['If-Modified-Since'] = exchange['request']['last_modified']
+    return headers
+
+def mark_upstream_failure(exchange):
+    """取得できなかった原因が上流の障害（回路遮断・通信エラー・429/5xx）であることをキャッシュ層に伝える"""
+    if exchange is not None:
+        exchange['upstream_failed'] = True
+
+def store_validators(exchange, response_headers):
+    """レスポンスのETag/Last-Modifiedをキャッシュ層に渡す"""
+    if exchange is not None:
+        validators = {
+            'etag': response_headers.get('ETag'),
+            'last_modified': response_headers.get('Last-Modified'),
+        }
+        exchange['response'] = validators if any(validators.values()) else None
+
+class RetryableFetchError(Exception):
+    """再試行してよい上流の失敗（429/5xxの応答・通信エラー）"""
+
+    def __init__(self, message, retry_after=None):
+        super().__init__(message)
+        self.retry_after = retry_after  # 応答のRetry-Afterヘッダーの値
+
+
+def retry_delay(retry_after, attempt):
+    """次の試行までの秒数を返す（Retry-Afterがあればそれに従う）。HTTP_RETRY_AFTER_MAXより長ければNone"""
+    if retry_after:
+        try:
+            delay = float(retry_after)
+        except ValueError:
+            try:
+                delay = email.utils.parsedate_to_datetime(retry_after).timestamp() - time.time()
+            except (TypeError, ValueError):
+                delay = None
+        if delay is not None:
+            return max(delay, 0.0) if delay <= HTTP_RETRY_AFTER_MAX else None
+    return HTTP_RETRY_BACKOFF * 2 ** attempt
+
+def fetch_page(url, params=None):
+    """指定されたURLのHTMLをバイト列で取得する
+
+    429/5xxの応答と通信エラーはHTTP_MAX_RETRIES回まで再試行する。再試行のたびにレート制限の送信枠を取り、
+    回路遮断器に結果を報告する（障害中の上流に設定以上の頻度で送らない）。
+    """
+    reservation = rate_limit_reserved.get()
+    for attempt in range(HTTP_MAX_RETRIES + 1):
+        reserved = reservation is not None and not reservation['used']
+        if reserved:
+            reservation['used'] = True
+        try:
+            return fetch_page_once(url, params, reserved=reserved)
+        except RetryableFetchError as e:
+            delay = retry_delay(e.retry_after, attempt)
+            if attempt == HTTP_MAX_RETRIES or delay is None:
+                print(f"Error fetching {url}: {e}")
+                return None
+        time.sleep(delay)
+
+def fetch_page_once(url, params=None, reserved=False):
+    """上流に1回だけ取得を送る。再試行してよい失敗はRetryableFetchErrorとなる"""
+    exchange = conditional_exchange.get()
+    headers = conditional_headers(exchange)
+    page_type = fetch_page_type.get()
+    connects = []
+    token = connect_timings.set(connects)
+    allowed = reported = False
+    try:
+        # サーバー負荷軽減のため、全スレッド共通のレート制限で送信間隔を調整
+        if not reserved:
+            observe_upstream(page_type, 'queue', rate_limiter.acquire(background=background_fetch.get()))
+        # 試しの取得の枠は送信の直前に取る（レート制限の待ち中に取りやめても枠が残らないように）
+        allowed = upstream_breaker.allow()
+        if not allowed:
+            # 上流の障害が続いているため、タイムアウトを待たずに失敗とする（キャッシュ層が前回の結果を返す）
+            metrics.inc('upstream_responses_total', page_type=page_type, status='short_circuit')
+            mark_upstream_failure(exchange)
+            print(f"Error fetching {url}: upstream circuit is open")
+            return None
+        start = time.perf_counter()
+        # 応答ヘッダーまで(TTFB)と本文の受信を分けて計測するため、本文は後から読む
+        with http_session.get(url, headers=headers, params=params, timeout=HTTP_TIMEOUT, stream=True) as response:
+            headers_at = time.perf_counter()
+            metrics.inc('upstream_responses_total', page_type=page_type, status=response.status_code)
+            if upstream_failed(response.status_code):
+                upstream_breaker.record_failure()
+                mark_upstream_failure(exchange)
+            else:
+                upstream_breaker.record_success()
+            reported = True
+            if connects:
+                observe_upstream(page_type, 'connect', sum(connects))
+            observe_upstream(page_type, 'ttfb', headers_at - start - sum(connects))
+            if response.status_code == 304 and headers:
+                # 本文のダウンロードと解析を省略し、キャッシュ済みの結果を使う
+                raise NotModified(url)
+            if response.status_code in HTTP_RETRY_STATUSES:
+                raise RetryableFetchError(f"HTTP {response.status_code} for url: {response.url}",
+                                          response.headers.get('Retry-After'))
+            response.raise_for_status()
+            content = response.content
+        observe_upstream(page_type, 'download', time.perf_counter() - headers_at)
+        observe_upstream(page_type, 'total', time.perf_counter() - start)
+        store_validators(exchange, response.headers)
+        record_transfer(content)
+        return content
+    except requests.exceptions.RequestException as e:
+        if e.response is None:
+            metrics.inc('upstream_responses_total', page_type=page_type, status='error')
+            upstream_breaker.record_failure()
+            mark_upstream_failure(exchange)
+            reported = True
+            raise RetryableFetchError(str(e)) from e
+        print(f"Error fetching {url}: {e}")
+        return None
+    finally:
+        if allowed and not reported:
+            upstream_breaker.release_trial(allowed)
+        connect_timings.reset(token)
+
+def get_page_content(url, params=None):
+    """指定されたURLのHTMLコンテンツを取得する"""
+    content = fetch_page(url, params)
+    if content is None:
+        return None
+    return make_soup(content)
+
+def json_loads(data):
+    """JSONを解析する（orjsonがあれば使用）"""
+    if orjson is not None:
+        return orjson.loads(data)
+    return json.loads(data)
+
+def extract_next_data(content):
+    """HTMLのバイト列から__NEXT_DATA__のJSONを、DOMを構築せずに切り出して解析する"""
+    marker = content.find(b'id="__NEXT_DATA__"')
+    # マーカーが<script>タグの属性内にあることを確認する
+    if marker < 0 or content.rfind(b'<script', 0, marker) < content.rfind(b'>', 0, marker):
+        return None
+    start = content.find(b'>', marker) + 1
+    end = content.find(b'</script>', start)
+    if start == 0 or end < 0:
+        return None
+    try:
+        return json_loads(content[start:end])
+    except ValueError:
+        return None
+
+def extract_next_data_from_soup(content):
+    """BeautifulSoupで__NEXT_DATA__を探して解析する（高速経路が失敗した場合の代替）"""
+    soup = make_soup(content)
+    script_tag = soup.find('script', id='__NEXT_DATA__')
+    if not script_tag:
+        return None
+    try:
+        return json.loads(script_tag.string)
+    except json.JSONDecodeError as e:
+        print(f"Error parsing JSON data: {e}")
+        return None
+
+def get_work_id_from_url(url):
+    """URLから作品IDを抽出する"""
+    if not url: return None
+    match = re.search(r'/works/(\d+)', url)
+    return match.group(1) if match else None
+
+def get_episode_id_from_url(url):
+    """URLからエピソードIDを抽出する"""
+    if not url: return None
+    match = re.search(r'/episodes/(\d+)', url)
+    return match.group(1) if match else None
+
+def render_chunks(template_name, context):
+    """テンプレートを描画しながら、STREAM_CHUNK_CHARS文字程度ずつ返すジェネレータ"""
+    template = app.jinja_env.get_template(template_name)
+    app.update_template_context(context)
+    chunk = []
+    size = 0
+    # 送信を待つ間（yield中）を除いた描画時間
+    elapsed = 0.0
+    start = time.perf_counter()
+    for fragment in template.generate(context):
+        chunk.append(fragment)
+        size += len(fragment)
+        if size >= STREAM_CHUNK_CHARS:
+            elapsed += time.perf_counter() - start
+            yield ''.join(chunk)
+            start = time.perf_counter()
+            chunk = []
+            size = 0
+    metrics.observe('render_duration_seconds', elapsed + time.perf_counter() - start, template=template_name)
+    if chunk:
+        yield ''.join(chunk)
+
+def stream_page(template_name, **context):
+    """テンプレートを描画しながら少しずつ送信するレスポンスを返す（ページ全体を組み立てるのを待たずに先頭から送られる）"""
+    return Response(stream_with_context(render_chunks(template_name, context)), mimetype='text/html')
+
+# ==============================================================================
+# --- レスポンスキャッシュ ---
+# ==============================================================================
+
+class CompressedValue:
+    """圧縮して保持するキャッシュの値（pickleをzlibで圧縮したもの）"""
+    __slots__ = ('blob',)
+
+    def __init__(self, blob):
+        self.blob = blob
+
+
+class ResponseCache:
+    """スクレイピング結果を保持する二層キャッシュ（メモリLRU + 任意のSQLiteディスク層）"""
+
+    def __init__(self, max_bytes, disk_path=None):
+        self.max_bytes = max_bytes
+        self.disk_path = disk_path
+        self._entries = OrderedDict()  # key -> (expires_at, size, value, validators, version)
+        self._bytes = 0
+        self._lock = threading.Lock()
+        self._db = None
+        self._db_lock = threading.Lock()
+        self.counters = {'hits': 0, 'disk_hits': 0, 'misses': 0, 'evictions': 0, 'expirations': 0, 'revalidations': 0}
+        if disk_path:
+            self.reopen()
+            self._db.execute(
+                "CREATE TABLE IF NOT EXISTS cache ("
+                "key TEXT PRIMARY KEY, expires_at REAL NOT NULL, value BLOB NOT NULL, validators TEXT)"
+            )
+            self._db.execute("DELETE FROM cache WHERE expires_at < ?", (time.time() - CACHE_STALE_KEEP,))
+            self._db.commit()
+
+    def reopen(self):
+        """ディスク層の接続を開く（フォーク後のワーカーでは、親プロセスの接続を使わずに開き直す）"""
+        self._db = sqlite3.connect(self.disk_path, check_same_thread=False)
+        # 複数のワーカープロセスが読み書きしても、読み込みが書き込みを待たないようにする
+        self._db.execute("PRAGMA journal_mode=WAL")
+        self._db.execute("PRAGMA synchronous=NORMAL")
+
+    def close(self):
+        """ディスク層の接続を閉じる（メモリ層は残す。reopenで再び開ける）"""
+        if self._db is not None:
+            with self._db_lock:
+                self._db.close()
+                self._db = None
+
+    def get(self, key):
+        """有効期限内の値を返す。存在しない場合はNone"""
+        now = time.time()
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry:
+                if entry[0] > now:
+                    self._entries.move_to_end(key)
+                    self.counters['hits'] += 1
+                    return self._unpack(entry[2])
+                # 期限切れのエントリは再検証用に残しておく
+                self.counters['expirations'] += 1
+                if self._db is None:
+                    self.counters['misses'] += 1
+                    return None
+                # ディスク層を共有する他のワーカーが取り直していれば、そちらを使う
+
+        row = self._disk_get(key)
+        value = self._loads(row[1]) if row and row[0] > now else None
+        if value is not None:
+            with self._lock:
+                self._store(key, row[0], row[1], self._memory_value(key, value, row[1]),
+                            json.loads(row[2]) if row[2] else None)
+                self.counters['disk_hits'] += 1
+            return value
+
+        with self._lock:
+            self.counters['misses'] += 1
+        return None
+
+    def get_stale(self, key):
+        """期限切れを含めて (値, 検証子, 有効期限) を返す。存在しない場合はNone"""
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry:
+                return self._unpack(entry[2]), entry[3], entry[0]
+        row = self._disk_get(key)
+        value = self._loads(row[1]) if row else None
+        if value is not None:
+            return value, json.loads(row[2]) if row[2] else None, row[0]
+        return None
+
+    def set(self, key, value, ttl, validators=None):
+        """値を両方の層に保存する。validatorsは条件付きGET用のETag/Last-Modified"""
+        blob = pickle.dumps(value, protocol=pickle.HIGHEST_PROTOCOL)
+        if self._compressed(key):
+            blob = zlib.compress(blob, CACHE_COMPRESS_LEVEL)
+        expires_at = time.time() + ttl
+        with self._lock:
+            self._store(key, expires_at, blob, self._memory_value(key, value, blob), validators)
+        if self._db is not None:
+            with self._db_lock:
+                self._db.execute(
+                    "INSERT OR REPLACE INTO cache (key, expires_at, value, validators) VALUES (?, ?, ?, ?)",
+                    (key, expires_at, blob, json.dumps(validators) if validators else None)
+                )
+                self._db.commit()
+
+    def refresh(self, key, value, ttl, validators):
+        """304で再検証できたエントリの有効期限を延長する"""
+        with self._lock:
+            self.counters['revalidations'] += 1
+        self.set(key, value, ttl, validators)
+
+    def expire(self, key):
+        """エントリを期限切れにする（値と検証子は残し、次の取得では条件付きGETで再検証する）"""
+        now = time.time()
+        # 期限切れ直後の値をすぐ返す(stale-while-revalidate)対象にせず、次の取得で必ず上流に問い合わせる
+        expires_at = now - CACHE_STALE_WHILE_REVALIDATE
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry and entry[0] > expires_at:
+                self._entries[key] = (expires_at, *entry[1:])
+        if self._db is not None:
+            with self._db_lock:
+                self._db.execute("UPDATE cache SET expires_at = ? WHERE key = ? AND expires_at > ?",
+                                 (expires_at, key, expires_at))
+                self._db.commit()
+
+    def preload(self, prefixes, max_bytes):
+        """キーが各接頭辞で始まるディスク層の値を、期限切れを含めて合計max_bytesまでメモリ層に読み込む。読み込んだ件数を返す"""
+        if self._db is None:
+            return 0
+        loaded = used = 0
+        for prefix in prefixes:
+            with self._db_lock:
+                rows = self._db.execute(
+                    "SELECT key, expires_at, value, validators FROM cache WHERE key >= ? AND key < ? ORDER BY key",
+                    (prefix, prefix + '\U0010ffff')
+                ).fetchall()
+            for key, expires_at, blob, validators in rows:
+                if used + len(blob) > max_bytes:
+                    return loaded
+                value = self._loads(blob)
+                if value is None:
+                    continue
+                with self._lock:
+                    self._store(key, expires_at, blob, self._memory_value(key, value, blob),
+                                json.loads(validators) if validators else None)
+                used += len(blob)
+                loaded += 1
+        return loaded
+
+    def version(self, key):
+        """メモリ層にある値の版（保存した内容のハッシュ）を、統計を変えずに返す。ない場合はNone"""
+        with self._lock:
+            entry = self._entries.get(key)
+            return entry[4] if entry else None
+
+    def contains(self, key):
+        """有効期限内の値があるかを、統計を変えずに確認する"""
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry:
+                return entry[0] > time.time()
+        row = self._disk_get(key)
+        return bool(row and row[0] > time.time())
+
+    def stats(self):
+        """ヒット/ミス/追い出しのカウンタと使用量を返す"""
+        with self._lock:
+            return dict(self.counters, entries=len(self._entries), bytes=self._bytes, max_bytes=self.max_bytes)
+
+    @staticmethod
+    def _compressed(key):
+        return key.split(':', 1)[0] in CACHE_COMPRESS_TYPES
+
+    def _memory_value(self, key, value, blob):
+        # 圧縮対象のページ種別は、メモリ上も圧縮したまま保持する
+        return CompressedValue(blob) if self._compressed(key) else value
+
+    @staticmethod
+    def _unpack(stored):
+        return pickle.loads(zlib.decompress(stored.blob)) if isinstance(stored, CompressedValue) else stored
+
+    @staticmethod
+    def _loads(blob):
+        """ディスク層の値を復元する。復元できない値（別の起動方法で保存したクラスなど）はNone"""
+        try:
+            # pickleは常に b'\x80' で始まるため、それ以外はzlibで圧縮した値
+            return pickle.loads(blob if blob[:1] == b'\x80' else zlib.decompress(blob))
+        except Exception as e:
+            print(f"Error loading cached value: {e}")
+            return None
+
+    def _disk_get(self, key):
+        if self._db is None:
+            return None
+        with self._db_lock:
+            return self._db.execute(
+                "SELECT expires_at, value, validators FROM cache WHERE key = ?", (key,)
+            ).fetchone()
+
+    def _store(self, key, expires_at, blob, value, validators):
+        # ロック取得済みの状態で呼ぶこと
+        self._discard(key)
+        size = len(blob)
+        if size > self.max_bytes:
+            return
+        version = hashlib.blake2b(blob, digest_size=16).digest()
+        self._entries[key] = (expires_at, size, value, validators, version)
+        self._bytes += size
+        while self._bytes > self.max_bytes:
+            _, evicted = self._entries.popitem(last=False)
+            self._bytes -= evicted[1]
+            self.counters['evictions'] += 1
+
+    def _discard(self, key):
+        entry = self._entries.pop(key, None)
+        if entry:
+            self._bytes -= entry[1]
+
+
+response_cache = ResponseCache(CACHE_MAX_BYTES, CACHE_DISK_PATH)
+
+
+class Revalidator:
+    """期限切れのまま返した結果を、バックグラウンドで上流から取り直す（stale-while-revalidate）"""
+
+    def __init__(self, workers):
+        self.workers = workers
+        self._queue = queue.Queue(maxsize=256)
+        self._lock = threading.Lock()
+        self._threads = []
+        self._pending = set()  # 取り直しを予約済みのキャッシュキー
+        self.counters = {'served_stale': 0, 'served_on_error': 0, 'scheduled': 0,
+                         'refreshed': 0, 'failed': 0, 'dropped': 0}
+
+    def schedule(self, key, scrape, args):
+        """期限切れの値を返したキーの取り直しを予約する（予約済みなら何もしない）"""
+        with self._lock:
+            self.counters['served_stale'] += 1
+            if key in self._pending:
+                return
+            self._pending.add(key)
+            self._start_workers()
+            self.counters['scheduled'] += 1
+        try:
+            self._queue.put_nowait((key, scrape, args))
+        except queue.Full:
+            with self._lock:
+                self._pending.discard(key)
+                self.counters['dropped'] += 1
+
+    def served_on_error(self):
+        """取得に失敗して期限切れの値を返したことを記録する"""
+        with self._lock:
+            self.counters['served_on_error'] += 1
+
+    def stats(self):
+        """期限切れの値を返した回数と、取り直しの結果"""
+        with self._lock:
+            return dict(self.counters, pending=len(self._pending))
+
+    def _start_workers(self):
+        # ロック取得済みの状態で呼ぶこと。スレッドは最初の予約時に起動する
+        while len(self._threads) < self.workers:
+            thread = threading.Thread(target=self._run, name='revalidate', daemon=True)
+            thread.start()
+            self._threads.append(thread)
+
+    def _run(self):
+        # バックグラウンドの取得は期限切れの値を返さず、上流からの結果を待つ
+        background_fetch.set(True)
+        while True:
+            key, scrape, args = self._queue.get()
+            result = None
+            try:
+                with app.test_request_context():
+                    result = scrape(*args)
+            except Exception as e:
+                print(f"Error revalidating {key}: {e}")
+            finally:
+                with self._lock:
+                    self._pending.discard(key)
+                    self.counters['refreshed' if result is not None else 'failed'] += 1
+
+
+revalidator = Revalidator(REVALIDATE_WORKERS)
+
+def serve_stale(stale):
+    """期限切れ後CACHE_STALE_WHILE_REVALIDATE秒以内の値なら、取り直しを待たずに返してよい（ユーザーのリクエストのみ）"""
+    return (stale is not None and not background_fetch.get()
+            and time.time() - stale[2] < CACHE_STALE_WHILE_REVALIDATE)
+
+def serve_on_error(key, stale):
+    """上流の障害時（回路遮断中を含む。404などページ自体の問題は除く）に、エラーページの代わりに前回の結果を返す
+
+    前回の結果はCIRCUIT_COOLDOWN秒だけ有効として扱い、障害中の上流に同じページの取得を重ねない。
+    """
+    revalidator.served_on_error()
+    response_cache.set(key, stale[0], CIRCUIT_COOLDOWN, stale[1])
+    return stale[0]
+
+def cached(page_type):
+    """スクレイピング関数の結果をページ種別ごとのTTLでキャッシュするデコレータ"""
+    def decorator(func):
+        signature = inspect.signature(func)
+
+        def arguments(*args, **kwargs):
+            bound = signature.bind(*args, **kwargs)
+            bound.apply_defaults()
+            return tuple(bound.arguments.values())
+
+        def cache_key(*args, **kwargs):
+            return f"{page_type}:" + json.dumps(list(arguments(*args, **kwargs)), ensure_ascii=False)
+
+        @functools.wraps(func)
+        def wrapper(*args, **kwargs):
+            key = cache_key(*args, **kwargs)
+            value = response_cache.get(key)
+            if value is not None:
+                if not background_fetch.get():
+                    prefetcher.claim(key)
+                return value
+
+            def fill():
+                # 期限切れのエントリがあれば、その検証子で条件付きGETを行う
+                stale = response_cache.get_stale(key)
+                exchange = {'request': stale[1] if stale else None, 'response': None, 'upstream_failed': False}
+                token = conditional_exchange.set(exchange)
+                type_token = fetch_page_type.set(page_type)
+                try:
+                    result = func(*args, **kwargs)
+                except NotModified:
+                    response_cache.refresh(key, stale[0], CACHE_TTL[page_type], stale[1])
+                    return stale[0]
+                finally:
+                    fetch_page_type.reset(type_token)
+                    conditional_exchange.reset(token)
+                # 取得失敗(None)はキャッシュしない
+                if result is not None:
+                    response_cache.set(key, result, CACHE_TTL[page_type], exchange['response'])
+                    index_scraped(page_type, arguments(*args, **kwargs), result)
+                elif stale and exchange['upstream_failed'] and not background_fetch.get():
+                    return serve_on_error(key, stale)
+                return result
+
+            stale = response_cache.get_stale(key)
+            if serve_stale(stale):
+                revalidator.schedule(key, wrapper, arguments(*args, **kwargs))
+                return stale[0]
+            # 同じページへの同時リクエストは1回の取得にまとめる（他のワーカーが取得済みならその結果を使う）
+            return in_flight.do(key, fill, lambda: response_cache.get(key))
+
+        wrapper.cache_key = cache_key
+        wrapper.page_type = page_type
+        return wrapper
+    return decorator
+
+# ==============================================================================
+# --- 描画済みページのキャッシュ ---
+# ==============================================================================
+
+class PageCache:
+    """描画済みページを、描画に使った内容のハッシュをキーに保持するLRUキャッシュ（無圧縮・gzip・brotli版を併せて保存）"""
+
+    def __init__(self, max_bytes):
+        self.max_bytes = max_bytes
+        self._entries = OrderedDict()  # key -> {'identity': bytes, 'gzip': bytes, 'br': bytes}
+        self._bytes = 0
+        self._lock = threading.Lock()
+        self.counters = {'hits': 0, 'misses': 0, 'not_modified': 0, 'evictions': 0}
+
+    def get(self, key):
+        """保存済みの各エンコーディングの本文を返す。存在しない場合はNone"""
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is None:
+                self.counters['misses'] += 1
+                return None
+            self._entries.move_to_end(key)
+            self.counters['hits'] += 1
+            return entry
+
+    def set(self, key, body):
+        """描画済みの本文を圧縮版とともに保存する（圧縮はロックの外で行う）"""
+        entry = {'identity': body, 'gzip': gzip.compress(body, compresslevel=PAGE_GZIP_LEVEL, mtime=0)}
+        if brotli is not None:
+            entry['br'] = brotli.compress(body, quality=PAGE_BROTLI_QUALITY)
+        size = sum(len(variant) for variant in entry.values())
+        if size > self.max_bytes:
+            return
+        with self._lock:
+            old = self._entries.pop(key, None)
+            if old:
+                self._bytes -= sum(len(variant) for variant in old.values())
+            self._entries[key] = entry
+            self._bytes += size
+            while self._bytes > self.max_bytes:
+                _, evicted = self._entries.popitem(last=False)
+                self._bytes -= sum(len(variant) for variant in evicted.values())
+                self.counters['evictions'] += 1
+
+    def count_not_modified(self):
+        with self._lock:
+            self.counters['not_modified'] += 1
+
+    def stats(self):
+        """ヒット/ミス/304応答/追い出しのカウンタと使用量を返す"""
+        with self._lock:
+            return dict(self.counters, entries=len(self._entries), bytes=self._bytes, max_bytes=self.max_bytes)
+
+
+page_cache = PageCache(PAGE_CACHE_MAX_BYTES)
+
+
+def page_digest(template_name, source, context):
+    """テンプレートと描画内容のハッシュを返す（同じ値なら描画結果も同じなので、キャッシュキーと強いETagに使う）
+
+    sourceは(描画元のスクレイピング結果のキャッシュキー, 取得前に読んだ版, 表示の指定)。
+    取得前になかった値は取得して保存した版を、あった値は取得後も同じ版であれば、描画内容を直列化せずに使う。
+    """
+    source_key, version, variant = source
+    current = response_cache.version(source_key)
+    digest = hashlib.blake2b(digest_size=16)
+    digest.update(TEMPLATES[template_name].encode('utf-8'))
+    digest.update(request.script_root.encode('utf-8'))
+    if current is not None and version in (None, current):
+        digest.update(source_key.encode('utf-8'))
+        digest.update(current)
+        digest.update(repr(variant).encode('utf-8'))
+    else:
+        # キャッシュになかった値や、描画中に取り直された値は、描画内容そのものから求める
+        digest.update(pickle.dumps(context, protocol=pickle.HIGHEST_PROTOCOL))
+    return digest.hexdigest()
+
+def page_cache_response(key, mimetype, headers):
+    """If-None-Matchが一致すれば304を、キャッシュにあれば事前に圧縮した版を返す。どちらでもなければNone"""
+    # 同じ内容であればエンコーディングの違う版のETagでも、手元の表現は有効
+    for etag in (key, f'{key}-gzip', f'{key}-br'):
+        if etag in request.if_none_match:
+            page_cache.count_not_modified()
+            return Response(status=304, headers=dict(headers, ETag=f'"{etag}"'))
+
+    entry = page_cache.get(key)
+    if entry is None:
+        return None
+    encoding = request.accept_encodings.best_match([name for name in ('br', 'gzip') if name in entry])
+    response = Response(entry[encoding or 'identity'], mimetype=mimetype, headers=headers)
+    if encoding:
+        response.headers['Content-Encoding'] = encoding
+    response.headers['ETag'] = f'"{key}-{encoding}"' if encoding else f'"{key}"'
+    return response
+
+def cached_page(page_type, template_name, source, **context):
+    """描画済みページのキャッシュを使ってページを返す
+
+    If-None-Matchが一致すれば304を返し、キャッシュにあれば事前に圧縮した版をそのまま送る。
+    キャッシュにない場合は従来どおりストリーミング描画し、送り終えた本文を保存する。
+    """
+    key = page_digest(template_name, source, context)
+    headers = {'Cache-Control': PAGE_CACHE_CONTROL[page_type], 'Vary': 'Accept-Encoding'}
+    response = page_cache_response(key, 'text/html', headers)
+    if response is not None:
+        return response
+
+    def generate():
+        chunks = []
+        for chunk in render_chunks(template_name, context):
+            chunks.append(chunk)
+            yield chunk
+        # 途中で切断された場合はここに到達しないため、不完全なページは保存されない
+        page_cache.set(key, ''.join(chunks).encode('utf-8'))
+
+    return Response(stream_with_context(generate()), mimetype='text/html', headers=dict(headers, ETag=f'"{key}"'))
+
+# ==============================================================================
+# --- 解析結果の省メモリな表現 ---
+# ==============================================================================
+# 大量の目次・本文をキャッシュに保持しても、項目ごとの辞書や段落ごとの文字列の
+# オーバーヘッドが膨らまないよう、列ごとにまとめて保持する。テンプレートからは属性、
+# 既存の処理からは辞書と同じ添字で、従来と同じ値を参照できる。
+
+PUBLISHED_AT_FORMAT = '%Y-%m-%dT%H:%M:%SZ'
+PUBLISHED_AT_PATTERN = re.compile(r'\d{4}-\d\d-\d\dT\d\d:\d\d:\d\dZ')
+NO_TIME = -1 << 63  # 公開日時のないエピソード・章を表す値
+RUBY_SEGMENT_SEPARATOR = '\x1e'  # 段落内の文字列・ルビの区切り
+RUBY_READING_SEPARATOR = '\x1f'  # 親文字とルビの区切り
+LINE_BREAK_SEGMENT = '\n'  # 段落の並びの中で、段落内の改行(<br>)を表す要素（文字列の要素は前後の空白を除くため区別できる）
+
+
+def pack_episode_ids(ids):
+    """エピソードIDの列を、すべて64ビットに収まる数字ならarrayに、そうでなければ文字列のタプルにする（Noneは0）"""
+    try:
+        packed = array('Q', (int(episode_id) if episode_id is not None else 0 for episode_id in ids))
+    except (ValueError, OverflowError):
+        packed = None
+    if packed is not None and all(
+            (str(value) == episode_id) if episode_id is not None else not value
+            for value, episode_id in zip(packed, ids)):
+        return packed
+    return tuple(sys.intern(episode_id) if episode_id is not None else None for episode_id in ids)
+
+def pack_published_at(values):
+    """公開日時の列を、すべて標準の書式ならUNIX時刻のarrayに、そうでなければ文字列のタプルにする"""
+    packed = array('q')
+    for value in values:
+        if value is None:
+            packed.append(NO_TIME)
+        elif PUBLISHED_AT_PATTERN.fullmatch(value):
+            timestamp = calendar.timegm(time.strptime(value, PUBLISHED_AT_FORMAT))
+            if time.strftime(PUBLISHED_AT_FORMAT, time.gmtime(timestamp)) != value:
+                return tuple(values)
+            packed.append(timestamp)
+        else:
+            return tuple(values)
+    return packed
+
+
+class TocEntry:
+    """目次の1項目（章またはエピソード）"""
+    __slots__ = ('is_chapter', 'title', 'episode_id', 'published_at')
+
+    def __init__(self, is_chapter, title, episode_id=None, published_at=None):
+        self.is_chapter = is_chapter
+        self.title = title
+        self.episode_id = episode_id
+        self.published_at = published_at
+
+    def __getitem__(self, name):
+        try:
+            return getattr(self, name)
+        except AttributeError:
+            raise KeyError(name) from None
+
+    def get(self, name, default=None):
+        return getattr(self, name, default)
+
+    def __eq__(self, other):
+        return isinstance(other, TocEntry) and all(getattr(self, name) == getattr(other, name) for name in self.__slots__)
+
+    def __repr__(self):
+        return f"TocEntry({', '.join(f'{name}={getattr(self, name)!r}' for name in self.__slots__)})"
+
+
+class EpisodeList(Sequence):
+    """目次の項目の並び。章かどうか・タイトル・エピソードID・公開日時を列ごとに保持し、取り出すときにTocEntryを作る"""
+    __slots__ = ('_chapters', '_titles', '_ids', '_published')
+
+    def __init__(self, entries=()):
+        entries = list(entries)
+        self._chapters = bytes(bool(entry['is_chapter']) for entry in entries)
+        self._titles = tuple(entry['title'] for entry in entries)
+        self._ids = pack_episode_ids([entry.get('episode_id') for entry in entries])
+        self._published = pack_published_at([entry.get('published_at') for entry in entries])
+
+    @classmethod
+    def _restore(cls, chapters, titles, ids, published):
+        episodes = cls.__new__(cls)
+        episodes._chapters, episodes._titles, episodes._ids, episodes._published = chapters, titles, ids, published
+        return episodes
+
+    def __reduce__(self):
+        return EpisodeList._restore, (self._chapters, self._titles, self._ids, self._published)
+
+    def __len__(self):
+        return len(self._chapters)
+
+    def __getitem__(self, index):
+        if isinstance(index, slice):
+            return EpisodeList(self[i] for i in range(*index.indices(len(self))))
+        episode_id = self._ids[index]
+        published_at = self._published[index]
+        if isinstance(self._ids, array):
+            episode_id = str(episode_id) if episode_id else None
+        if isinstance(self._published, array):
+            published_at = time.strftime(PUBLISHED_AT_FORMAT, time.gmtime(published_at)) if published_at != NO_TIME else None
+        return TocEntry(bool(self._chapters[index]), self._titles[index], episode_id, published_at)
+
+
+class BodyLines(Sequence):
+    """本文の段落の並び。全段落を連結した1つの文字列と、各段落の終了位置として保持する"""
+    __slots__ = ('_text', '_ends')
+
+    def __init__(self, lines=()):
+        self._text = ''.join(lines)
+        self._ends = array('I')
+        position = 0
+        for line in lines:
+            position += len(line)
+            self._ends.append(position)
+
+    @classmethod
+    def _restore(cls, text, ends):
+        lines = cls.__new__(cls)
+        lines._text, lines._ends = text, ends
+        return lines
+
+    def __reduce__(self):
+        return BodyLines._restore, (self._text, self._ends)
+
+    def __len__(self):
+        return len(self._ends)
+
+    def __getitem__(self, index):
+        if isinstance(index, slice):
+            return [self[i] for i in range(*index.indices(len(self)))]
+        if index < 0:
+            index += len(self._ends)
+        end = self._ends[index]
+        return self._text[self._ends[index - 1] if index else 0:end]
+
+
+class RubyLines(Sequence):
+    """段落ごとの文字列と(親文字, ルビ)の並び（ルビのない段落はNone）
+
+    ルビを含む段落だけを、区切り文字で連結した1つの文字列として段落番号とともに保持する。
+    区切り文字を含む段落は、そのままの並びで保持する。
+    """
+    __slots__ = ('_length', '_indexes', '_lines')
+
+    def __init__(self, lines=()):
+        lines = list(lines)
+        self._length = len(lines)
+        self._indexes = array('I')
+        stored = []
+        for index, segments in enumerate(lines):
+            if segments is None:
+                continue
+            self._indexes.append(index)
+            stored.append(self._encode(segments))
+        self._lines = tuple(stored)
+
+    @staticmethod
+    def _encode(segments):
+        texts = [text for segment in segments for text in ((segment,) if isinstance(segment, str) else segment)]
+        if any(RUBY_SEGMENT_SEPARATOR in text or RUBY_READING_SEPARATOR in text for text in texts):
+            return list(segments)
+        return RUBY_SEGMENT_SEPARATOR.join(
+            segment if isinstance(segment, str) else RUBY_READING_SEPARATOR.join(segment) for segment in segments)
+
+    @staticmethod
+    def _decode(encoded):
+        if not isinstance(encoded, str):
+            return encoded
+        return [tuple(part.split(RUBY_READING_SEPARATOR)) if RUBY_READING_SEPARATOR in part else part
+                for part in encoded.split(RUBY_SEGMENT_SEPARATOR)]
+
+    @classmethod
+    def _restore(cls, length, indexes, lines):
+        ruby_lines = cls.__new__(cls)
+        ruby_lines._length, ruby_lines._indexes, ruby_lines._lines = length, indexes, lines
+        return ruby_lines
+
+    def __reduce__(self):
+        return RubyLines._restore, (self._length, self._indexes, self._lines)
+
+    def __len__(self):
+        return self._length
+
+    def __getitem__(self, index):
+        if isinstance(index, slice):
+            return [self[i] for i in range(*index.indices(len(self)))]
+        if index < 0:
+            index += self._length
+        if not 0 <= index < self._length:
+            raise IndexError(index)
+        position = bisect.bisect_left(self._indexes, index)
+        if position < len(self._indexes) and self._indexes[position] == index:
+            return self._decode(self._lines[position])
+        return None
+
+
+def compact_json(value):
+    """json.dumpのdefaultに指定し、列ごとに保持した目次・本文を通常のリスト・辞書として書き出す"""
+    if isinstance(value, TocEntry):
+        return {name: getattr(value, name) for name in TocEntry.__slots__}
+    if isinstance(value, Sequence):
+        return list(value)
+    raise TypeError(f'Object of type {type(value).__name__} is not JSON serializable')
+
+
+# ==============================================================================
+# --- HTML解析の実行 ---
+# ==============================================================================
+
+def make_soup(content):
+    """設定されたパーサーでBeautifulSoupを構築する"""
+    return BeautifulSoup(content, HTML_PARSER)
+
+class ElementSelector:
+    """タグ名・クラス・属性値の前方一致だけからなる単純なセレクタ（import時に作成し、要素ごとに判定する）
+
+    classesはすべてを含むクラス（`.a.b`）、class_containsはclass属性の文字列に含まれる部分（`[class*="a"]`）。
+    """
+    __slots__ = ('name', 'classes', 'class_contains', 'attr_prefix')
+
+    def __init__(self, name=None, classes=(), class_contains=(), attr_prefix=None):
+        self.name = name
+        self.classes = frozenset(classes)
+        self.class_contains = tuple(class_contains)
+        self.attr_prefix = attr_prefix  # (属性名, 値の先頭)
+
+    def match(self, name, attrs):
+        if self.name is not None and name != self.name:
+            return False
+        if self.classes or self.class_contains:
+            classes = (attrs.get('class') or '').split()
+            if not self.classes.issubset(classes):
+                return False
+            joined = ' '.join(classes)
+            if not all(part in joined for part in self.class_contains):
+                return False
+        if self.attr_prefix is not None:
+            value = attrs.get(self.attr_prefix[0])
+            if value is None or not value.startswith(self.attr_prefix[1]):
+                return False
+        return True
+
+# BeautifulSoupで文字列がNavigableStringとして扱われない（get_textに含まれない）要素
+NON_TEXT_ELEMENTS = frozenset(['rt', 'rp', 'style', 'script', 'template'])
+LXML_FEED_SIZE = 512  # BeautifulSoup(lxml)と同じ区切りでパーサーに渡す
+
+def lxml_document(content):
+    """BeautifulSoup(lxml)と同じ文字コードの判定・入力の渡し方で、lxmlの要素の木を構築する（要素がなければNone）"""
+    if isinstance(content, str):
+        attempts = [(content.lstrip('\N{BYTE ORDER MARK}'), None)]
+    else:
+        # 文字コードの候補を順に試し、lxmlが受け付けないものは飛ばす
+        detector = EncodingDetector(content, is_html=True)
+        attempts = ((detector.markup, encoding) for encoding in detector.encodings)
+    for markup, encoding in attempts:
+        try:
+            parser = lxml_etree.HTMLParser(strip_cdata=False, recover=True, encoding=encoding)
+            for offset in range(0, max(len(markup), 1), LXML_FEED_SIZE):
+                parser.feed(markup[offset:offset + LXML_FEED_SIZE])
+            return parser.close()
+        except lxml_etree.XMLSyntaxError:
+            return None  # 要素が1つもない（空のページなど）
+        except (UnicodeDecodeError, LookupError, lxml_etree.ParserError):
+            continue
+    return None
+
+def iter_elements(content):
+    """ページの要素を文書順に1回だけ走査し、('start', 要素, タグ名, 属性) と ('end', 要素, None, None) を返す
+
+    lxmlがあり HTML_PARSER が 'lxml' の場合はBeautifulSoupを介さずlxmlの木を、それ以外はBeautifulSoupの木を走査する。
+    属性のclassは空白区切りの文字列として返す。
+    """
+    if lxml_etree is not None and HTML_PARSER == 'lxml':
+        root = lxml_document(content)
+        if root is None:
+            return
+        for event, element in lxml_etree.iterwalk(root, events=('start', 'end')):
+            if event == 'start':
+                yield 'start', element, element.tag, element.attrib
+            else:
+                yield 'end', element, None, None
+        return
+    stack = []
+    for tag in make_soup(content).descendants:
+        if not isinstance(tag, Tag):
+            continue
+        while stack and stack[-1] is not tag.parent:
+            yield 'end', stack.pop(), None, None
+        stack.append(tag)
+        attrs = tag.attrs
+        if isinstance(attrs.get('class'), list):
+            attrs = dict(attrs, **{'class': ' '.join(attrs['class'])})
+        yield 'start', tag, tag.name, attrs
+    while stack:
+        yield 'end', stack.pop(), None, None
+
+def element_text(element, separator=''):
+    """BeautifulSoupの get_text(separator, strip=True) と同じ文字列を返す"""
+    if isinstance(element, Tag):
+        return element.get_text(separator=separator, strip=True)
+    strings = []
+    hidden = 0  # 開いているNON_TEXT_ELEMENTSの数
+    for event, node in lxml_etree.iterwalk(element, events=('start', 'end', 'comment', 'pi')):
+        if event == 'start':
+            if node.tag in NON_TEXT_ELEMENTS:
+                hidden += 1
+            if not hidden and node.text:
+                strings.append(node.text)
+            continue
+        if event == 'end' and node.tag in NON_TEXT_ELEMENTS:
+            hidden -= 1
+        # コメント・処理命令は中身を含めず、その後ろの文字列だけを含める
+        if node is not element and not hidden and node.tail:
+            strings.append(node.tail)
+    return separator.join(text for text in (string.strip() for string in strings) if text)
+
+def parse_in_context(parse, content, *args):
+    """解析プロセス・スレッドプールで解析関数を実行する（解析結果はリクエストのURLに依存しない）"""
+    return parse(content, *args)
+
+def init_parse_worker(parser):
+    """解析プロセスの初期化（親プロセスのパーサー設定を引き継ぐ）"""
+    global HTML_PARSER
+    HTML_PARSER = parser
+
+parse_process_pool = None
+parse_process_pool_lock = threading.Lock()
+
+def get_parse_process_pool():
+    """解析用のプロセスプールを返す（最初の呼び出し時に生成）"""
+    global parse_process_pool
+    with parse_process_pool_lock:
+        if parse_process_pool is None:
+            # 多数のスレッドを持つプロセスからのforkを避けるためspawnで起動する
+            parse_process_pool = ProcessPoolExecutor(
+                max_workers=PARSE_PROCESSES,
+                mp_context=multiprocessing.get_context('spawn'),
+                initializer=init_parse_worker,
+                initargs=(HTML_PARSER,),
+            )
+        return parse_process_pool
+
+def run_parse(parse, content, *args):
+    """解析関数を実行する。PARSE_PROCESSESが設定されていればプロセスプールで実行し、GILの競合を避ける"""
+    start = time.perf_counter()
+    try:
+        if PARSE_PROCESSES > 0:
+            return get_parse_process_pool().submit(parse_in_context, parse, content, *args).result()
+        return parse(content, *args)
+    finally:
+        observe_parse(parse, time.perf_counter() - start)
+
+# ==============================================================================
+# --- スクレイピング関数 ---
+# ==============================================================================
+
+def ranking_page_request(genre, period, page=1):
+    """ランキングページの取得先URLとクエリパラメータを返す"""
+    return f"{RANKING_URL_BASE}/{genre}/{period}", {'page': page}
+
+@cached('ranking')
+def scrape_ranking_page(genre, period, page=1):
+    """ランキングページをスクレイピングする"""
+    content = fetch_page(*ranking_page_request(genre, period, page))
+    if content is None:
+        return None
+    return run_parse(parse_ranking_page, content, page)
+
+# ランキングページのセレクタ（広告枠内を除いた `.widget-work.float-parent` が1作品）
+RANKING_ITEM = ElementSelector('div', classes=['widget-work', 'float-parent'])
+RANKING_AD_BOX = ElementSelector(classes=['widget-workRankingBoxForNext'])
+RANKING_TITLE_HEADING = ElementSelector('h3', classes=['widget-workCard-title'])
+RANKING_INTRODUCTION = ElementSelector('p', classes=['widget-workCard-introduction'])
+RANKING_PAGER_NEXT = ElementSelector('p', classes=['widget-pagerNext'])
+RANKING_LIST_TITLE = ElementSelector('header', classes=['widget-media-genresWorkList-listTitle'])
+RANKING_FIELDS = {
+    # 項目名: (セレクタ, 祖先に必要な要素のセレクタ)
+    'rank': (ElementSelector('p', classes=['widget-work-rank']), None),
+    'title': (ElementSelector('a', classes=['widget-workCard-titleLabel']), RANKING_TITLE_HEADING),
+    'author': (ElementSelector('a', classes=['widget-workCard-authorLabel']), None),
+    'summary': (ElementSelector('a'), RANKING_INTRODUCTION),
+    'meta': (ElementSelector('p', classes=['widget-workCard-meta']), None),
+}
+RANKING_PAGE_FIELDS = {
+    'next': (ElementSelector('a'), RANKING_PAGER_NEXT),
+    'title': (ElementSelector('h3'), RANKING_LIST_TITLE),
+}
+# 祖先として開いているかを数えるセレクタ
+RANKING_CONTEXTS = (RANKING_AD_BOX, RANKING_TITLE_HEADING, RANKING_INTRODUCTION, RANKING_PAGER_NEXT, RANKING_LIST_TITLE)
+
+def match_fields(found, fields, name, attrs, element, open_contexts):
+    """まだ見つかっていない項目のうち、要素が一致するものを記録する（各項目は文書順で最初の要素）"""
+    for field, (selector, context) in fields.items():
+        if field not in found and selector.match(name, attrs) and (context is None or open_contexts[context]):
+            found[field] = element
+
+def parse_ranking_page(content, page):
+    """ランキングページのHTMLを解析する（要素を1回だけ走査し、各作品の項目を取り出す）"""
+    items = []  # 作品ごとに見つかった項目の要素（文書順）
+    open_items = []  # 開いている作品の項目
+    page_found = {}
+    open_contexts = dict.fromkeys(RANKING_CONTEXTS, 0)  # 開いている祖先の要素の数（セレクタごと）
+    stack = []  # 開いている要素ごとの(一致した祖先用セレクタ, 作品の項目)
+    for event, element, name, attrs in iter_elements(content):
+        if event == 'end':
+            contexts, item = stack.pop()
+            for context in contexts:
+                open_contexts[context] -= 1
+            if item is not None:
+                open_items.pop()
+            continue
+        # 祖先の要素（この要素自身は含まない）で判定するため、項目の記録を先に行う
+        for found in open_items:
+            match_fields(found, RANKING_FIELDS, name, attrs, element, open_contexts)
+        match_fields(page_found, RANKING_PAGE_FIELDS, name, attrs, element, open_contexts)
+        item = None
+        # 広告枠内の要素は除外する
+        if not open_contexts[RANKING_AD_BOX] and RANKING_ITEM.match(name, attrs):
+            item = {}
+            items.append(item)
+            open_items.append(item)
+        contexts = [context for context in RANKING_CONTEXTS if context.match(name, attrs)]
+        for context in contexts:
+            open_contexts[context] += 1
+        stack.append((contexts, item))
+
+    results = []
+    for found in items:
+        rank_tag, title_tag = found.get('rank'), found.get('title')
+        # 必須要素がなければスキップ
+        if not (rank_tag is not None and title_tag is not None and title_tag.get('href')):
+            continue
+
+        work_id = get_work_id_from_url(title_tag.get('href'))
+        if work_id:
+            meta_text = ""
+            if 'meta' in found:
+                # ' | ' で区切って取得し、空でない要素だけを再結合
+                meta_text_raw = element_text(found['meta'], separator=' | ')
+                meta_text = ' | '.join(part for part in meta_text_raw.split(' | ') if part)
+
+            results.append({
+                'rank': element_text(rank_tag),
+                'title': element_text(title_tag),
+                'work_id': work_id,
+                'author': element_text(found['author']) if 'author' in found else '作者不明',
+                'summary': element_text(found['summary']) if 'summary' in found else 'あらすじなし',
+                'meta': meta_text
+            })
+
+    pagination = {'prev': None, 'next': None}
+    next_page_tag = page_found.get('next')
+    if next_page_tag is not None and next_page_tag.get('href'):
+        pagination['next'] = page + 1
+        
+    if page > 1:
+        pagination['prev'] = page - 1
+        
+    title = element_text(page_found['title']) if 'title' in page_found else 'ランキング'
+
+    return {'results': results, 'pagination': pagination, 'title': title}
+
+
+def search_page_request(query, page=1):
+    """検索結果ページの取得先URLとクエリパラメータを返す"""
+    return SEARCH_URL, {'q': query, 'page': page}
+
+@cached('search')
+def scrape_search_page(query, page=1):
+    """検索結果ページをスクレイピングする"""
+    content = fetch_page(*search_page_request(query, page))
+    if content is None:
+        return None
+    return run_parse(parse_search_page, content, page)
+
+# 検索結果ページのセレクタ（Next.jsの動的クラス名に対応するため、クラス名の一部で判定する）
+SEARCH_ITEM = ElementSelector('div', class_contains=['WorkListItem_container'])
+# 上記の作品が見つからない場合の代替: 作品へのリンクを含む見出しを囲む枠
+SEARCH_BOX = ElementSelector('div', class_contains=['NewBox_box', 'padding-py-m'])
+SEARCH_HEADING = ElementSelector('h3', class_contains=['Heading_heading'])
+SEARCH_WORK_LINK = ElementSelector('a', attr_prefix=('href', '/works/'))
+SEARCH_AUTHOR_LABEL = ElementSelector('span', class_contains=['WorkTitle_workLabelAuthor'])
+SEARCH_FIELDS = {
+    'title': (ElementSelector('a'), SEARCH_HEADING),
+    'author': (ElementSelector('a'), SEARCH_AUTHOR_LABEL),
+}
+# あらすじは作品へのリンクの直下の要素
+SEARCH_SUMMARY = ElementSelector('div', class_contains=['partialGiftWidgetWeakText'])
+SEARCH_TOTAL = ElementSelector('div', class_contains=['Typography_align-right'])
+SEARCH_CONTEXTS = (SEARCH_HEADING, SEARCH_AUTHOR_LABEL)
+
+def parse_search_page(content, page):
+    """検索結果ページのHTMLを解析する（要素を1回だけ走査し、各作品の項目を取り出す）"""
+    items = []  # `#search-result-main` 内の作品ごとに見つかった項目の要素（文書順）
+    links = []  # 代替用: 見出し内の作品へのリンクごとに、それを囲む最も内側の枠の項目（なければNone）
+    open_items = []  # 開いている作品・枠の項目
+    open_boxes = []  # 開いている枠の項目
+    total_tag = None
+    main = 0  # 開いている `#search-result-main` の数
+    open_contexts = dict.fromkeys(SEARCH_CONTEXTS, 0)
+    stack = []  # 開いている要素ごとの(一致した祖先用セレクタ, 作品・枠の項目, 枠か, 作品へのリンクか, mainか)
+    for event, element, name, attrs in iter_elements(content):
+        if event == 'end':
+            contexts, item, is_box, work_link, is_main = stack.pop()
+            for context in contexts:
+                open_contexts[context] -= 1
+            if item is not None:
+                open_items.pop()
+            if is_box:
+                open_boxes.pop()
+            main -= is_main
+            continue
+        parent_is_work_link = bool(stack) and stack[-1][3]
+        for found in open_items:
+            match_fields(found, SEARCH_FIELDS, name, attrs, element, open_contexts)
+            if 'summary' not in found and parent_is_work_link and SEARCH_SUMMARY.match(name, attrs):
+                found['summary'] = element
+        if total_tag is None and SEARCH_TOTAL.match(name, attrs):
+            total_tag = element
+        work_link = SEARCH_WORK_LINK.match(name, attrs)
+        if work_link and open_contexts[SEARCH_HEADING]:
+            links.append(open_boxes[-1] if open_boxes else None)
+        # 作品・枠の要素は、その子孫から項目を取り出す（枠の項目は代替の場合のみ使う）
+        item = None
+        if main and SEARCH_ITEM.match(name, attrs):
+            item = {}
+            items.append(item)
+        is_box = SEARCH_BOX.match(name, attrs)
+        if is_box:
+            item = item if item is not None else {}
+            open_boxes.append(item)
+        if item is not None:
+            open_items.append(item)
+        is_main = attrs.get('id') == 'search-result-main'
+        main += is_main
+        contexts = [context for context in SEARCH_CONTEXTS if context.match(name, attrs)]
+        for context in contexts:
+            open_contexts[context] += 1
+        stack.append((contexts, item, is_box, work_link, is_main))
+    if not items:
+        items = links
+
+    results = []
+    for found in items:
+        if not found: continue
+        title_tag = found.get('title')
+        if title_tag is not None and title_tag.get('href'):
+            work_id = get_work_id_from_url(title_tag.get('href'))
+            if work_id:
+                results.append({
+                    'title': element_text(title_tag),
+                    'work_id': work_id,
+                    'author': element_text(found['author']) if 'author' in found else '作者不明',
+                    'summary': element_text(found['summary'], separator='\n') if 'summary' in found else 'あらすじなし'
+                })
+
+    pagination = {'prev': None, 'next': None}
+    total_text = element_text(total_tag) if total_tag is not None else ""
+    total_count_match = re.search(r'全(\d+)件', total_text)
+    total = total_count_match.group(1) if total_count_match else '多数'
+    
+    # ページネーションの有無を判定
+    # 件数が分かればそこから最終ページを求める。「多数」の場合は、検索結果が1ページの最大数あれば次のページがあるとみなす
+    if total_count_match:
+        if page < search_page_count(int(total)):
+            pagination['next'] = page + 1
+    elif len(results) >= SEARCH_PER_PAGE:
+        pagination['next'] = page + 1
+    if page > 1:
+        pagination['prev'] = page - 1
+
+    return {'results': results, 'pagination': pagination, 'total': total}
+
+def toc_page_request(work_id):
+    """目次ページの取得先URLとクエリパラメータを返す"""
+    return urljoin(BASE_URL, f"works/{work_id}"), None
+
+@cached('toc')
+def scrape_toc_page(work_id):
+    """作品の目次ページをスクレイピングする（__NEXT_DATA__ JSONを解析する方式）"""
+    content = fetch_page(*toc_page_request(work_id))
+    if content is None:
+        return None
+    return run_parse(parse_toc_page, content, work_id)
+
+def parse_toc_page(content, work_id):
+    """目次ページのHTMLから__NEXT_DATA__を取り出して解析する"""
+    # 数MBになる目次ページでもDOMを構築しないよう、まずバイト列から直接切り出す
+    data = extract_next_data(content)
+    if data is None:
+        data = extract_next_data_from_soup(content)
+        if data is None:
+            return None
+
+    try:
+        apollo_state = data['props']['pageProps']['__APOLLO_STATE__']
+    except (KeyError, TypeError) as e:
+        print(f"Error parsing JSON data: {e}")
+        return None
+
+    work_key = f'Work:{work_id}'
+    if work_key not in apollo_state:
+        return None
+    work_data = apollo_state[work_key]
+
+    author_key = work_data.get('author', {}).get('__ref')
+    author_name = apollo_state.get(author_key, {}).get('activityName', '作者不明')
+
+    novel_info = {
+        'title': work_data.get('title', 'タイトル不明'),
+        'work_id': sys.intern(work_id),
+        'author': author_name,
+        'summary': work_data.get('introduction', '').replace('\\n', '\n'),
+        'episodes': []
+    }
+
+    toc_refs = work_data.get('tableOfContents', [])
+    for toc_ref in toc_refs:
+        chapter_key = toc_ref.get('__ref')
+        chapter_data = apollo_state.get(chapter_key)
+        
+        if not chapter_data:
+            continue
+            
+        # 章タイトルを追加 (章が存在する場合のみ)
+        # 'chapter'キーの値がnull (PythonではNone) の場合があるため、チェックを強化
+        chapter_ref = chapter_data.get('chapter')
+        if chapter_ref and chapter_ref.get('__ref'):
+            chapter_info_key = chapter_ref.get('__ref')
+            chapter_info = apollo_state.get(chapter_info_key)
+            if chapter_info:
+                novel_info['episodes'].append({
+                    'is_chapter': True,
+                    'title': chapter_info.get('title', '章タイトル不明')
+                })
+
+        # エピソードリストを追加
+        episode_refs = chapter_data.get('episodeUnions', [])
+        for episode_ref in episode_refs:
+            episode_key = episode_ref.get('__ref')
+            episode_data = apollo_state.get(episode_key)
+            if episode_data:
+                episode_id = episode_data.get('id')
+                if episode_id:
+                    novel_info['episodes'].append({
+                        'is_chapter': False,
+                        'title': episode_data.get('title', 'エピソード不明'),
+                        'episode_id': episode_id,
+                        'published_at': episode_data.get('publishedAt')
+                    })
+
+    # キャッシュに保持する間の使用メモリを抑えるため、列ごとにまとめる
+    novel_info['episodes'] = EpisodeList(novel_info['episodes'])
+    return novel_info
+
+def viewer_page_request(work_id, episode_id):
+    """本文ページの取得先URLとクエリパラメータを返す"""
+    return urljoin(BASE_URL, f"works/{work_id}/episodes/{episode_id}"), None
+
+@cached('episode')
+def scrape_viewer_page(work_id, episode_id):
+    """小説の本文ページをスクレイピングする"""
+    content = fetch_page(*viewer_page_request(work_id, episode_id))
+    if content is None:
+        return None
+    return run_parse(parse_viewer_page, content, work_id)
+
+class EpisodePageParser(HTMLParser):
+    """本文ページを1回の走査で解析する（DOMを構築せず、各段落を文字列と(親文字, ルビ)の並びとして取り出す）
+
+    BeautifulSoup(html.parser)でルビ要素を置き換えていた従来の処理と同じ結果になるよう、
+    文字列の区切り方とrt/rp/script/style/template内の文字列の扱いを合わせている。
+    """
+
+    # 終了タグを持たない要素（BeautifulSoupのHTMLTreeBuilder.empty_element_tagsと同じ）
+    VOID_ELEMENTS = frozenset([
+        'area', 'base', 'br', 'col', 'embed', 'hr', 'img', 'input', 'keygen', 'link', 'menuitem', 'meta',
+        'param', 'source', 'track', 'wbr', 'basefont', 'bgsound', 'command', 'frame', 'image', 'isindex',
+        'nextid', 'spacer',
+    ])
+    # 中の文字列が本文のテキストとして扱われない要素
+    STRING_CONTAINERS = frozenset(['rt', 'rp', 'style', 'script', 'template'])
+
+    def __init__(self, original_encoding=None):
+        super().__init__(convert_charrefs=False)
+        self.original_encoding = original_encoding
+        self.title = None
+        self.subtitle = None
+        self.prev_href = None
+        self.next_href = None
+        self.body_lines = None  # 本文要素が見つかった時点でリストになる
+        self._found = set()  # 最初の一致だけを使う項目（'prev', 'next'）
+        self._stack = []  # 開いている要素の(タグ名, 役割のリスト)
+        self._text = []  # 次のタグまでに出現したテキスト
+        self._containers = []  # 開いているrt/rp等
+        self._captures = {}  # 取得中のタイトル・サブタイトルの文字列
+        self._breadcrumbs = 0  # 開いているパンくず要素の数
+        self._breadcrumb_h1 = 0  # パンくず要素内で開いているh1の数
+        self._in_body = False
+        self._lines = []  # 開いている段落の文字列
+        self._ruby = None  # 処理中のルビ: {'base': [...], 'reading': [...], 'rt': 状態}
+
+    @classmethod
+    def parse(cls, content):
+        """HTMLのバイト列を解析したパーサーを返す（文字コードはBeautifulSoupと同じ方法で判定する）"""
+        dammit = UnicodeDammit(content, is_html=True)
+        parser = cls(dammit.original_encoding)
+        parser.feed(dammit.unicode_markup or '')
+        parser.close()
+        return parser
+
+    def handle_starttag(self, tag, attrs):
+        self._flush()
+        attrs = dict(attrs)
+        classes = attrs.get('class') or ''
+        if 'prev' not in self._found and (
+                (tag == 'link' and ' '.join((attrs.get('rel') or '').split()) == 'prev')
+                or (tag == 'a' and 'ChapterLink_prev__' in classes)):
+            self._found.add('prev')
+            self.prev_href = attrs.get('href')
+        if 'next' not in self._found and (
+                (tag == 'link' and ' '.join((attrs.get('rel') or '').split()) == 'next')
+                or (tag == 'a' and 'ChapterLink_next__' in classes)):
+            self._found.add('next')
+            self.next_href = attrs.get('href')
+        if tag == 'br' and self._ruby is None and not self._containers:
+            for line in self._lines:
+                if line and line[-1] != LINE_BREAK_SEGMENT:
+                    line.append(LINE_BREAK_SEGMENT)
+        if tag in self.VOID_ELEMENTS:
+            return
+
+        roles = []
+        if tag == 'h1' and self._breadcrumbs:
+            self._breadcrumb_h1 += 1
+            roles.append('h1')
+        if attrs.get('id') == 'worksEpisodesEpisodeHeader-breadcrumbs':
+            self._breadcrumbs += 1
+            roles.append('breadcrumbs')
+        if tag == 'a' and self._breadcrumb_h1 and self.title is None and 'title' not in self._captures:
+            self._captures['title'] = []
+            roles.append('title')
+        if (self.subtitle is None and 'subtitle' not in self._captures
+                and ('widget-episodeTitle' in classes.split() or (tag == 'p' and 'WorkEpisode_title__' in classes))):
+            self._captures['subtitle'] = []
+            roles.append('subtitle')
+        if (tag == 'div' and self.body_lines is None
+                and ('widget-episodeBody' in classes.split() or 'Viewer_viewer__' in classes)):
+            self.body_lines = []
+            self._in_body = True
+            roles.append('body')
+        if self._in_body:
+            if tag == 'p':
+                line = []
+                self.body_lines.append(line)
+                self._lines.append(line)
+                roles.append('p')
+            if tag == 'ruby' and self._ruby is None:
+                self._ruby = {'base': [], 'reading': [], 'rt': None}
+                roles.append('ruby')
+            elif tag == 'rt' and self._ruby is not None and self._ruby['rt'] is None:
+                # ルビとして使うのは最初のrtのみ（2つ目以降のrtは親文字にも含まれない）
+                self._ruby['rt'] = 'open'
+                roles.append('reading')
+        if tag in self.STRING_CONTAINERS:
+            self._containers.append(tag)
+            roles.append('container')
+        self._stack.append((tag, roles))
+
+    def handle_endtag(self, tag):
+        self._flush()
+        # 対応する開始タグまでの要素をすべて閉じる（対応するものがなければ無視する）
+        for index in range(len(self._stack) - 1, -1, -1):
+            if self._stack[index][0] == tag:
+                while len(self._stack) > index:
+                    self._close(self._stack.pop()[1])
+                return
+
+    def handle_data(self, data):
+        self._text.append(data)
+
+    def handle_charref(self, name):
+        # BeautifulSoupHTMLParser.handle_charrefと同じ変換を行う
+        if name[:1] in ('x', 'X'):
+            code = int(name.lstrip('xX'), 16)
+        else:
+            code = int(name)
+        data = None
+        if code < 256:
+            for encoding in (self.original_encoding, 'windows-1252'):
+                if not encoding:
+                    continue
+                try:
+                    data = bytearray([code]).decode(encoding)
+                except UnicodeDecodeError:
+                    pass
+        if not data:
+            try:
+                data = chr(code)
+            except (ValueError, OverflowError):
+                pass
+        self._text.append(data or '\N{REPLACEMENT CHARACTER}')
+
+    def handle_entityref(self, name):
+        character = EntitySubstitution.HTML_ENTITY_TO_CHARACTER.get(name)
+        self._text.append(character if character is not None else f'&{name}')
+
+    def handle_comment(self, data):
+        self._flush()
+
+    def handle_decl(self, decl):
+        self._flush()
+
+    def unknown_decl(self, data):
+        self._flush()
+
+    def handle_pi(self, data):
+        self._flush()
+
+    def close(self):
+        super().close()
+        self._flush()
+        while self._stack:
+            self._close(self._stack.pop()[1])
+
+    def _flush(self):
+        """タグの間のテキストを1つの文字列として処理する"""
+        if not self._text:
+            return
+        text = ''.join(self._text)
+        self._text = []
+        container = self._containers[-1] if self._containers else None
+        stripped = text.strip()
+        if container is None:
+            for parts in self._captures.values():
+                parts.append(stripped)
+        if self._ruby is not None:
+            if container is None:
+                self._ruby['base'].append(stripped)
+            elif container == 'rt' and self._ruby['rt'] == 'open':
+                self._ruby['reading'].append(stripped)
+        elif container is None and stripped:
+            for line in self._lines:
+                line.append(stripped)
+
+    def _close(self, roles):
+        for role in reversed(roles):
+            if role == 'container':
+                self._containers.pop()
+            elif role == 'reading':
+                self._ruby['rt'] = 'closed'
+            elif role == 'ruby':
+                ruby, self._ruby = self._ruby, None
+                if ruby['rt'] is None:
+                    # rtのないルビはそのまま（親文字の文字列を1つずつ）出力する
+                    segments = [text for text in ruby['base'] if text]
+                else:
+                    segments = [(''.join(ruby['base']), ''.join(ruby['reading']))]
+                for line in self._lines:
+                    line.extend(segments)
+            elif role == 'p':
+                self._lines.pop()
+            elif role == 'body':
+                self._in_body = False
+            elif role == 'breadcrumbs':
+                self._breadcrumbs -= 1
+            elif role == 'h1':
+                self._breadcrumb_h1 -= 1
+            elif role in ('title', 'subtitle'):
+                setattr(self, role, ''.join(self._captures.pop(role)))
+
+def format_body_line(segments):
+    """段落の文字列と(親文字, ルビ)の並びを、表示用の1行（ルビは「親文字(ルビ)」）にする"""
+    return '\n'.join(segment if isinstance(segment, str) else f'{segment[0]}({segment[1]})'
+                     for segment in segments if segment != LINE_BREAK_SEGMENT)
+
+def parse_viewer_page(content, work_id):
+    """本文ページのHTMLを解析し、(本文, 前後の話のID)を返す（リンクのURLは描画時にviewer_navで組み立てる）
+
+    HTML_PARSERの設定によらず、EpisodePageParserの1回の走査で解析する。
+    """
+    page = EpisodePageParser.parse(content)
+    title = page.title if page.title is not None else '作品タイトル不明'
+    subtitle = page.subtitle if page.subtitle is not None else 'サブタイトル不明'
+
+    if page.body_lines is not None:
+        # 末尾の改行を除き、改行だけの段落は空の段落として扱う
+        lines = [line[:-1] if line and line[-1] == LINE_BREAK_SEGMENT else line for line in page.body_lines]
+        lines = [line for line in lines if line]
+        body_lines = [format_body_line(line) for line in lines]
+        # エクスポート用に、ルビを含む段落だけ分割前の並び（段落内の改行を含む）を残す（ルビのない段落はNone）
+        ruby_lines = [line if any(not isinstance(segment, str) for segment in line) else None for line in lines]
+    else:
+        body_lines = ['本文が取得できませんでした。']
+        ruby_lines = [None]
+
+    novel = {
+        'title': title,
+        'subtitle': subtitle,
+        'body': BodyLines(body_lines),
+        'ruby_body': RubyLines(ruby_lines)
+    }
+
+    # URLはマウント先(script_root)によって変わるため、キャッシュにはIDだけを保存する
+    nav = {'prev': None, 'next': None}
+    
+    if page.prev_href:
+        nav['prev'] = get_episode_id_from_url(page.prev_href)
+
+    if page.next_href:
+        nav['next'] = get_episode_id_from_url(page.next_href)
+
+    return novel, nav
+
+def nav_episode_id(value):
+    """ナビゲーションの前後の話のIDを返す（以前の形式でキャッシュされた本文ページのURLからも取り出す）"""
+    return value.rsplit('/', 1)[1] if value and '/' in value else value
+
+def viewer_nav(work_id, nav):
+    """前後の話のIDから、本文ページのナビゲーションのリンクを組み立てる"""
+    links = {'prev': None, 'toc': url_for('table_of_contents', work_id=work_id), 'next': None}
+    for direction in ('prev', 'next'):
+        episode_id = nav_episode_id(nav[direction])
+        if episode_id:
+            links[direction] = url_for('viewer', work_id=work_id, episode_id=episode_id)
+    return links
+
+
+# ==============================================================================
+# --- 先読み ---
+# ==============================================================================
+
+class Prefetcher:
+    """閲覧中のエピソードの続きと作品の目次を、バックグラウンドでキャッシュに先読みする"""
+
+    MAX_READERS = 1024  # 世代を記録する読者数の上限
+    MAX_TRACKED = 4096  # 未使用の先読み結果として記録するキー数の上限
+
+    def __init__(self, episodes, workers):
+        self.episodes = episodes
+        self.workers = workers
+        self._queue = queue.Queue(maxsize=256)
+        self._lock = threading.Lock()
+        self._threads = []
+        self._generations = OrderedDict()  # reader -> 最新の先読み世代
+        self._unused = OrderedDict()  # 先読みしたがまだ読まれていないキャッシュキー
+        self.counters = {'scheduled': 0, 'fetched': 0, 'cancelled': 0, 'dropped': 0, 'hits': 0}
+
+    def schedule(self, reader, work_id, episode_id):
+        """readerが開いたエピソードに続く先読みを予約し、同じ読者の古い予約を無効にする"""
+        with self._lock:
+            generation = self._generations.pop(reader, 0) + 1
+            self._generations[reader] = generation
+            while len(self._generations) > self.MAX_READERS:
+                self._generations.popitem(last=False)
+            self._start_workers()
+            self.counters['scheduled'] += 1
+        try:
+            self._queue.put_nowait((reader, generation, work_id, episode_id))
+        except queue.Full:
+            with self._lock:
+                self.counters['dropped'] += 1
+
+    def claim(self, key):
+        """ユーザーのリクエストがキャッシュにヒットした際に呼び、先読みの的中を記録する"""
+        with self._lock:
+            if self._unused.pop(key, False):
+                self.counters['hits'] += 1
+
+    def stats(self):
+        """先読みの件数と的中率を返す"""
+        with self._lock:
+            fetched = self.counters['fetched']
+            return dict(self.counters, hit_rate=self.counters['hits'] / fetched if fetched else None)
+
+    def _start_workers(self):
+        # ロック取得済みの状態で呼ぶこと。スレッドは最初の予約時に起動する
+        while len(self._threads) < self.workers:
+            thread = threading.Thread(target=self._run, name='prefetch', daemon=True)
+            thread.start()
+            self._threads.append(thread)
+
+    def _is_current(self, reader, generation):
+        with self._lock:
+            current = self._generations.get(reader) == generation
+            if not current:
+                self.counters['cancelled'] += 1
+            return current
+
+    def _run(self):
+        background_fetch.set(True)
+        while True:
+            reader, generation, work_id, episode_id = self._queue.get()
+            try:
+                with app.test_request_context():
+                    self._prefetch(reader, generation, work_id, episode_id)
+            except Exception as e:
+                print(f"Error prefetching {work_id}/{episode_id}: {e}")
+
+    def _prefetch(self, reader, generation, work_id, episode_id):
+        if not self._is_current(reader, generation):
+            return
+        novel = self._cached(scrape_toc_page, work_id) or self._fetch(scrape_toc_page, work_id)
+        if not novel:
+            return
+        episode_ids = [item['episode_id'] for item in novel['episodes'] if not item['is_chapter']]
+        if episode_id not in episode_ids:
+            return
+        position = episode_ids.index(episode_id)
+        for next_id in episode_ids[position + 1:position + 1 + self.episodes]:
+            # 読者が別のエピソードへ移動していれば残りは取りやめる
+            if not self._is_current(reader, generation):
+                return
+            self._fetch(scrape_viewer_page, work_id, next_id)
+
+    @staticmethod
+    def _cached(scrape, *args):
+        """キャッシュ済みの有効な値を、キャッシュの統計を変えずに返す。ない場合はNone"""
+        cached = response_cache.get_stale(scrape.cache_key(*args))
+        return cached[0] if cached and cached[2] > time.time() else None
+
+    def _fetch(self, scrape, *args):
+        """キャッシュにないページを取得する。キャッシュ済み・取得中のページは取得せずNoneを返す"""
+        key = scrape.cache_key(*args)
+        if response_cache.contains(key) or in_flight.pending(key):
+            return None
+        # 低い優先度の送信枠は、取得をまとめる代表になる前に待つ
+        # （待機中に同じページを開いたユーザーのリクエストが、先読みの待機に巻き込まれないように）
+        observe_upstream(scrape.page_type, 'queue', rate_limiter.acquire(background=True))
+        reservation = {'used': False}
+        token = rate_limit_reserved.set(reservation)
+        try:
+            # 待機中に取得済み・取得中になったページは取得しない
+            result = None if response_cache.contains(key) or in_flight.pending(key) else scrape(*args)
+        finally:
+            rate_limit_reserved.reset(token)
+            if not reservation['used']:
+                # 上流に送らなかった場合は送信枠を返す
+                rate_limiter.release()
+        if result is not None and reservation['used']:
+            with self._lock:
+                self.counters['fetched'] += 1
+                self._unused[key] = True
+                while len(self._unused) > self.MAX_TRACKED:
+                    self._unused.popitem(last=False)
+        return result
+
+
+prefetcher = Prefetcher(PREFETCH_EPISODES, PREFETCH_WORKERS)
+
+# ==============================================================================
+# --- 一括エクスポート ---
+# ==============================================================================
+
+# 形式ごとのContent-Type
+EXPORT_FORMATS = {
+    'epub': 'application/epub+zip',
+    'txt': 'text/plain; charset=utf-8',
+}
+
+def load_export_episode(work_id, episode_id, spool_dir=None, background=False):
+    """1話分の本文を返す: (本文, 取得元)。取得元は 'spool'（途中保存）/ 'cache' / 'fetched' / 'failed'"""
+    path = os.path.join(spool_dir, f'{episode_id}.json') if spool_dir else None
+    if path and os.path.exists(path):
+        with open(path, encoding='utf-8') as f:
+            return json.load(f), 'spool'
+    background_fetch.set(background)
+    source = 'cache' if response_cache.contains(scrape_viewer_page.cache_key(work_id, episode_id)) else 'fetched'
+    with app.test_request_context():
+        result = scrape_viewer_page(work_id, episode_id)
+    if result is None:
+        return None, 'failed'
+    novel = result[0]
+    if path:
+        # 中断されても壊れたファイルが残らないよう、一時ファイルから置き換える
+        with open(path + '.tmp', 'w', encoding='utf-8') as f:
+            json.dump(novel, f, ensure_ascii=False, default=compact_json)
+        os.replace(path + '.tmp', path)
+    return novel, source
+
+def iter_work_episodes(work_id, items, workers=EXPORT_WORKERS, spool_dir=None, background=False):
+    """目次の項目を順に (項目, 本文, 取得元) として返す。本文は並行して取得し、章の本文はNoneとする"""
+    executor = ThreadPoolExecutor(max_workers=workers)
+    pending = deque()
+
+    def resolve(entry):
+        item, future = entry
+        if future is None:
+            return item, None, 'chapter'
+        return (item, *future.result())
+
+    try:
+        for item in items:
+            future = None
+            if not item['is_chapter']:
+                future = executor.submit(contextvars.copy_context().run, load_export_episode,
+                                         work_id, item['episode_id'], spool_dir, background)
+            pending.append((item, future))
+            # 取得済みの本文を溜め込みすぎないよう、先行して取得するのはworkers*2件まで
+            if len(pending) >= workers * 2:
+                yield resolve(pending.popleft())
+        while pending:
+            yield resolve(pending.popleft())
+    finally:
+        # ダウンロードが中断された場合は、未着手の取得を取りやめる
+        executor.shutdown(wait=False, cancel_futures=True)
+
+def export_line_segments(novel):
+    """本文の各段落を文字列と(親文字, ルビ)の並びとして返す（ルビのない段落は、段落内の改行を含む表示用の行のまま）"""
+    ruby_lines = novel.get('ruby_body') or [None] * len(novel['body'])
+    return [segments or [line] for line, segments in zip(novel['body'], ruby_lines)]
+
+def iter_export_text(novel, episodes):
+    """作品全体を1つのテキストとして少しずつ返す（ルビはカクヨムの記法「｜親文字《ルビ》」で残す）"""
+    yield f"{novel['title']}\n作者: {novel['author']}\n\n{novel['summary']}\n".encode('utf-8')
+    for item, body, source in episodes:
+        if item['is_chapter']:
+            yield f"\n\n■ {item['title']}\n".encode('utf-8')
+            continue
+        lines = export_line_segments(body) if body else [[FETCH_ERROR_MESSAGES['episode']]]
+        text = '\n'.join(
+            ''.join(segment if isinstance(segment, str) else f'｜{segment[0]}《{segment[1]}》' for segment in line)
+            for line in lines
+        )
+        yield f"\n\n◆ {item['title']}\n\n{text}\n".encode('utf-8')
+
+class ExportBuffer:
+    """zipfileの出力を溜めておき、書き込まれた分ずつ取り出すための書き込み専用ファイル"""
+
+    def __init__(self):
+        self._chunks = []
+
+    def write(self, data):
+        self._chunks.append(bytes(data))
+        return len(data)
+
+    def flush(self):
+        pass
+
+    def take(self):
+        data = b''.join(self._chunks)
+        self._chunks = []
+        return data
+
+def iter_export_epub(novel, episodes):
+    """作品全体をEPUBとして少しずつ返す（ルビは<ruby>要素として残す。テンプレートの描画にアプリケーションコンテキストが必要）"""
+    buffer = ExportBuffer()
+    groups = [{'title': None, 'entries': []}]
+    files = []
+    with zipfile.ZipFile(buffer, 'w', zipfile.ZIP_DEFLATED) as archive:
+        # mimetypeは先頭に無圧縮で置く（EPUBの仕様）
+        archive.writestr(zipfile.ZipInfo('mimetype'), 'application/epub+zip', compress_type=zipfile.ZIP_STORED)
+        archive.writestr('META-INF/container.xml', EPUB_CONTAINER_XML)
+        archive.writestr('OEBPS/text/title.xhtml', render_template('epub/title.xhtml', novel=novel))
+        yield buffer.take()
+        for item, body, source in episodes:
+            if item['is_chapter']:
+                groups.append({'title': item['title'], 'entries': []})
+                continue
+            file = f'episode-{len(files) + 1:05d}.xhtml'
+            # 章の最初の話には章タイトルも表示する
+            chapter = groups[-1]['title'] if not groups[-1]['entries'] else None
+            files.append(file)
+            groups[-1]['entries'].append({'title': item['title'], 'file': file})
+            lines = export_line_segments(body) if body else [[FETCH_ERROR_MESSAGES['episode']]]
+            archive.writestr(f'OEBPS/text/{file}', render_template(
+                'epub/episode.xhtml', heading=item['title'], chapter=chapter, lines=lines))
+            yield buffer.take()
+        archive.writestr('OEBPS/nav.xhtml', render_template(
+            'epub/nav.xhtml', novel=novel, groups=[group for group in groups if group['entries']]))
+        archive.writestr('OEBPS/content.opf', render_template(
+            'epub/package.xml', novel=novel, files=files,
+            modified=time.strftime('%Y-%m-%dT%H:%M:%SZ', time.gmtime())))
+    yield buffer.take()
+
+def export_command(args):
+    """コマンドラインから作品全体を保存する（中断しても、同じコマンドで続きから再開できる）"""
+    output = args.output or f'{args.work_id}.{args.format}'
+    spool_dir = output + '.parts'
+
+    with app.test_request_context():
+        novel = scrape_toc_page(args.work_id)
+    if novel is None or not novel.get('episodes'):
+        print(FETCH_ERROR_MESSAGES['toc'], file=sys.stderr)
+        return 1
+
+    # 1. 全話を取得して途中保存する（保存済みの話は取得しない）
+    os.makedirs(spool_dir, exist_ok=True)
+    total = sum(not item['is_chapter'] for item in novel['episodes'])
+    counts = {'spool': 0, 'cache': 0, 'fetched': 0, 'failed': 0}
+    for item, body, source in iter_work_episodes(args.work_id, novel['episodes'], args.workers, spool_dir):
+        if item['is_chapter']:
+            continue
+        counts[source] += 1
+        print(f"[{sum(counts.values())}/{total}] {item['title']} ({source})", file=sys.stderr)
+    if counts['failed']:
+        print(f"{counts['failed']}話の取得に失敗しました。もう一度実行すると続きから取得します。", file=sys.stderr)
+        return 1
+
+    # 2. 途中保存した本文から出力ファイルを作る
+    episodes = iter_work_episodes(args.work_id, novel['episodes'], args.workers, spool_dir)
+    chunks = iter_export_epub(novel, episodes) if args.format == 'epub' else iter_export_text(novel, episodes)
+    with app.app_context(), open(output + '.tmp', 'wb') as f:
+        for chunk in chunks:
+            f.write(chunk)
+    os.replace(output + '.tmp', output)
+    shutil.rmtree(spool_dir)
+    print(f"{output}: {total}話（取得 {counts['fetched']}、キャッシュ {counts['cache']}、途中保存 {counts['spool']}）",
+          file=sys.stderr)
+    return 0
+
+
+# ==============================================================================
+# --- ライブラリ（ローカル保存と更新確認） ---
+# ==============================================================================
+
+class Library:
+    """作品・章・エピソード情報と本文をSQLiteに保存し、目次の差分だけを取得して更新する"""
+
+    def __init__(self, path):
+        self._db = sqlite3.connect(path, check_same_thread=False)
+        self._lock = threading.Lock()
+        with self._lock:
+            self._db.executescript(
+                "CREATE TABLE IF NOT EXISTS works ("
+                "work_id TEXT PRIMARY KEY, title TEXT, author TEXT, summary TEXT, synced_at REAL, last_sync TEXT);"
+                "CREATE TABLE IF NOT EXISTS chapters ("
+                "work_id TEXT NOT NULL, position INTEGER NOT NULL, title TEXT, PRIMARY KEY (work_id, position));"
+                "CREATE TABLE IF NOT EXISTS episodes ("
+                "work_id TEXT NOT NULL, episode_id TEXT NOT NULL, position INTEGER NOT NULL,"
+                " title TEXT, published_at TEXT, body TEXT, PRIMARY KEY (work_id, episode_id));"
+            )
+
+    def add(self, work_id):
+        """作品を登録する（目次と本文は次の同期で取得する）"""
+        with self._lock:
+            self._db.execute("INSERT OR IGNORE INTO works (work_id) VALUES (?)", (work_id,))
+            self._db.commit()
+
+    def work_ids(self):
+        """登録済みの作品IDの一覧"""
+        with self._lock:
+            return [row[0] for row in self._db.execute("SELECT work_id FROM works ORDER BY rowid")]
+
+    def close(self):
+        with self._lock:
+            self._db.close()
+
+    def works(self):
+        """登録済みの作品と、エピソード数・本文の保存数・前回の同期結果の一覧"""
+        with self._lock:
+            rows = self._db.execute(
+                "SELECT w.work_id, w.title, w.author, w.synced_at, w.last_sync, COUNT(e.episode_id), COUNT(e.body) "
+                "FROM works w LEFT JOIN episodes e ON e.work_id = w.work_id GROUP BY w.work_id ORDER BY w.rowid"
+            ).fetchall()
+        return [
+            {'work_id': work_id, 'title': title, 'author': author, 'synced_at': synced_at,
+             'last_sync': json.loads(last_sync) if last_sync else None, 'episodes': episodes, 'stored': stored}
+            for work_id, title, author, synced_at, last_sync, episodes, stored in rows
+        ]
+
+    def episode(self, work_id, episode_id):
+        """保存済みの本文を返す。未保存ならNone"""
+        with self._lock:
+            row = self._db.execute(
+                "SELECT body FROM episodes WHERE work_id = ? AND episode_id = ?", (work_id, episode_id)
+            ).fetchone()
+        return json.loads(row[0]) if row and row[0] else None
+
+    def sync(self, work_id, workers=EXPORT_WORKERS, background=False):
+        """目次を取得し直して保存済みの目次と比較し、新規・変更されたエピソードの本文だけを取得する。同期の統計を返す"""
+        stats = {'work_id': work_id, 'episodes': 0, 'fetched': 0, 'cached': 0, 'skipped': 0,
+                 'removed': 0, 'failed': 0, 'bytes': 0}
+        transferred = []
+        token = transferred_bytes.set(transferred)
+        try:
+            self._sync(work_id, stats, workers, background)
+        finally:
+            transferred_bytes.reset(token)
+        stats['bytes'] = sum(transferred)
+        with self._lock:
+            self._db.execute("UPDATE works SET synced_at = ?, last_sync = ? WHERE work_id = ?",
+                             (time.time(), json.dumps(stats), work_id))
+            self._db.commit()
+        return stats
+
+    def _sync(self, work_id, stats, workers, background):
+        # 目次はキャッシュの有効期限内でも再検証する（変更がなければ304で済む）
+        response_cache.expire(scrape_toc_page.cache_key(work_id))
+        with app.test_request_context():
+            novel = scrape_toc_page(work_id)
+        if novel is None or not novel.get('episodes'):
+            stats['failed'] += 1
+            return
+
+        pending, changed, stats['removed'] = self._update_toc(novel)
+        items = [item for item in novel['episodes'] if not item['is_chapter']]
+        targets = [item for item in items if item['episode_id'] in pending]
+        stats['episodes'] = len(items)
+        stats['skipped'] = len(items) - len(targets)
+        # 変更されたエピソードは、キャッシュに残っている古い本文を使わないよう再検証させる
+        for episode_id in changed:
+            response_cache.expire(scrape_viewer_page.cache_key(work_id, episode_id))
+
+        for item, body, source in iter_work_episodes(work_id, targets, workers, background=background):
+            if body is None:
+                stats['failed'] += 1
+                continue
+            with self._lock:
+                self._db.execute("UPDATE episodes SET body = ? WHERE work_id = ? AND episode_id = ?",
+                                 (json.dumps(body, ensure_ascii=False, default=compact_json), work_id, item['episode_id']))
+                self._db.commit()
+            stats['cached' if source == 'cache' else 'fetched'] += 1
+
+    def _update_toc(self, novel):
+        """目次を保存し、(本文の取得が必要なID, 変更されたID, 削除された数)を返す"""
+        work_id = novel['work_id']
+        with self._lock:
+            stored = {
+                episode_id: (title, published_at)
+                for episode_id, title, published_at in self._db.execute(
+                    "SELECT episode_id, title, published_at FROM episodes WHERE work_id = ?", (work_id,))
+            }
+            current = {}
+            changed = set()
+            with self._db:
+                self._db.execute(
+                    "INSERT INTO works (work_id, title, author, summary) VALUES (?, ?, ?, ?) "
+                    "ON CONFLICT (work_id) DO UPDATE SET title = excluded.title, author = excluded.author, "
+                    "summary = excluded.summary",
+                    (work_id, novel['title'], novel['author'], novel['summary'])
+                )
+                self._db.execute("DELETE FROM chapters WHERE work_id = ?", (work_id,))
+                for position, item in enumerate(novel['episodes']):
+                    if item['is_chapter']:
+                        self._db.execute("INSERT INTO chapters (work_id, position, title) VALUES (?, ?, ?)",
+                                         (work_id, position, item['title']))
+                        continue
+                    episode_id = item['episode_id']
+                    current[episode_id] = True
+                    version = (item['title'], item.get('published_at'))
+                    if stored.get(episode_id) == version:
+                        self._db.execute("UPDATE episodes SET position = ? WHERE work_id = ? AND episode_id = ?",
+                                         (position, work_id, episode_id))
+                        continue
+                    # 新規または変更されたエピソードは本文を空にして取得対象にする
+                    if episode_id in stored:
+                        changed.add(episode_id)
+                    self._db.execute(
+                        "INSERT OR REPLACE INTO episodes (work_id, episode_id, position, title, published_at, body) "
+                        "VALUES (?, ?, ?, ?, ?, NULL)", (work_id, episode_id, position, *version)
+                    )
+                removed = [episode_id for episode_id in stored if episode_id not in current]
+                self._db.executemany("DELETE FROM episodes WHERE work_id = ? AND episode_id = ?",
+                                     [(work_id, episode_id) for episode_id in removed])
+            pending = {row[0] for row in self._db.execute(
+                "SELECT episode_id FROM episodes WHERE work_id = ? AND body IS NULL", (work_id,))}
+        return pending, changed, len(removed)
+
+
+library = None
+library_lock = threading.Lock()
+
+def get_library():
+    """ライブラリを返す（最初の呼び出し時にLIBRARY_PATHのデータベースを開く）"""
+    global library
+    with library_lock:
+        if library is None:
+            library = Library(data_path(LIBRARY_PATH))
+        return library
+
+
+class LibrarySyncer:
+    """Webからのライブラリ同期を、1本のスレッドでバックグラウンド実行する"""
+
+    def __init__(self):
+        self._queue = queue.Queue()
+        self._queued = set()
+        self._lock = threading.Lock()
+        self._thread = None
+        self.current = None
+
+    def schedule(self, work_ids):
+        """作品の同期を予約する（予約済みの作品は重複させない）"""
+        with self._lock:
+            for work_id in work_ids:
+                if work_id not in self._queued and work_id != self.current:
+                    self._queued.add(work_id)
+                    self._queue.put(work_id)
+            if self._thread is None:
+                self._thread = threading.Thread(target=self._run, name='library-sync', daemon=True)
+                self._thread.start()
+
+    def status(self):
+        """同期中の作品IDと、待機中の作品数"""
+        with self._lock:
+            return {'current': self.current, 'queued': len(self._queued)}
+
+    def _run(self):
+        # 閲覧中のリクエストを妨げないよう、先読みと同じ低い優先度でレート制限を使う
+        background_fetch.set(True)
+        while True:
+            work_id = self._queue.get()
+            with self._lock:
+                self._queued.discard(work_id)
+                self.current = work_id
+            try:
+                get_library().sync(work_id, background=True)
+            except Exception as e:
+                print(f"Error syncing {work_id}: {e}")
+            finally:
+                with self._lock:
+                    self.current = None
+
+
+library_syncer = LibrarySyncer()
+
+def sync_command(args):
+    """コマンドラインからライブラリを同期し、作品ごとの統計をJSONで1行ずつ出力する"""
+    library = get_library()
+    for work_id in args.work_ids:
+        library.add(work_id)
+    totals = {'fetched': 0, 'cached': 0, 'skipped': 0, 'removed': 0, 'failed': 0, 'bytes': 0}
+    for work_id in args.work_ids or library.work_ids():
+        stats = library.sync(work_id, args.workers)
+        print(json.dumps(stats, ensure_ascii=False))
+        for name in totals:
+            totals[name] += stats[name]
+    print(json.dumps(dict(totals, work_id='total'), ensure_ascii=False))
+    return 1 if totals['failed'] else 0
+
+
+# ==============================================================================
+# --- 更新情報（複数作品の新着エピソード） ---
+# ==============================================================================
+
+def request_json_ids(name):
+    """リクエストのJSON本文と、その中のIDの配列（文字列のリスト）を返す
+
+    JSONがなければ ({}, [])。本文がオブジェクトでない、または name が文字列・整数の配列でなければ (None, None)。
+    """
+    body = request.get_json(silent=True)
+    if body is None:
+        return {}, []
+    if not isinstance(body, dict):
+        return None, None
+    ids = body.get(name, [])
+    if not isinstance(ids, list) or not all(isinstance(value, (str, int)) and not isinstance(value, bool)
+                                            for value in ids):
+        return None, None
+    return body, [str(value) for value in ids]
+
+def parse_since(value, default_days=FEED_DEFAULT_DAYS):
+    """sinceの指定（UNIX時刻、またはISO 8601の日付・日時。時差の指定がなければローカル時刻）を日時に変換する
+
+    省略時はdefault_days日前。不正な指定（範囲外の時刻や文字列・数値以外を含む）はValueErrorとなる。
+    """
+    if not value:
+        return datetime.now(timezone.utc) - timedelta(days=default_days)
+    try:
+        return datetime.fromtimestamp(float(value), timezone.utc)
+    except (OverflowError, OSError) as e:
+        raise ValueError(f"since out of range: {value!r}") from e
+    except (TypeError, ValueError):
+        pass
+    if not isinstance(value, str):
+        raise ValueError(f"invalid since: {value!r}")
+    since = datetime.fromisoformat(value)
+    try:
+        return since if since.tzinfo else since.astimezone()
+    except (OverflowError, OSError) as e:
+        raise ValueError(f"since out of range: {value!r}") from e
+
+def published_datetime(published_at):
+    """目次の公開日時（例: 2024-01-01T09:00:00Z）を日時に変換する"""
+    return datetime.fromisoformat(published_at.replace('Z', '+00:00'))
+
+def work_updates(work_id, since):
+    """作品の目次を取得し、since以降に公開されたエピソードを新しい順に返す。取得できなければNone"""
+    novel = scrape_toc_page(work_id)
+    if novel is None or not novel.get('episodes'):
+        return None
+    episodes = [
+        {'work_id': work_id, 'work_title': novel['title'], 'episode_id': item['episode_id'],
+         'title': item['title'], 'published_at': item['published_at']}
+        for item in novel['episodes']
+        if not item['is_chapter'] and item.get('published_at') and published_datetime(item['published_at']) > since
+    ]
+    episodes.sort(key=lambda episode: published_datetime(episode['published_at']), reverse=True)
+    return {'work_id': work_id, 'title': novel['title'], 'author': novel['author'], 'episodes': episodes}
+
+def iter_updates(work_ids, since, workers=FEED_WORKERS, background=False):
+    """複数作品の目次を並行して取得し、取得できた作品から順に結果を返す
+
+    作品ごとに {'type': 'work', ...}（取得失敗は {'type': 'error', ...}）を返し、最後に全作品の
+    新着エピソードを新しい順にまとめた {'type': 'feed', ...} を返す。
+    """
+    executor = ThreadPoolExecutor(max_workers=workers)
+
+    def fetch(work_id):
+        background_fetch.set(background)
+        return work_updates(work_id, since)
+
+    futures = {executor.submit(contextvars.copy_context().run, fetch, work_id): work_id
+               for work_id in dict.fromkeys(work_ids)}
+    feed = []
+    failed = 0
+    try:
+        for future in as_completed(futures):
+            work_id = futures[future]
+            try:
+                result = future.result()
+            except Exception as e:
+                print(f"Error fetching updates for {work_id}: {e}")
+                result = None
+            if result is None:
+                failed += 1
+                yield {'type': 'error', 'work_id': work_id, 'error': FETCH_ERROR_MESSAGES['toc']}
+                continue
+            feed.extend(result['episodes'])
+            yield {'type': 'work', **result}
+        feed.sort(key=lambda episode: published_datetime(episode['published_at']), reverse=True)
+        yield {'type': 'feed', 'since': since.isoformat(), 'works': len(futures), 'failed': failed, 'episodes': feed}
+    finally:
+        # 送信が中断された場合は、未着手の取得を取りやめる
+        executor.shutdown(wait=False, cancel_futures=True)
+
+def feed_command(args):
+    """コマンドラインから複数作品の新着エピソードを取得し、作品ごとの結果と全体の結果をJSONで1行ずつ出力する"""
+    try:
+        since = parse_since(args.since)
+    except ValueError:
+        print(f"--since の指定が正しくありません: {args.since}", file=sys.stderr)
+        return 2
+    failed = 0
+    for entry in iter_updates(args.work_ids or get_library().work_ids(), since, args.workers):
+        failed += entry['type'] == 'error'
+        print(json.dumps(entry, ensure_ascii=False), flush=True)
+    return 1 if failed else 0
+
+
+# ==============================================================================
+# --- ランキングのスナップショット ---
+# ==============================================================================
+
+def ranking_position(rank):
+    """順位の表記から数値を取り出す。取り出せなければNone"""
+    match = re.search(r'\d+', rank)
+    return int(match.group()) if match else None
+
+
+class RankingSnapshots:
+    """ランキングの最新のスナップショットと順位の履歴をSQLiteに保存する
+
+    最新のスナップショットはメモリにも保持し、ランキングページはそこから返す。
+    履歴は定期取得のたびに作品ID→順位を記録したもので、順位の変動の計算に使う。
+    """
+
+    def __init__(self, path):
+        self._db = sqlite3.connect(path, check_same_thread=False)
+        self._lock = threading.Lock()
+        with self._lock:
+            self._db.executescript(
+                "CREATE TABLE IF NOT EXISTS snapshots ("
+                "genre TEXT NOT NULL, period TEXT NOT NULL, page INTEGER NOT NULL, taken_at REAL NOT NULL,"
+                " data TEXT NOT NULL, PRIMARY KEY (genre, period, page));"
+                "CREATE TABLE IF NOT EXISTS rank_history ("
+                "genre TEXT NOT NULL, period TEXT NOT NULL, taken_at REAL NOT NULL, ranks TEXT NOT NULL,"
+                " PRIMARY KEY (genre, period, taken_at));"
+            )
+            self._db.execute("DELETE FROM rank_history WHERE taken_at < ?", (time.time() - RANKING_HISTORY_KEEP,))
+            self._db.commit()
+            self._latest = {
+                (genre, period, page): (taken_at, json.loads(data))
+                for genre, period, page, taken_at, data in self._db.execute(
+                    "SELECT genre, period, page, taken_at, data FROM snapshots")
+            }
+
+    def latest(self, genre, period, page, max_age=RANKING_SNAPSHOT_MAX_AGE):
+        """max_age秒以内に取得したスナップショットを返す。なければNone"""
+        snapshot = self._latest.get((genre, period, page))
+        if snapshot is None or snapshot[0] < time.time() - RANKING_WARM_INTERVAL:
+            # 定期取得を行う別のワーカープロセスが保存した、より新しいスナップショットを読み込む
+            snapshot = self._reload(genre, period, page) or snapshot
+        if snapshot is None or snapshot[0] < time.time() - max_age:
+            return None
+        return snapshot[1]
+
+    def _reload(self, genre, period, page):
+        with self._lock:
+            row = self._db.execute(
+                "SELECT taken_at, data FROM snapshots WHERE genre = ? AND period = ? AND page = ?",
+                (genre, period, page)
+            ).fetchone()
+            current = self._latest.get((genre, period, page))
+            if row is None or (current is not None and current[0] >= row[0]):
+                return None
+            snapshot = self._latest[(genre, period, page)] = (row[0], json.loads(row[1]))
+            return snapshot
+
+    def work_ids(self):
+        """最新のスナップショットに含まれる作品ID（ページ・順位の順。重複を除く）"""
+        work_ids = {}
+        for key in sorted(self._latest, key=lambda key: key[2]):
+            for item in self._latest[key][1]['results']:
+                work_ids.setdefault(item['work_id'], None)
+        return list(work_ids)
+
+    def close(self):
+        with self._lock:
+            self._db.close()
+
+    def oldest(self):
+        """最新のスナップショットのうち、最も古い取得時刻。スナップショットがなければNone"""
+        return min((taken_at for taken_at, _ in self._latest.values()), default=None)
+
+    def record(self, genre, period, pages, taken_at):
+        """ジャンル×期間の取得結果（ページ番号→解析結果）を保存し、順位を履歴に加える"""
+        ranks = {}
+        for data in pages.values():
+            for item in data['results']:
+                position = ranking_position(item['rank'])
+                if position is not None:
+                    ranks.setdefault(item['work_id'], position)
+        with self._lock:
+            for page, data in pages.items():
+                self._db.execute(
+                    "INSERT OR REPLACE INTO snapshots (genre, period, page, taken_at, data) VALUES (?, ?, ?, ?, ?)",
+                    (genre, period, page, taken_at, json.dumps(data, ensure_ascii=False))
+                )
+            self._db.execute(
+                "INSERT OR REPLACE INTO rank_history (genre, period, taken_at, ranks) VALUES (?, ?, ?, ?)",
+                (genre, period, taken_at, json.dumps(ranks))
+            )
+            self._db.commit()
+            for page, data in pages.items():
+                self._latest[(genre, period, page)] = (taken_at, data)
+
+    def deltas(self, genre, period, results, window=RANKING_DELTA_WINDOW):
+        """window秒より前の順位と比べた変動を返す: (比較した順位の取得時刻, 作品ID→表記)。履歴がなければ(None, {})"""
+        with self._lock:
+            row = self._db.execute(
+                "SELECT taken_at, ranks FROM rank_history WHERE genre = ? AND period = ? AND taken_at <= ? "
+                "ORDER BY taken_at DESC LIMIT 1",
+                (genre, period, time.time() - window)
+            ).fetchone()
+        if row is None:
+            return None, {}
+        baseline = json.loads(row[1])
+        covered = max(baseline.values(), default=0)
+        deltas = {}
+        for item in results:
+            position = ranking_position(item['rank'])
+            if position is None:
+                continue
+            previous = baseline.get(item['work_id'])
+            if previous is None:
+                # 前回取得した範囲の順位に新しく入った作品だけを「NEW」とする
+                if position <= covered:
+                    deltas[item['work_id']] = 'NEW'
+            elif previous > position:
+                deltas[item['work_id']] = f'↑{previous - position}'
+            elif previous < position:
+                deltas[item['work_id']] = f'↓{position - previous}'
+            else:
+                deltas[item['work_id']] = '→'
+        return row[0], deltas
+
+
+ranking_snapshots = None
+ranking_snapshots_lock = threading.Lock()
+
+def get_ranking_snapshots(create=False):
+    """ランキングのスナップショットを返す（RANKING_SNAPSHOT_PATHのデータベースを開く）。無効の場合はNone
+
+    createでない場合（ランキングページなど読むだけの場合）は、データベースがまだなければ作成せずNoneを返す。
+    """
+    global ranking_snapshots
+    with ranking_snapshots_lock:
+        if ranking_snapshots is None and RANKING_SNAPSHOT_PATH:
+            if create or os.path.exists(os.path.join(DATA_DIR, RANKING_SNAPSHOT_PATH)):
+                ranking_snapshots = RankingSnapshots(data_path(RANKING_SNAPSHOT_PATH))
+        return ranking_snapshots
+
+
+class RankingWarmer:
+    """全ジャンル×期間のランキングを定期的に取得し、スナップショットを更新する
+
+    1本のスレッドで、先読みと同じ低い優先度でレート制限を使う。キャッシュ済みのページは
+    期限切れにしてから取得するため、変更がなければ条件付きGETの304で済む。
+    """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._thread = None
+        self.counters = {'passes': 0, 'pages': 0, 'failed': 0}
+        self.last_pass = None
+
+    def start(self):
+        """定期取得のスレッドを開始する（開始済み、または無効の場合は何もしない）"""
+        with self._lock:
+            if self._thread is not None or not RANKING_WARM_ENABLED or not RANKING_SNAPSHOT_PATH:
+                return
+            self._thread = threading.Thread(target=self._run, name='ranking-warmer', daemon=True)
+            self._thread.start()
+
+    def warm(self, pages=RANKING_WARM_PAGES):
+        """全ジャンル×期間のランキングをpagesページずつ取得してスナップショットを保存し、統計を返す"""
+        snapshots = get_ranking_snapshots(create=True)
+        stats = {'pages': 0, 'failed': 0, 'started_at': time.time()}
+        for genre in RANKING_GENRES:
+            for period in RANKING_PERIODS:
+                fetched = {}
+                for page in range(1, pages + 1):
+                    response_cache.expire(scrape_ranking_page.cache_key(genre, period, page))
+                    data = scrape_ranking_page(genre, period, page)
+                    if data is None:
+                        stats['failed'] += 1
+                        break
+                    fetched[page] = data
+                    if not data['pagination']['next']:
+                        break
+                if fetched:
+                    snapshots.record(genre, period, fetched, time.time())
+                    stats['pages'] += len(fetched)
+        stats['seconds'] = round(time.time() - stats['started_at'], 1)
+        with self._lock:
+            self.counters['passes'] += 1
+            self.counters['pages'] += stats['pages']
+            self.counters['failed'] += stats['failed']
+            self.last_pass = stats
+        return stats
+
+    def stats(self):
+        """定期取得の回数・取得ページ数と、前回の取得結果"""
+        with self._lock:
+            return dict(self.counters, running=self._thread is not None, last_pass=self.last_pass)
+
+    def _run(self):
+        background_fetch.set(True)
+        # 再起動直後など、保存済みのスナップショットが新しければ次の予定時刻まで待つ
+        oldest = get_ranking_snapshots(create=True).oldest()
+        if oldest is not None:
+            time.sleep(max(oldest + RANKING_WARM_INTERVAL - time.time(), 0))
+        while True:
+            started_at = time.time()
+            try:
+                self.warm()
+            except Exception as e:
+                print(f"Error warming rankings: {e}")
+            time.sleep(max(started_at + RANKING_WARM_INTERVAL - time.time(), 0))
+
+
+ranking_warmer = RankingWarmer()
+
+def rankings_command(args):
+    """コマンドラインからランキングを1回取得してスナップショットを保存し、統計をJSONで出力する"""
+    if not RANKING_SNAPSHOT_PATH:
+        print("スナップショットの保存先が指定されていません（--snapshots にファイルのパスを指定してください）。", file=sys.stderr)
+        return 2
+    stats = ranking_warmer.warm(args.pages)
+    print(json.dumps(stats, ensure_ascii=False))
+    return 1 if stats['failed'] else 0
+
+
+# ==============================================================================
+# --- カクヨムの検索結果（正規化した検索語ごと） ---
+# ==============================================================================
+# 全角・半角や英字の大小、空白だけが異なる検索語は、正規化して同じ検索語として取得・キャッシュする。
+# 取得済みのページの「全N件」から最終ページを求め、それより後のページは上流に取得しに行かずに空の結果を返す。
+
+def normalize_search_query(query):
+    """カクヨムで検索する語を正規化する（全角英数字を半角に、英字を小文字に、連続する空白を1つに）"""
+    return ' '.join(normalize_search_text(query).split())
+
+def search_page_count(total):
+    """検索結果の件数からページ数を求める"""
+    return -(-total // SEARCH_PER_PAGE)
+
+
+class SearchResultSets:
+    """正規化した検索語ごとに取得済みの検索結果の件数を記録し、キャッシュの利用状況を数える"""
+
+    def __init__(self, max_entries):
+        self.max_entries = max_entries
+        self._totals = OrderedDict()  # 正規化した検索語 -> (件数（不明ならNone）, 有効期限)
+        self._lock = threading.Lock()
+        self.counters = {'queries': 0, 'normalized': 0, 'hits': 0, 'misses': 0, 'beyond_last': 0}
+
+    def total(self, query):
+        """取得済みの検索結果の件数を返す。不明な場合はNone"""
+        now = time.time()
+        with self._lock:
+            entry = self._totals.get(query)
+            if entry and entry[1] > now:
+                self._totals.move_to_end(query)
+                return entry[0]
+        # 他のワーカーが取得した1ページ目がキャッシュにあれば、その件数を使う
+        stale = response_cache.get_stale(scrape_search_page.cache_key(query, 1))
+        if stale is None or stale[2] <= now or not stale[0]['total'].isdigit():
+            # 不明だったことも短時間記録し、同じ検索語のたびにディスクキャッシュを読まない
+            self._store(query, None, now + SEARCH_TOTAL_MISS_TTL)
+            return None
+        self.record(query, stale[0], stale[2])
+        return int(stale[0]['total'])
+
+    def record(self, query, data, expires_at=None):
+        """検索結果ページの件数を記録する（「多数」の場合は記録しない）"""
+        if data['total'].isdigit():
+            self._store(query, int(data['total']), expires_at or time.time() + CACHE_TTL['search'])
+
+    def _store(self, query, total, expires_at):
+        with self._lock:
+            self._totals[query] = (total, expires_at)
+            self._totals.move_to_end(query)
+            while len(self._totals) > self.max_entries:
+                self._totals.popitem(last=False)
+
+    def count(self, event):
+        with self._lock:
+            self.counters[event] += 1
+
+    def stats(self):
+        """検索語・ページ単位のキャッシュのヒット/ミスと、最終ページより後として取得を省いた回数"""
+        with self._lock:
+            served = self.counters['hits'] + self.counters['beyond_last']
+            requests = served + self.counters['misses']
+            return dict(self.counters, entries=len(self._totals),
+                        hit_rate=round(served / requests, 3) if requests else None)
+
+
+search_result_sets = SearchResultSets(SEARCH_RESULT_SETS_MAX)
+
+def search_results(query, page=1):
+    """カクヨムの検索結果ページを返す（検索語を正規化し、最終ページより後と分かっているページは取得しない）"""
+    normalized = normalize_search_query(query)
+    search_result_sets.count('queries')
+    if normalized != query:
+        search_result_sets.count('normalized')
+    total = search_result_sets.total(normalized)
+    last_page = max(search_page_count(total), 1) if total is not None else None
+    if last_page is not None and page > last_page:
+        search_result_sets.count('beyond_last')
+        # 「前のページ」は結果のある最終ページに戻す
+        return {'results': [], 'pagination': {'prev': min(page - 1, last_page), 'next': None}, 'total': str(total)}
+    hit = response_cache.contains(scrape_search_page.cache_key(normalized, page))
+    search_result_sets.count('hits' if hit else 'misses')
+    data = scrape_search_page(normalized, page)
+    if data is not None:
+        search_result_sets.record(normalized, data)
+    return data
+
+
+# ==============================================================================
+# --- ローカル検索（取得済みの目次・本文の全文検索） ---
+# ==============================================================================
+# 日本語は単語の区切りが空白で表れないため、正規化した文字列を2文字ずつの語(bigram)に
+# 分けてFTS5の索引に入れ、検索語も同じように分けたフレーズで検索する。
+
+SEARCH_WORD_PATTERN = re.compile(r'[^\W_]+')
+
+
+def normalize_search_text(text):
+    """検索用に文字列を正規化する（全角英数字を半角に、英字を小文字に）"""
+    return unicodedata.normalize('NFKC', text).lower()
+
+def search_bigrams(word):
+    """語を2文字ずつの語に分ける（1文字の語はそのまま）"""
+    return [word[i:i + 2] for i in range(len(word) - 1)] or [word]
+
+def search_tokens(text):
+    """索引に入れる語の並びを空白区切りで返す
+
+    1文字の検索語を前方一致で探せるよう、各語の末尾の文字も1文字の語として加える。
+    """
+    tokens = []
+    for word in SEARCH_WORD_PATTERN.findall(normalize_search_text(text)):
+        tokens.extend(search_bigrams(word))
+        if len(word) > 1:
+            tokens.append(word[-1])
+    return ' '.join(tokens)
+
+def search_match_expression(query):
+    """検索語をFTS5の検索式に変換する（すべての語を含む文書に一致）。検索できる語がなければNone"""
+    phrases = []
+    for word in SEARCH_WORD_PATTERN.findall(normalize_search_text(query)):
+        if len(word) == 1:
+            phrases.append(f'"{word}"*')
+        else:
+            phrases.append('"' + ' '.join(search_bigrams(word)) + '"')
+    return ' AND '.join(phrases) or None
+
+def search_snippet(text, query, width=SEARCH_SNIPPET_CHARS):
+    """一致箇所を含む段落から、最初の一致箇所の前後width文字を(文字列, 一致したか)の並びとして返す"""
+    words = sorted(set(SEARCH_WORD_PATTERN.findall(normalize_search_text(query))), key=len, reverse=True)
+    pattern = re.compile('|'.join(re.escape(word) for word in words)) if words else None
+    lines = text.split('\n')
+    line = next((line for line in lines if pattern and pattern.search(normalize_search_text(line))), lines[0])
+
+    # 正規化で文字数が変わる文字（…など）があっても元の文字列を表示できるよう、1文字ずつ正規化して位置を対応づける
+    normalized = []
+    positions = []
+    for index, char in enumerate(line):
+        piece = normalize_search_text(char)
+        normalized.append(piece)
+        positions.extend([index] * len(piece))
+    matches = [(positions[found.start()], positions[found.end() - 1] + 1)
+               for found in (pattern.finditer(''.join(normalized)) if pattern else ())]
+
+    first_start, first_end = matches[0] if matches else (0, 0)
+    start = max(first_start - width, 0)
+    end = min(first_end + width, len(line))
+    segments = [('…', False)] if start > 0 else []
+    position = start
+    for match_start, match_end in matches:
+        if match_start >= end:
+            break
+        if match_start < position:
+            continue
+        if match_start > position:
+            segments.append((line[position:match_start], False))
+        position = min(match_end, end)
+        segments.append((line[match_start:position], True))
+    if end > position:
+        segments.append((line[position:end], False))
+    if end < len(line):
+        segments.append(('…', False))
+    return segments
+
+
+class SearchIndex:
+    """取得した目次（作品情報）と本文を、SQLite FTS5の全文検索索引に登録・検索する
+
+    登録はスクレイピング結果がキャッシュに保存されたときに予約され、1本のスレッドで
+    バックグラウンド実行する。内容が前回の登録から変わっていなければ索引は更新しない。
+    """
+
+    def __init__(self, path):
+        self._db = sqlite3.connect(path, check_same_thread=False)
+        self._lock = threading.Lock()
+        self._queue = queue.Queue()
+        self._thread = None
+        self.counters = {'indexed': 0, 'unchanged': 0, 'queries': 0}
+        with self._lock:
+            self._db.executescript(
+                "CREATE TABLE IF NOT EXISTS documents ("
+                "id INTEGER PRIMARY KEY, work_id TEXT NOT NULL, episode_id TEXT NOT NULL,"
+                " work_title TEXT, title TEXT, author TEXT, text TEXT, digest TEXT,"
+                " UNIQUE (work_id, episode_id));"
+                "CREATE VIRTUAL TABLE IF NOT EXISTS documents_fts USING fts5(title, author, text);"
+            )
+
+    def schedule(self, page_type, arguments, value):
+        """キャッシュに保存されたスクレイピング結果の登録を予約する（目次と本文以外は無視する）"""
+        if page_type not in ('toc', 'episode'):
+            return
+        with self._lock:
+            self._queue.put((page_type, arguments, value))
+            if self._thread is None:
+                self._thread = threading.Thread(target=self._run, name='search-index', daemon=True)
+                self._thread.start()
+
+    def add_work(self, novel):
+        """作品情報（タイトル・作者・あらすじ）を登録する"""
+        self._upsert(novel['work_id'], '', novel['title'], novel['title'], novel['author'], novel['summary'])
+
+    def add_episode(self, work_id, episode_id, novel):
+        """エピソードの本文を登録する（タイトルはサブタイトル）"""
+        self._upsert(work_id, episode_id, novel['title'], novel['subtitle'], '', '\n'.join(novel['body']))
+
+    def search(self, query, page=1, per_page=SEARCH_LOCAL_PER_PAGE):
+        """検索結果（作品とエピソード、抜粋付き）と一致件数を返す"""
+        expression = search_match_expression(query)
+        if expression is None:
+            return [], 0
+        with self._lock:
+            self.counters['queries'] += 1
+            total = self._db.execute(
+                "SELECT COUNT(*) FROM documents_fts WHERE documents_fts MATCH ?", (expression,)
+            ).fetchone()[0]
+            rows = self._db.execute(
+                "SELECT d.work_id, d.episode_id, d.work_title, d.title, d.author, d.text "
+                "FROM documents_fts JOIN documents d ON d.id = documents_fts.rowid "
+                "WHERE documents_fts MATCH ? ORDER BY bm25(documents_fts, 10.0, 5.0, 1.0) LIMIT ? OFFSET ?",
+                (expression, per_page, (page - 1) * per_page)
+            ).fetchall()
+        results = [
+            {'work_id': work_id, 'episode_id': episode_id or None, 'work_title': work_title, 'title': title,
+             'author': author, 'snippet': search_snippet(text or '', query)}
+            for work_id, episode_id, work_title, title, author, text in rows
+        ]
+        return results, total
+
+    def stats(self):
+        """登録数・検索回数と、登録待ちの件数"""
+        with self._lock:
+            documents = self._db.execute("SELECT COUNT(*) FROM documents").fetchone()[0]
+            return dict(self.counters, documents=documents, queued=self._queue.qsize())
+
+    def _upsert(self, work_id, episode_id, work_title, title, author, text):
+        digest = hashlib.blake2b('\0'.join((work_title, title, author, text)).encode('utf-8'), digest_size=16).hexdigest()
+        row = self._select(work_id, episode_id)
+        if row and row[1] == digest:
+            with self._lock:
+                self.counters['unchanged'] += 1
+            return
+        # 語の分割は時間がかかるため、ロックの外で行う
+        tokens = (search_tokens(title), search_tokens(author), search_tokens(text))
+        with self._lock:
+            row = self._db.execute(
+                "SELECT id FROM documents WHERE work_id = ? AND episode_id = ?", (work_id, episode_id)
+            ).fetchone()
+            if row:
+                self._db.execute("DELETE FROM documents_fts WHERE rowid = ?", (row[0],))
+                self._db.execute(
+                    "UPDATE documents SET work_title = ?, title = ?, author = ?, text = ?, digest = ? WHERE id = ?",
+                    (work_title, title, author, text, digest, row[0])
+                )
+                document_id = row[0]
+            else:
+                document_id = self._db.execute(
+                    "INSERT INTO documents (work_id, episode_id, work_title, title, author, text, digest) "
+                    "VALUES (?, ?, ?, ?, ?, ?, ?)",
+                    (work_id, episode_id, work_title, title, author, text, digest)
+                ).lastrowid
+            self._db.execute(
+                "INSERT INTO documents_fts (rowid, title, author, text) VALUES (?, ?, ?, ?)", (document_id, *tokens)
+            )
+            self._db.commit()
+            self.counters['indexed'] += 1
+
+    def _select(self, work_id, episode_id):
+        with self._lock:
+            return self._db.execute(
+                "SELECT id, digest FROM documents WHERE work_id = ? AND episode_id = ?", (work_id, episode_id)
+            ).fetchone()
+
+    def _run(self):
+        while True:
+            page_type, arguments, value = self._queue.get()
+            try:
+                if page_type == 'toc':
+                    self.add_work(value)
+                else:
+                    self.add_episode(arguments[0], arguments[1], value[0])
+            except Exception as e:
+                print(f"Error indexing {page_type} {arguments}: {e}")
+            finally:
+                self._queue.task_done()
+
+
+search_index = None
+search_index_lock = threading.Lock()
+
+def get_search_index():
+    """全文検索索引を返す（最初の呼び出し時にSEARCH_INDEX_PATHのデータベースを開く）。無効の場合はNone"""
+    global search_index
+    with search_index_lock:
+        if search_index is None and SEARCH_INDEX_PATH:
+            search_index = SearchIndex(data_path(SEARCH_INDEX_PATH))
+        return search_index
+
+def index_scraped(page_type, arguments, value):
+    """キャッシュに保存したスクレイピング結果を全文検索索引に登録する"""
+    index = get_search_index()
+    if index is not None:
+        index.schedule(page_type, arguments, value)
+
+
+# ==============================================================================
+# --- Flask ルート定義 ---
+# ==============================================================================
+
+@app.route('/')
+def index():
+    """トップページ: 検索フォームを表示"""
+    return render_template('index.html', local_search=bool(SEARCH_INDEX_PATH))
+
+@app.route('/ranking/<genre>/<period>')
+def ranking(genre, period):
+    """ランキングを表示（定期取得したスナップショットがあればそれを使い、前日からの順位の変動を添える）"""
+    page = request.args.get('page', 1, type=int)
+    
+    if genre not in RANKING_GENRES or period not in RANKING_PERIODS:
+        return render_template('error.html', message="無効なランキングの指定です。")
+
+    snapshots = get_ranking_snapshots()
+    data = snapshots.latest(genre, period, page) if snapshots is not None else None
+    if data is None:
+        data = scrape_ranking_page(genre, period, page)
+    if data is None:
+        return render_template('error.html', message=FETCH_ERROR_MESSAGES['ranking'])
+    since, deltas = snapshots.deltas(genre, period, data['results']) if snapshots is not None else (None, {})
+
+    return render_template(
+        'ranking.html',
+        title=data['title'],
+        results=data['results'],
+        pagination=data['pagination'],
+        current_page=page,
+        genre=genre,
+        period=period,
+        deltas=deltas,
+        delta_since=time.strftime('%Y-%m-%d %H:%M', time.localtime(since)) if since else None
+    )
+
+@app.route('/search')
+def search():
+    """検索結果を表示（?mode=local の場合は取得済みの作品・本文から検索し、一致がなければカクヨムで検索する）"""
+    query = request.args.get('q')
+    page = request.args.get('page', 1, type=int)
+    if not query:
+        return redirect(url_for('index'))
+
+    fallback = False
+    index = get_search_index() if request.args.get('mode') == 'local' else None
+    if index is not None:
+        page = max(page, 1)
+        results, total = index.search(query, page)
+        if total:
+            return render_template(
+                'search_local.html',
+                query=query,
+                results=results,
+                total=total,
+                pagination={'prev': page - 1 if page > 1 else None,
+                            'next': page + 1 if page * SEARCH_LOCAL_PER_PAGE < total else None},
+                current_page=page,
+                per_page=SEARCH_LOCAL_PER_PAGE
+            )
+        fallback = True
+
+    data = search_results(query, page)
+    if data is None:
+        return render_template('error.html', message=FETCH_ERROR_MESSAGES['search'])
+
+    return render_template(
+        'search.html',
+        query=query,
+        results=data['results'],
+        total=data['total'],
+        pagination=data['pagination'],
+        current_page=page,
+        fallback=fallback
+    )
+
+def toc_sections(episodes, size=TOC_SECTION_SIZE):
+    """目次の項目を章ごとの区切りにまとめる（size話を超える章は分割し、話のない章は省く）"""
+    sections = []
+    chapter = None
+    section = None
+    number = 0
+    for item in episodes:
+        if item['is_chapter']:
+            chapter = item['title']
+            section = None
+            continue
+        number += 1
+        if section is None or len(section['episodes']) >= size:
+            section = {'title': chapter, 'first': number, 'last': number, 'episodes': []}
+            sections.append(section)
+        section['episodes'].append(item)
+        section['last'] = number
+    return sections
+
+@app.route('/novel/<work_id>')
+def table_of_contents(work_id):
+    """作品の目次を表示（話数の多い作品は章ごとに折りたたむ。?view=full ですべて表示）"""
+    source_key = scrape_toc_page.cache_key(work_id)
+    version = response_cache.version(source_key)
+    novel_data = scrape_toc_page(work_id)
+    if novel_data is None or not novel_data.get('episodes'):
+        return render_template('error.html', message=FETCH_ERROR_MESSAGES['toc'])
+
+    view = request.args.get('view')
+    collapsible = len(novel_data['episodes']) > TOC_COLLAPSE_THRESHOLD
+    sections = None
+    current = 0
+    if view == 'chapters' or (collapsible and view != 'full'):
+        sections = toc_sections(novel_data['episodes'])
+        current = min(max(request.args.get('chapter', 0, type=int), 0), len(sections) - 1)
+
+    return cached_page(
+        'toc',
+        'toc.html',
+        (source_key, version, (sections is not None, current)),
+        novel=novel_data,
+        sections=sections,
+        current=current,
+        collapsible=collapsible
+    )
+
+@app.route('/novel/<work_id>/sections/<int:index>')
+def toc_section(work_id, index):
+    """目次の1区切り分のエピソード一覧をJSONで返す（章ごと表示で閉じている章を開いたときに使う）"""
+    novel_data = scrape_toc_page(work_id)
+    if novel_data is None or not novel_data.get('episodes'):
+        return jsonify(error=FETCH_ERROR_MESSAGES['toc']), 502
+    sections = toc_sections(novel_data['episodes'])
+    if index >= len(sections):
+        return jsonify(error="指定された章がありません。"), 404
+
+    section = sections[index]
+    return jsonify(
+        index=index,
+        total=len(sections),
+        title=section['title'],
+        first=section['first'],
+        last=section['last'],
+        episodes=[
+            {'episode_id': item['episode_id'], 'title': item['title'],
+             'url': url_for('viewer', work_id=work_id, episode_id=item['episode_id'])}
+            for item in section['episodes']
+        ]
+    )
+
+@app.route('/novel/<work_id>/export/<any(epub, txt):fmt>')
+def export_work(work_id, fmt):
+    """作品全体をEPUBまたはテキストとしてダウンロードさせる（本文は取得しながら順に送信する）"""
+    novel_data = scrape_toc_page(work_id)
+    if novel_data is None or not novel_data.get('episodes'):
+        return render_template('error.html', message=FETCH_ERROR_MESSAGES['toc'])
+
+    # 閲覧中のリクエストを妨げないよう、先読みと同じ低い優先度でレート制限を使う
+    episodes = iter_work_episodes(work_id, novel_data['episodes'], background=True)
+    chunks = iter_export_epub(novel_data, episodes) if fmt == 'epub' else iter_export_text(novel_data, episodes)
+    return Response(
+        stream_with_context(chunks),
+        mimetype=EXPORT_FORMATS[fmt],
+        headers={'Content-Disposition': f'attachment; filename="{work_id}.{fmt}"'}
+    )
 
 @app.route('/novel/<work_id>/<episode_id>')
 def viewer(work_id, episode_id):
     """小説の本文を表示"""
+    source_key = scrape_viewer_page.cache_key(work_id, episode_id)
+    version = response_cache.version(source_key)
     result = scrape_viewer_page(work_id, episode_id)
     if result is None:
-        return render_template_string(ERROR_TEMPLATE, message="本文ページの取得に失敗しました。")
+        return render_template('error.html', message=FETCH_ERROR_MESSAGES['episode'])
     
     novel_data, nav_data = result
-    return render_template_string(
-        VIEWER_TEMPLATE,
+    if PREFETCH_ENABLED:
+        prefetcher.schedule(request.remote_addr, work_id, episode_id)
+    return cached_page(
+        'episode',
+        'viewer.html',
+        (source_key, version, ()),
         work_id=work_id,
         novel=novel_data,
-        nav=nav_data
+        nav=viewer_nav(work_id, nav_data)
     )
 
+@app.route('/library')
+def library_page():
+    """ライブラリに保存した作品の一覧を表示"""
+    return render_template('library.html', works=get_library().works(), status=library_syncer.status())
+
+@app.route('/library/sync', methods=['POST'])
+def library_sync():
+    """作品をライブラリに追加し（work_id指定時）、更新の確認をバックグラウンドで開始する"""
+    work_id = request.form.get('work_id')
+    library = get_library()
+    if work_id:
+        library.add(work_id)
+    library_syncer.schedule([work_id] if work_id else library.work_ids())
+    return redirect(url_for('library_page'))
+
+@app.route('/feed', methods=['GET', 'POST'])
+def updates_feed():
+    """複数作品の新着エピソードをNDJSONで返す（作品ごとの結果を取得できた順に送り、最後に全体を新しい順にまとめて送る）
+
+    作品IDは work_id パラメータ（複数可）またはJSONの {"work_ids": [...], "since": ...} で指定し、
+    省略時はライブラリの全作品とする。
+    """
+    body, json_work_ids = request_json_ids('work_ids')
+    if body is None:
+        return jsonify(error="JSONの指定が正しくありません（work_ids は作品IDの配列で指定してください）。"), 400
+    work_ids = request.values.getlist('work_id') + json_work_ids
+    if not work_ids:
+        work_ids = get_library().work_ids()
+    if not all(work_id.isdigit() for work_id in work_ids):
+        return jsonify(error="作品IDが正しくありません。"), 400
+    if len(work_ids) > FEED_MAX_WORKS:
+        return jsonify(error=f"一度に指定できる作品は{FEED_MAX_WORKS}件までです。"), 400
+    try:
+        since = parse_since(body.get('since') or request.values.get('since'))
+    except ValueError:
+        return jsonify(error="sinceの指定が正しくありません。"), 400
+
+    def generate():
+        for entry in iter_updates(work_ids, since):
+            yield json.dumps(entry, ensure_ascii=False) + '\n'
+
+    return Response(stream_with_context(generate()), mimetype='application/x-ndjson')
+
+@app.route('/metrics')
+def metrics_page():
+    """リクエスト・上流取得・解析・描画の所要時間とキャッシュの統計をPrometheusのテキスト形式で返す"""
+    return Response(metrics.render(cache_samples() + circuit_samples() + search_samples()),
+                    content_type='text/plain; version=0.0.4; charset=utf-8')
+
+@app.route('/stats')
+def stats():
+    """キャッシュ・描画済みページ・先読み・期限切れの値の利用・回路遮断器・ライブラリ同期・ランキングの定期取得・検索結果・検索索引の統計情報をJSONで返す"""
+    return jsonify(cache=response_cache.stats(), pages=page_cache.stats(), prefetch=prefetcher.stats(),
+                   stale=revalidator.stats(), circuit=upstream_breaker.stats(),
+                   library=library_syncer.status(), rankings=ranking_warmer.stats(),
+                   search=search_result_sets.stats(),
+                   search_index=search_index.stats() if search_index is not None else None)
+
+# ==============================================================================
+# --- JSON API (/api/v1) ---
+# ==============================================================================
+# スクレイピング結果をHTMLに描画せず、空白を省いたJSONで返す（アプリや電子書籍端末向け）。
+# ?fields=title,episodes.episode_id のように返す項目を絞り込める。?format=ndjson（または
+# Accept: application/x-ndjson）の場合、目次は1項目ずつ、本文は1段落ずつの行として順に送る。
+
+def api_json(value):
+    """空白を省いたJSONのバイト列を返す（orjsonがあれば使用）"""
+    if orjson is not None:
+        return orjson.dumps(value, default=compact_json)
+    return json.dumps(value, ensure_ascii=False, separators=(',', ':'), default=compact_json).encode('utf-8')
+
+def parse_fields(spec):
+    """?fields=title,episodes.title を {'title': None, 'episodes': {'title': None}} にする（Noneはその項目すべて）"""
+    if not spec:
+        return None
+    fields = {}
+    for path in spec.split(','):
+        names = [name for name in path.strip().split('.') if name]
+        if not names:
+            continue
+        node = fields
+        for name in names[:-1]:
+            if name in node and node[name] is None:
+                break  # 上位の項目すべてが指定済み
+            node = node.setdefault(name, {})
+        else:
+            node[names[-1]] = None
+    return fields
+
+def select_fields(value, fields):
+    """parse_fieldsの指定に従って、辞書（リストの場合は各要素）から項目を選ぶ"""
+    if fields is None:
+        return value
+    if isinstance(value, TocEntry):
+        value = compact_json(value)
+    if isinstance(value, dict):
+        return {name: select_fields(value[name], fields[name]) for name in fields if name in value}
+    if isinstance(value, Sequence) and not isinstance(value, str):
+        return [select_fields(item, fields) for item in value]
+    return value
+
+def wants_ndjson():
+    return (request.args.get('format') == 'ndjson' or
+            request.accept_mimetypes.best_match(['application/json', 'application/x-ndjson']) == 'application/x-ndjson')
+
+def api_response(value, fields=None):
+    return Response(api_json(select_fields(value, fields)), mimetype='application/json')
+
+def cached_api(page_type, source, value, fields):
+    """スクレイピング結果のJSONを、描画済みページのキャッシュに保存した直列化済みの本文で返す
+
+    sourceは(スクレイピング結果のキャッシュキー, 取得前に読んだ版)。キーと版、fieldsから求めたハッシュを
+    キャッシュキーと強いETagに使う。キャッシュの版が定まらない値は、従来どおりその都度直列化する。
+    """
+    source_key, version = source
+    current = response_cache.version(source_key)
+    if current is None or version not in (None, current):
+        return api_response(value, fields)
+    digest = hashlib.blake2b(digest_size=16)
+    digest.update(b'api:')
+    digest.update(source_key.encode('utf-8'))
+    digest.update(current)
+    digest.update(repr(fields).encode('utf-8'))
+    key = digest.hexdigest()
+    headers = {'Cache-Control': PAGE_CACHE_CONTROL[page_type], 'Vary': 'Accept-Encoding'}
+    response = page_cache_response(key, 'application/json', headers)
+    if response is not None:
+        return response
+    body = api_json(select_fields(value, fields))
+    page_cache.set(key, body)
+    return Response(body, mimetype='application/json', headers=dict(headers, ETag=f'"{key}"'))
+
+def api_error(message, status):
+    return Response(api_json({'error': message}), status=status, mimetype='application/json')
+
+def ndjson_response(values):
+    """値を1つずつJSONの1行として送るレスポンス"""
+    return Response(stream_with_context(api_json(value) + b'\n' for value in values), mimetype='application/x-ndjson')
+
+def episode_json(work_id, episode_id, novel, nav, ruby=False):
+    """本文をAPIの形式にする（前後の話はIDで示す。ルビの分割はrubyの場合のみ含める）"""
+    episode = {
+        'work_id': work_id,
+        'episode_id': episode_id,
+        'title': novel['title'],
+        'subtitle': novel['subtitle'],
+        'prev_episode_id': nav_episode_id(nav['prev']),
+        'next_episode_id': nav_episode_id(nav['next']),
+        'body': novel['body'],
+    }
+    if ruby:
+        # ルビを含む段落だけ、文字列と[親文字, ルビ]の並びにしたもの（ルビのない段落はnull）
+        episode['ruby_body'] = novel.get('ruby_body') or [None] * len(novel['body'])
+    return episode
+
+@app.route('/api/v1/ranking/<genre>/<period>')
+def api_ranking(genre, period):
+    """ランキングをJSONで返す"""
+    page = request.args.get('page', 1, type=int)
+    if genre not in RANKING_GENRES or period not in RANKING_PERIODS:
+        return api_error("無効なランキングの指定です。", 404)
+    snapshots = get_ranking_snapshots()
+    data = snapshots.latest(genre, period, page) if snapshots is not None else None
+    if data is None:
+        data = scrape_ranking_page(genre, period, page)
+    if data is None:
+        return api_error(FETCH_ERROR_MESSAGES['ranking'], 502)
+    return api_response(dict(data, genre=genre, period=period, page=page), parse_fields(request.args.get('fields')))
+
+@app.route('/api/v1/search')
+def api_search():
+    """カクヨムの検索結果をJSONで返す"""
+    query = request.args.get('q')
+    page = request.args.get('page', 1, type=int)
+    if not query:
+        return api_error("検索語(q)を指定してください。", 400)
+    data = search_results(query, page)
+    if data is None:
+        return api_error(FETCH_ERROR_MESSAGES['search'], 502)
+    return api_response(dict(data, query=query, page=page), parse_fields(request.args.get('fields')))
+
+@app.route('/api/v1/works/<work_id>')
+def api_work(work_id):
+    """作品の情報と目次をJSONで返す（NDJSONでは作品の情報の行に続けて、目次の項目を1行ずつ送る）"""
+    source_key = scrape_toc_page.cache_key(work_id)
+    version = response_cache.version(source_key)
+    novel_data = scrape_toc_page(work_id)
+    if novel_data is None or not novel_data.get('episodes'):
+        return api_error(FETCH_ERROR_MESSAGES['toc'], 502)
+    fields = parse_fields(request.args.get('fields'))
+    if not wants_ndjson():
+        return cached_api('toc', (source_key, version), novel_data, fields)
+
+    def lines():
+        yield select_fields({name: value for name, value in novel_data.items() if name != 'episodes'}, fields)
+        if fields is None or 'episodes' in fields:
+            item_fields = fields['episodes'] if fields else None
+            for item in novel_data['episodes']:
+                yield select_fields(item, item_fields)
+
+    return ndjson_response(lines())
+
+@app.route('/api/v1/works/<work_id>/episodes/<episode_id>')
+def api_episode(work_id, episode_id):
+    """本文をJSONで返す（NDJSONでは本文以外の情報の行に続けて、段落を1行ずつ送る。?fields=ruby_body でルビの分割も返す）"""
+    result = scrape_viewer_page(work_id, episode_id)
+    if result is None:
+        return api_error(FETCH_ERROR_MESSAGES['episode'], 502)
+    fields = parse_fields(request.args.get('fields'))
+    episode = episode_json(work_id, episode_id, *result, ruby=bool(fields and 'ruby_body' in fields))
+    if not wants_ndjson():
+        return api_response(episode, fields)
+
+    def lines():
+        yield select_fields({name: value for name, value in episode.items() if name not in ('body', 'ruby_body')}, fields)
+        if fields is None or 'body' in fields or 'ruby_body' in fields:
+            for index, line in enumerate(episode['body']):
+                paragraph = {'text': line}
+                if 'ruby_body' in episode:
+                    paragraph['ruby'] = episode['ruby_body'][index]
+                yield paragraph
+
+    return ndjson_response(lines())
+
+@app.route('/api/v1/works/<work_id>/episodes', methods=['GET', 'POST'])
+def api_episodes(work_id):
+    """複数の話の本文をまとめて返す（?ids=1,2,3 またはJSONの {"ids": [...]}。並行して取得し、指定の順に返す）
+
+    NDJSONでは取得できた順ではなく指定の順に1話1行で送る。?fieldsは各話に適用する。
+    """
+    body, json_episode_ids = request_json_ids('ids')
+    if body is None:
+        return api_error("JSONの指定が正しくありません（ids は話のIDの配列で指定してください）。", 400)
+    episode_ids = ([episode_id for value in request.values.getlist('ids') for episode_id in value.split(',') if episode_id]
+                   + json_episode_ids)
+    if not episode_ids:
+        return api_error("話のID(ids)を指定してください。", 400)
+    if not all(episode_id.isdigit() for episode_id in episode_ids):
+        return api_error("話のIDが正しくありません。", 400)
+    if len(episode_ids) > API_BATCH_MAX_EPISODES:
+        return api_error(f"一度に指定できる話は{API_BATCH_MAX_EPISODES}件までです。", 400)
+    fields = parse_fields(request.values.get('fields'))
+    ruby = bool(fields and 'ruby_body' in fields)
+    items = [{'is_chapter': False, 'episode_id': episode_id} for episode_id in episode_ids]
+
+    def episodes():
+        for item, novel, source in iter_work_episodes(work_id, items, API_BATCH_WORKERS):
+            # 取得した結果はキャッシュにあるため、前後の話を含めてもう一度取り出す
+            result = scrape_viewer_page(work_id, item['episode_id']) if novel is not None else None
+            if result is None:
+                yield {'episode_id': item['episode_id'], 'error': FETCH_ERROR_MESSAGES['episode']}
+            else:
+                yield select_fields(episode_json(work_id, item['episode_id'], *result, ruby=ruby), fields)
+
+    if wants_ndjson():
+        return ndjson_response(episodes())
+    return api_response({'work_id': work_id, 'episodes': list(episodes())})
+
+# ==============================================================================
+# --- 非同期(ASGI)モード ---
+# ==============================================================================
+# `uvicorn app:asgi_app` のようにASGIサーバーで起動すると、上流の取得をイベントループ上で
+# 非同期に行い、HTML解析を上限付きのスレッドプールで実行する。取得結果でキャッシュを
+# 温めてから既存のFlaskルートを呼ぶため、URLとテンプレートは通常モードと共通になる。
+
+parse_pool = ThreadPoolExecutor(max_workers=ASYNC_PARSE_WORKERS, thread_name_prefix='parse')
+async_client = None
+
+
+def get_async_client():
+    """非同期HTTPクライアントを返す（最初の呼び出し時に生成）"""
+    global async_client
+    if async_client is None:
+        async_client = httpx.AsyncClient(
+            headers={'User-Agent': USER_AGENT},
+            timeout=HTTP_TIMEOUT,
+            limits=httpx.Limits(max_connections=HTTP_POOL_SIZE, max_keepalive_connections=HTTP_POOL_SIZE),
+            follow_redirects=True,
+        )
+    return async_client
+
+
+async def fetch_page_async(url, params=None):
+    """fetch_pageの非同期版。httpxがない場合はスレッドでfetch_pageを実行する"""
+    if httpx is None:
+        return await asyncio.to_thread(fetch_page, url, params)
+    for attempt in range(HTTP_MAX_RETRIES + 1):
+        try:
+            return await fetch_page_once_async(url, params)
+        except RetryableFetchError as e:
+            delay = retry_delay(e.retry_after, attempt)
+            if attempt == HTTP_MAX_RETRIES or delay is None:
+                print(f"Error fetching {url}: {e}")
+                return None
+        await asyncio.sleep(delay)
+
+async def fetch_page_once_async(url, params=None):
+    """fetch_page_onceの非同期版"""
+    exchange = conditional_exchange.get()
+    headers = conditional_headers(exchange)
+    page_type = fetch_page_type.get()
+    queued = time.perf_counter()
+    await rate_limiter.acquire_async(background=background_fetch.get())
+    start = time.perf_counter()
+    observe_upstream(page_type, 'queue', start - queued)
+    # 試しの取得の枠はレート制限の待ちの後に取り、キャンセルされた場合は返す
+    allowed = upstream_breaker.allow()
+    if not allowed:
+        metrics.inc('upstream_responses_total', page_type=page_type, status='short_circuit')
+        mark_upstream_failure(exchange)
+        print(f"Error fetching {url}: upstream circuit is open")
+        return None
+    reported = False
+    try:
+        try:
+            response = await get_async_client().get(url, params=params, headers=headers)
+        except httpx.HTTPError as e:
+            metrics.inc('upstream_responses_total', page_type=page_type, status='error')
+            upstream_breaker.record_failure()
+            reported = True
+            mark_upstream_failure(exchange)
+            raise RetryableFetchError(str(e)) from e
+
+        # httpxでは接続・TTFB・受信を分けずに、全体の時間だけを記録する
+        observe_upstream(page_type, 'total', time.perf_counter() - start)
+        metrics.inc('upstream_responses_total', page_type=page_type, status=response.status_code)
+        if upstream_failed(response.status_code):
+            upstream_breaker.record_failure()
+            mark_upstream_failure(exchange)
+        else:
+            upstream_breaker.record_success()
+        reported = True
+    finally:
+        if not reported:
+            upstream_breaker.release_trial(allowed)
+    if response.status_code == 304 and headers:
+        raise NotModified(url)
+    if response.status_code in HTTP_RETRY_STATUSES:
+        raise RetryableFetchError(f"HTTP {response.status_code} for url: {response.url}",
+                                  response.headers.get('Retry-After'))
+    if response.is_error:
+        print(f"Error fetching {url}: {response.status_code}")
+        return None
+    store_validators(exchange, response.headers)
+    record_transfer(response.content)
+    return response.content
+
+
+def render_error_page(message):
+    """リクエストコンテキストの外でエラーページを描画する"""
+    with app.test_request_context():
+        return render_template('error.html', message=message)
+
+
+class AsyncSingleFlight:
+    """SingleFlightの非同期版。同一キーの取得を1つのタスクにまとめる"""
+
+    def __init__(self):
+        self._calls = {}
+
+    async def do(self, key, func):
+        future = self._calls.get(key)
+        if future is not None:
+            return await asyncio.shield(future)
+        future = self._calls[key] = asyncio.get_running_loop().create_future()
+        result = None
+        try:
+            result = await func()
+        finally:
+            del self._calls[key]
+            future.set_result(result)
+        return result
+
+
+async_in_flight = AsyncSingleFlight()
+
+
+async def scrape_async(scrape, args, page_request, parse, parse_args):
+    """キャッシュ済みのスクレイピング関数と同じキャッシュを使い、非同期に取得・解析する"""
+    key = scrape.cache_key(*args)
+    value = response_cache.get(key)
+    if value is not None:
+        prefetcher.claim(key)
+        return value
+    stale = response_cache.get_stale(key)
+    if serve_stale(stale):
+        # Flaskルートのキャッシュ層が同じ期限切れの値を返し、取り直しを予約する
+        return stale[0]
+
+    async def fill():
+        stale = response_cache.get_stale(key)
+        exchange = {'request': stale[1] if stale else None, 'response': None, 'upstream_failed': False}
+        token = conditional_exchange.set(exchange)
+        type_token = fetch_page_type.set(scrape.page_type)
+        try:
+            content = await fetch_page_async(*page_request)
+        except NotModified:
+            response_cache.refresh(key, stale[0], CACHE_TTL[scrape.page_type], stale[1])
+            return stale[0]
+        finally:
+            fetch_page_type.reset(type_token)
+            conditional_exchange.reset(token)
+        if content is None:
+            return serve_on_error(key, stale) if stale and exchange['upstream_failed'] else None
+        loop = asyncio.get_running_loop()
+        executor = get_parse_process_pool() if PARSE_PROCESSES > 0 else parse_pool
+        start = time.perf_counter()
+        result = await loop.run_in_executor(executor, parse_in_context, parse, content, *parse_args)
+        observe_parse(parse, time.perf_counter() - start)
+        if result is not None:
+            response_cache.set(key, result, CACHE_TTL[scrape.page_type], exchange['response'])
+            index_scraped(scrape.page_type, tuple(args), result)
+        return result
+
+    return await async_in_flight.do(key, fill)
+
+
+def query_int(query, name, default):
+    """request.args.get(name, default, type=int) と同じ規則でクエリの整数値を取り出す"""
+    try:
+        return int(query[name][0])
+    except (KeyError, ValueError):
+        return default
+
+
+# JSON APIのルートと、同じスクレイピングを行うHTMLのルート
+API_ENDPOINTS = {'api_ranking': 'ranking', 'api_search': 'search', 'api_work': 'table_of_contents', 'api_episode': 'viewer'}
+
+def async_scrape_plan(endpoint, view_args, query):
+    """ルートが必要とするスクレイピングを scrape_async の引数として返す。不要ならNone"""
+    if endpoint == 'search' and query.get('mode', [None])[0] == 'local' and SEARCH_INDEX_PATH:
+        return None  # 取得済みの作品・本文から検索する（一致がなければルートがカクヨムで検索する）
+    endpoint = API_ENDPOINTS.get(endpoint, endpoint)
+    if endpoint == 'ranking':
+        genre, period = view_args['genre'], view_args['period']
+        if genre not in RANKING_GENRES or period not in RANKING_PERIODS:
+            return None
+        page = query_int(query, 'page', 1)
+        snapshots = get_ranking_snapshots()
+        if snapshots is not None and snapshots.latest(genre, period, page) is not None:
+            return None  # 定期取得したスナップショットをルートがそのまま使う
+        return (scrape_ranking_page, (genre, period, page),
+                ranking_page_request(genre, period, page), parse_ranking_page, (page,))
+    if endpoint == 'search':
+        if not query.get('q'):
+            return None
+        q, page = normalize_search_query(query['q'][0]), query_int(query, 'page', 1)
+        total = search_result_sets.total(q)
+        if total is not None and page > max(search_page_count(total), 1):
+            return None  # 最終ページより後のページは取得しない
+        return scrape_search_page, (q, page), search_page_request(q, page), parse_search_page, (page,)
+    if endpoint == 'table_of_contents':
+        work_id = view_args['work_id']
+        return scrape_toc_page, (work_id,), toc_page_request(work_id), parse_toc_page, (work_id,)
+    if endpoint == 'viewer':
+        work_id, episode_id = view_args['work_id'], view_args['episode_id']
+        return (scrape_viewer_page, (work_id, episode_id),
+                viewer_page_request(work_id, episode_id), parse_viewer_page, (work_id,))
+    return None
+
+
+def wsgi_environ(scope, body):
+    """ASGIのscopeからWSGIのenvironを組み立てる"""
+    server = scope.get('server') or ('localhost', 80)
+    environ = {
+        'REQUEST_METHOD': scope['method'],
+        'SCRIPT_NAME': scope.get('root_path', '').encode('utf-8').decode('latin-1'),
+        'PATH_INFO': scope['path'].encode('utf-8').decode('latin-1'),
+        'QUERY_STRING': scope['query_string'].decode('latin-1'),
+        'SERVER_NAME': server[0],
+        'SERVER_PORT': str(server[1]),
+        'SERVER_PROTOCOL': f"HTTP/{scope.get('http_version', '1.1')}",
+        'REMOTE_ADDR': scope['client'][0] if scope.get('client') else '',
+        'wsgi.version': (1, 0),
+        'wsgi.url_scheme': scope.get('scheme', 'http'),
+        'wsgi.input': io.BytesIO(body),
+        'wsgi.errors': sys.stderr,
+        'wsgi.multithread': True,
+        'wsgi.multiprocess': False,
+        'wsgi.run_once': False,
+    }
+    for raw_name, raw_value in scope['headers']:
+        name = raw_name.decode('latin-1').upper().replace('-', '_')
+        value = raw_value.decode('latin-1')
+        if name in ('CONTENT_TYPE', 'CONTENT_LENGTH'):
+            environ[name] = value
+            continue
+        key = f'HTTP_{name}'
+        environ[key] = f"{environ[key]},{value}" if key in environ else value
+    return environ
+
+
+async def call_flask(scope, body, send):
+    """Flaskアプリをスレッドで実行し、レスポンスをASGIで送信する"""
+    loop = asyncio.get_running_loop()
+    chunks = asyncio.Queue()
+    started = {'status': None, 'headers': []}
+
+    def start_response(status, headers, exc_info=None):
+        started['status'] = int(status.split(' ', 1)[0])
+        started['headers'] = [(k.lower().encode('latin-1'), v.encode('latin-1')) for k, v in headers]
+
+    def run():
+        # ストリーミングレスポンスもリクエストコンテキストと同じスレッドで最後まで読み出す
+        try:
+            iterable = app(wsgi_environ(scope, body), start_response)
+            try:
+                for chunk in iterable:
+                    loop.call_soon_threadsafe(chunks.put_nowait, chunk)
+            finally:
+                if hasattr(iterable, 'close'):
+                    iterable.close()
+        finally:
+            loop.call_soon_threadsafe(chunks.put_nowait, None)
+
+    worker = loop.run_in_executor(None, run)
+    chunk = await chunks.get()
+    if started['status'] is None:
+        # アプリが例外で終わるなどして、start_responseが呼ばれないまま本文が返された
+        await send({'type': 'http.response.start', 'status': 500,
+                    'headers': [(b'content-type', b'text/plain; charset=utf-8')]})
+        await send({'type': 'http.response.body', 'body': b'Internal Server Error'})
+        await worker
+        return
+    await send({'type': 'http.response.start', 'status': started['status'], 'headers': started['headers']})
+    while chunk is not None:
+        if chunk:
+            await send({'type': 'http.response.body', 'body': chunk, 'more_body': True})
+        chunk = await chunks.get()
+    await send({'type': 'http.response.body', 'body': b''})
+    await worker
+
+
+async def asgi_lifespan(receive, send):
+    """ASGIのlifespanイベントを処理する"""
+    global async_client
+    while True:
+        message = await receive()
+        if message['type'] == 'lifespan.startup':
+            await send({'type': 'lifespan.startup.complete'})
+        elif message['type'] == 'lifespan.shutdown':
+            if async_client is not None:
+                await async_client.aclose()
+                async_client = None
+            await send({'type': 'lifespan.shutdown.complete'})
+            return
+
+
+async def asgi_app(scope, receive, send):
+    """ASGIエントリーポイント"""
+    if scope['type'] == 'lifespan':
+        await asgi_lifespan(receive, send)
+        return
+    if scope['type'] != 'http':
+        return
+
+    body = b''
+    more_body = True
+    while more_body:
+        message = await receive()
+        body += message.get('body', b'')
+        more_body = message.get('more_body', False)
+
+    try:
+        adapter = app.url_map.bind('localhost', script_name=scope.get('root_path') or None)
+        endpoint, view_args = adapter.match(scope['path'], method=scope['method'])
+    except HTTPException:
+        endpoint, view_args = None, {}
+
+    plan = async_scrape_plan(endpoint, view_args, parse_qs(scope['query_string'].decode('latin-1')))
+    if plan is not None:
+        # 上流の取得を待つ間はスレッドを占有しない。失敗時もFlaskルートで再取得させず、ここでエラーを返す
+        if await scrape_async(*plan) is None:
+            message = FETCH_ERROR_MESSAGES[plan[0].page_type]
+            if endpoint in API_ENDPOINTS:
+                await send({'type': 'http.response.start', 'status': 502,
+                            'headers': [(b'content-type', b'application/json')]})
+                await send({'type': 'http.response.body', 'body': api_json({'error': message})})
+                return
+            html = await asyncio.to_thread(render_error_page, message)
+            await send({'type': 'http.response.start', 'status': 200,
+                        'headers': [(b'content-type', b'text/html; charset=utf-8')]})
+            await send({'type': 'http.response.body', 'body': html.encode('utf-8')})
+            return
+
+    await call_flask(scope, body, send)
+
+# ==============================================================================
+# --- 本番サーバー（プリフォーク） ---
+# ==============================================================================
+# python app.py serve で、待ち受けソケットを開いた親プロセスがSERVER_WORKERS個のワーカーをフォークし、
+# 各ワーカーはSERVER_THREADS本のスレッドでリクエストを処理する。ディスクキャッシュ・レート制限・
+# 取得中のページの表はSERVER_SHARED_DIRのファイルでワーカー間に共有する。
+
+class ServerRequestHandler(WSGIRequestHandler):
+    # 待機中の接続でスレッドを占有しないよう、応答ごとに接続を閉じる（接続の維持は前段のリバースプロキシで行う）
+    protocol_version = 'HTTP/1.0'
+
+
+class PooledWSGIServer(BaseWSGIServer):
+    """フォーク前に開いたソケットで待ち受け、固定数のスレッドでリクエストを処理するWSGIサーバー"""
+    multithread = True
+
+    def __init__(self, host, port, wsgi_app, threads, fd, multiprocess=False):
+        self.multiprocess = multiprocess
+        super().__init__(host, port, wsgi_app, handler=ServerRequestHandler, fd=fd)
+        # 複数のワーカーが同じソケットで待ち受けるため、先に受け付けられた接続を待たないようにする
+        self.socket.setblocking(False)
+        self.pool = ThreadPoolExecutor(max_workers=threads, thread_name_prefix='request')
+
+    def process_request(self, request, client_address):
+        self.pool.submit(self._process, request, client_address)
+
+    def _process(self, request, client_address):
+        try:
+            self.finish_request(request, client_address)
+        except Exception:
+            self.handle_error(request, client_address)
+        finally:
+            self.shutdown_request(request)
+
+
+def hot_work_ids(limit=WARM_START_WORKS):
+    """起動時に読み込む作品: ライブラリの作品と、保存済みのランキングの上位の作品（重複を除いた順）"""
+    work_ids = {}
+    if os.path.exists(os.path.join(DATA_DIR, LIBRARY_PATH)):
+        for work_id in get_library().work_ids():
+            work_ids.setdefault(work_id, None)
+    snapshots = get_ranking_snapshots()
+    if snapshots is not None:
+        for work_id in snapshots.work_ids():
+            work_ids.setdefault(work_id, None)
+    return list(work_ids)[:limit]
+
+def warm_start(limit=WARM_START_WORKS, max_bytes=WARM_START_MAX_BYTES):
+    """ディスクキャッシュから、ランキングとよく読まれる作品の目次・本文をメモリに読み込む: (読み込んだ件数, 描画した目次数)
+
+    上流には取得しない。期限切れの値も読み込み、期限切れ直後の即時応答や条件付きGETの再検証に使う。
+    有効期限内の目次は描画済みページのキャッシュにも入れておき、フォークしたワーカーはこれらを引き継ぐ。
+    """
+    work_ids = hot_work_ids(limit)
+    prefixes = ['ranking:']
+    for work_id in work_ids:
+        prefixes.append(scrape_toc_page.cache_key(work_id))
+        # 作品の全話のキーの共通部分（'episode:["<作品ID>", '）
+        prefixes.append(scrape_viewer_page.cache_key(work_id, '')[:-len('""]')])
+    loaded = response_cache.preload(prefixes, max_bytes)
+    rendered = 0
+    for work_id in work_ids:
+        # 期限切れの目次は描画しない（取り直しのスレッドをフォーク前に起動させない）
+        if not response_cache.contains(scrape_toc_page.cache_key(work_id)):
+            continue
+        with app.test_request_context(f'/novel/{work_id}'):
+            for _ in table_of_contents(work_id).response:
+                pass
+        rendered += 1
+    return loaded, rendered
+
+def close_databases():
+    """フォーク前に親プロセスで開いたSQLiteの接続を閉じる（ワーカーでは最初の使用時に開き直す）"""
+    global library, ranking_snapshots
+    response_cache.close()
+    for database in (library, ranking_snapshots):
+        if database is not None:
+            database.close()
+    library = ranking_snapshots = None
+
+def run_worker(sock, threads, index, multiprocess):
+    """ワーカーとしてリクエストを処理する（フォーク後の子プロセス、またはワーカー数1の場合は親プロセスで実行）"""
+    global RANKING_WARM_ENABLED
+    if index > 0:
+        RANKING_WARM_ENABLED = False  # ランキングの定期取得は最初のワーカーだけが行う
+    host, port = sock.getsockname()[:2]
+    server = PooledWSGIServer(host, port, app, threads, sock.fileno(), multiprocess)
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+
+def serve(host=SERVER_HOST, port=SERVER_PORT, workers=SERVER_WORKERS, threads=SERVER_THREADS,
+          shared_dir=SERVER_SHARED_DIR, cache_path=None, warm=True):
+    """本番用のサーバーを起動する（終了するまで戻らない）
+
+    ワーカーが異常終了した場合は同じ番号のワーカーを起動し直す。SIGTERM/SIGINTで全ワーカーを終了させる。
+    """
+    global response_cache, rate_limiter, in_flight, RATE_LIMIT_STATE_PATH
+    if workers > 1 and not hasattr(os, 'fork'):
+        print("os.fork is unavailable; starting a single worker")
+        workers = 1
+    if shared_dir:
+        os.makedirs(shared_dir, exist_ok=True)
+        cache_path = cache_path or CACHE_DISK_PATH or os.path.join(shared_dir, 'cache.sqlite')
+        RATE_LIMIT_STATE_PATH = RATE_LIMIT_STATE_PATH or os.path.join(shared_dir, 'rate_limit.json')
+        rate_limiter = create_rate_limiter()
+        in_flight = create_in_flight(os.path.join(shared_dir, 'in_flight'))
+    if cache_path and cache_path != response_cache.disk_path:
+        response_cache = ResponseCache(CACHE_MAX_BYTES, cache_path)
+
+    if warm:
+        start = time.monotonic()
+        loaded, rendered = warm_start()
+        print(f"warm start: loaded {loaded} cached pages and rendered {rendered} tables of contents "
+              f"in {time.monotonic() - start:.1f}s")
+    # 読み込みが終わってから待ち受けを始める
+    sock = socket.create_server((host, port), backlog=1024)
+    print(f"serving on http://{host}:{sock.getsockname()[1]}/ with {workers} workers x {threads} threads")
+    if workers == 1:
+        run_worker(sock, threads, 0, False)
+        return
+    close_databases()
+
+    children = {}  # pid -> ワーカー番号
+    stopping = False
+
+    def spawn(index):
+        pid = os.fork()
+        if pid == 0:
+            signal.signal(signal.SIGTERM, signal.SIG_DFL)
+            signal.signal(signal.SIGINT, signal.default_int_handler)
+            code = 0
+            try:
+                if response_cache.disk_path:
+                    response_cache.reopen()
+                run_worker(sock, threads, index, True)
+            except BaseException as e:
+                print(f"worker {index} failed: {e}")
+                code = 1
+            finally:
+                os._exit(code)
+        children[pid] = index
+
+    def stop(signum, frame):
+        nonlocal stopping
+        stopping = True
+        for pid in list(children):
+            try:
+                os.kill(pid, signal.SIGTERM)
+            except ProcessLookupError:
+                pass
+
+    for index in range(workers):
+        spawn(index)
+    signal.signal(signal.SIGTERM, stop)
+    signal.signal(signal.SIGINT, stop)
+    while children:
+        try:
+            pid, status = os.wait()
+        except ChildProcessError:
+            break
+        index = children.pop(pid, None)
+        if index is not None and not stopping:
+            print(f"worker {index} exited with status {status}; restarting")
+            spawn(index)
+    sock.close()
+
 # --- 実行 ---
 if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='軽量カクヨムリーダー（引数なしで開発用サーバーを、serve で本番用のサーバーを起動します）')
+    commands = parser.add_subparsers(dest='command')
+    export_parser = commands.add_parser('export', help='作品全体をEPUBまたはテキストとして保存する')
+    export_parser.add_argument('work_id', help='作品ID')
+    export_parser.add_argument('--format', choices=sorted(EXPORT_FORMATS), default='epub', help='出力形式')
+    export_parser.add_argument('-o', '--output', help='出力先のパス（省略時は <作品ID>.<形式>）')
+    export_parser.add_argument('--workers', type=int, default=EXPORT_WORKERS, help='本文を並行取得するスレッド数')
+    export_parser.add_argument('--cache', default=CACHE_DISK_PATH,
+                               help='ディスクキャッシュのパス。指定すると、再エクスポート時に変更のない話を再取得しない')
+    sync_parser = commands.add_parser('sync', help='ライブラリの作品の更新を確認し、新しい話だけを取得する')
+    sync_parser.add_argument('work_ids', nargs='*', help='追加・同期する作品ID（省略時は登録済みの全作品）')
+    sync_parser.add_argument('--library', help=f'ライブラリのデータベースのパス（省略時は {DATA_DIR} の {LIBRARY_PATH}）')
+    sync_parser.add_argument('--workers', type=int, default=EXPORT_WORKERS, help='本文を並行取得するスレッド数')
+    sync_parser.add_argument('--cache', default=CACHE_DISK_PATH, help='ディスクキャッシュのパス')
+    feed_parser = commands.add_parser('feed', help='複数作品の新着エピソードを取得する（作品ごとの結果を取得できた順に出力する）')
+    feed_parser.add_argument('work_ids', nargs='*', help='作品ID（省略時はライブラリの全作品）')
+    feed_parser.add_argument('--since', help=f'この日時以降に公開されたエピソードを新着とする（UNIX時刻またはISO 8601。省略時は{FEED_DEFAULT_DAYS}日前）')
+    feed_parser.add_argument('--library', help=f'ライブラリのデータベースのパス（省略時は {DATA_DIR} の {LIBRARY_PATH}）')
+    feed_parser.add_argument('--workers', type=int, default=FEED_WORKERS, help='目次を並行取得するスレッド数')
+    feed_parser.add_argument('--cache', default=CACHE_DISK_PATH, help='ディスクキャッシュのパス')
+    rankings_parser = commands.add_parser('rankings', help='全ジャンル×期間のランキングを取得してスナップショットを保存する（cron等での定期実行用）')
+    rankings_parser.add_argument('--pages', type=int, default=RANKING_WARM_PAGES, help='ジャンル×期間ごとに取得するページ数')
+    rankings_parser.add_argument('--snapshots', help=f'スナップショットのデータベースのパス（省略時は {DATA_DIR} の {RANKING_SNAPSHOT_PATH}）')
+    rankings_parser.add_argument('--cache', default=CACHE_DISK_PATH,
+                                 help='ディスクキャッシュのパス。指定すると、次回は変更のないページを条件付きGETで確認する')
+    serve_parser = commands.add_parser('serve', help='本番用のサーバーを起動する（ワーカープロセスをフォークし、状態を共有する）')
+    serve_parser.add_argument('--host', default=SERVER_HOST)
+    serve_parser.add_argument('--port', type=int, default=SERVER_PORT)
+    serve_parser.add_argument('--workers', type=int, default=SERVER_WORKERS, help='ワーカープロセス数')
+    serve_parser.add_argument('--threads', type=int, default=SERVER_THREADS, help='ワーカーごとのスレッド数')
+    serve_parser.add_argument('--shared-dir', default=SERVER_SHARED_DIR,
+                              help='ワーカー間で共有するキャッシュ・レート制限・取得中のページの表を置くディレクトリ')
+    serve_parser.add_argument('--cache', default=CACHE_DISK_PATH,
+                              help='ディスクキャッシュのパス（省略時は共有ディレクトリの cache.sqlite）')
+    serve_parser.add_argument('--no-warm', action='store_true', help='起動時にディスクキャッシュを読み込まない')
+    serve_parser.add_argument('--no-ranking-warm', action='store_true', help='ランキングを定期的に取得しない')
+    args = parser.parse_args()
+
+    if args.command == 'serve':
+        RANKING_WARM_ENABLED = not args.no_ranking_warm
+        serve(args.host, args.port, args.workers, args.threads, args.shared_dir, args.cache, not args.no_warm)
+        sys.exit(0)
+    if args.command and args.cache != CACHE_DISK_PATH:
+        response_cache = ResponseCache(CACHE_MAX_BYTES, args.cache)
+    if args.command == 'export':
+        sys.exit(export_command(args))
+    if args.command in ('sync', 'feed') and args.library:
+        LIBRARY_PATH = os.path.abspath(args.library)
+    if args.command == 'sync':
+        sys.exit(sync_command(args))
+    if args.command == 'feed':
+        sys.exit(feed_command(args))
+    if args.command == 'rankings':
+        if args.snapshots is not None:
+            RANKING_SNAPSHOT_PATH = os.path.abspath(args.snapshots) if args.snapshots else None
+        sys.exit(rankings_command(args))
     app.run(host='0.0.0.0', port=8000, debug=True)
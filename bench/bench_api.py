@@ -0,0 +1,93 @@
+"""JSON API(/api/v1)とHTMLのページについて、キャッシュ済みの状態での応答バイト数とサーバー側の処理時間を比較するベンチマーク
+
+使い方: python bench/bench_api.py
+（APIの応答を読み直した値がscrape_*の結果と一致することも確認する）
+"""
+import json
+import os
+import sys
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import app  # noqa: E402
+import fixtures  # noqa: E402
+import standin  # noqa: E402
+
+REPEAT = 20
+
+
+def cases():
+    """(項目名, HTMLのパス, APIのパス) の並び"""
+    work_id, episode_id = fixtures.EPISODE_WORK_ID, fixtures.EPISODE_ID
+    return [
+        ('ranking', '/ranking/all/daily', '/api/v1/ranking/all/daily'),
+        ('toc_large', f'/novel/{fixtures.LARGE_WORK_ID}?view=full', f'/api/v1/works/{fixtures.LARGE_WORK_ID}'),
+        ('toc_ndjson', f'/novel/{fixtures.LARGE_WORK_ID}?view=full',
+         f'/api/v1/works/{fixtures.LARGE_WORK_ID}?format=ndjson'),
+        ('toc_ids', f'/novel/{fixtures.LARGE_WORK_ID}?view=full',
+         f'/api/v1/works/{fixtures.LARGE_WORK_ID}?fields=episodes.episode_id'),
+        ('episode', f'/novel/{work_id}/{episode_id}', f'/api/v1/works/{work_id}/episodes/{episode_id}'),
+    ]
+
+
+def fetch(client, path):
+    """応答本文を読み切って、(秒数, バイト列)を返す"""
+    start = time.perf_counter()
+    response = client.get(path)
+    data = response.get_data()
+    elapsed = time.perf_counter() - start
+    response.close()
+    assert response.status_code == 200, (path, response.status_code)
+    return elapsed, data
+
+
+def best(client, path):
+    fetch(client, path)  # 初回（上流からの取得と描画済みページのキャッシュへの登録）を計測から除く
+    return min(fetch(client, path)[0] for _ in range(REPEAT)), fetch(client, path)[1]
+
+
+def golden(client):
+    """APIの応答がscrape_*の結果と同じ値であることを確認する"""
+    ranking = app.scrape_ranking_page('all', 'daily', 1)
+    data = json.loads(fetch(client, '/api/v1/ranking/all/daily')[1])
+    assert data['results'] == ranking['results'] and data['pagination'] == ranking['pagination']
+
+    novel = app.scrape_toc_page(fixtures.LARGE_WORK_ID)
+    data = json.loads(fetch(client, f'/api/v1/works/{fixtures.LARGE_WORK_ID}')[1])
+    assert data['episodes'] == [app.compact_json(item) for item in novel['episodes']]
+    lines = fetch(client, f'/api/v1/works/{fixtures.LARGE_WORK_ID}?format=ndjson')[1].splitlines()
+    assert [json.loads(line) for line in lines[1:]] == data['episodes']
+
+    work_id, episode_id = fixtures.EPISODE_WORK_ID, fixtures.EPISODE_ID
+    with app.app.test_request_context():
+        body, nav = app.scrape_viewer_page(work_id, episode_id)
+    data = json.loads(fetch(client, f'/api/v1/works/{work_id}/episodes/{episode_id}?fields=body,ruby_body')[1])
+    assert data['body'] == list(body['body'])
+    assert data['ruby_body'] == [json.loads(json.dumps(line)) for line in body['ruby_body']]
+    print(f"golden: ranking, {len(novel['episodes'])} TOC entries and episode body identical")
+
+
+def main():
+    upstream, upstream_url = standin.serve()
+    standin.point(app, upstream_url)
+    app.RATE_LIMIT_RATE = app.RATE_LIMIT_BURST = 10000
+    app.rate_limiter = app.create_rate_limiter()
+    app.PREFETCH_ENABLED = False
+    app.RANKING_WARM_ENABLED = False
+    app.RANKING_SNAPSHOT_PATH = None
+    app.SEARCH_INDEX_PATH = None
+    client = app.app.test_client()
+
+    golden(client)
+    print(f"{'page':>10} {'html(KB)':>9} {'api(KB)':>9} {'html(ms)':>9} {'api(ms)':>9}")
+    for name, html_path, api_path in cases():
+        html_time, html = best(client, html_path)
+        api_time, api = best(client, api_path)
+        print(f"{name:>10} {len(html) / 1024:>9.1f} {len(api) / 1024:>9.1f} "
+              f"{html_time * 1000:>9.2f} {api_time * 1000:>9.2f}")
+    upstream.shutdown()
+
+
+if __name__ == '__main__':
+    main()
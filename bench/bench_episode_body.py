@@ -0,0 +1,51 @@
+"""本文抽出（1回走査のEpisodePageParserと従来のBeautifulSoup経路）のベンチマーク
+
+使い方: python bench/bench_episode_body.py
+（出力が従来の実装と一致することは tests/test_episode_parser.py で確認する）
+"""
+import os
+import sys
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import app  # noqa: E402
+import fixtures  # noqa: E402
+from legacy import legacy_parse_episode  # noqa: E402
+
+WORK_ID = '1177354054880000000'
+RUBY_COUNTS = [1, 4, 16]  # 1段落あたりのルビ数
+REPEAT = 3
+
+
+def stream_parse(content):
+    """EpisodePageParserによる(タイトル, サブタイトル, 本文, 前, 次)"""
+    page = app.EpisodePageParser.parse(content)
+    body_lines = ([app.format_body_line(line) for line in page.body_lines if line]
+                  if page.body_lines is not None else ['本文が取得できませんでした。'])
+    return (page.title if page.title is not None else '作品タイトル不明',
+            page.subtitle if page.subtitle is not None else 'サブタイトル不明',
+            body_lines, page.prev_href, page.next_href)
+
+
+def best_of(func, content):
+    best = float('inf')
+    for _ in range(REPEAT):
+        start = time.perf_counter()
+        func(content)
+        best = min(best, time.perf_counter() - start)
+    return best
+
+
+def main():
+    print(f"{'ruby/p':>6} {'size(KB)':>9} {'soup(ms)':>9} {'stream(ms)':>10} {'speedup':>8}")
+    for ruby_count in RUBY_COUNTS:
+        content = fixtures.episode_page(WORK_ID, '1000', ruby_per_paragraph=ruby_count, seed=ruby_count)
+        soup_time = best_of(legacy_parse_episode, content)
+        stream_time = best_of(stream_parse, content)
+        print(f"{ruby_count:>6} {len(content) / 1024:>9.0f} {soup_time * 1000:>9.1f} "
+              f"{stream_time * 1000:>10.1f} {soup_time / stream_time:>7.1f}x")
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,50 @@
+"""ランキング・検索結果ページの解析（要素を1回走査する実装と従来のselect/find_parentによる実装）のベンチマーク
+
+使い方: python bench/bench_listing.py
+（bench/recorded/ に保存したページがあればそれを、なければ生成したページを使う。lxmlがあればパーサーごとに計測する。
+出力が従来の実装と一致することは tests/test_listing_parser.py で確認する）
+"""
+import os
+import sys
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import app  # noqa: E402
+import fixtures  # noqa: E402
+from legacy import legacy_parse_ranking, legacy_parse_search  # noqa: E402
+
+REPEAT = 20
+
+
+def pages():
+    """(ページ種別, HTML) の並び。保存したページ、なければ生成したページ"""
+    return [('ranking', fixtures.page_for('/rankings/all/daily', 1)),
+            ('search', fixtures.page_for('/search', 1, query=fixtures.SEARCH_QUERY))]
+
+
+def best(func, *args):
+    timings = []
+    for _ in range(REPEAT):
+        start = time.perf_counter()
+        func(*args)
+        timings.append(time.perf_counter() - start)
+    return min(timings)
+
+
+def main():
+    parsers = {'ranking': (legacy_parse_ranking, app.parse_ranking_page),
+               'search': (legacy_parse_search, app.parse_search_page)}
+    html_parsers = ['lxml', 'html.parser'] if app.lxml else ['html.parser']
+    print(f"{'parser':>12} {'page':>8} {'size(KB)':>9} {'legacy(ms)':>11} {'walk(ms)':>9} {'speedup':>8}")
+    for html_parser in html_parsers:
+        app.HTML_PARSER = html_parser
+        for kind, content in pages():
+            legacy, current = parsers[kind]
+            before, after = best(legacy, content, 1), best(current, content, 1)
+            print(f"{html_parser:>12} {kind:>8} {len(content) / 1024:>9.0f} {before * 1000:>11.2f} "
+                  f"{after * 1000:>9.2f} {before / after:>7.1f}x")
+
+
+if __name__ == '__main__':
+    main()
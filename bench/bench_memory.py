@@ -0,0 +1,92 @@
+"""解析結果（目次・本文）の保持に必要なメモリを、従来の辞書・リストの表現と列ごとの表現で比較するベンチマーク
+
+使い方: python bench/bench_memory.py
+（保持するバイト数はtracemallocで、キャッシュの使用量として数えるバイト数はpickleの大きさで計測する）
+"""
+import gc
+import os
+import pickle
+import sys
+import tracemalloc
+import zlib
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import app  # noqa: E402
+import fixtures  # noqa: E402
+
+WORK_ID = '1177354054880000000'
+EPISODES = 5000
+BODY_PAGES = 20
+
+
+def retained(func):
+    """funcの戻り値を保持するために確保したままのバイト数を返す: (戻り値, バイト数)"""
+    gc.collect()
+    tracemalloc.start()
+    before = tracemalloc.get_traced_memory()[0]
+    value = func()
+    gc.collect()
+    size = tracemalloc.get_traced_memory()[0] - before
+    tracemalloc.stop()
+    return value, size
+
+
+def legacy(func):
+    """列ごとの表現を使わない（従来の辞書・リストのままの）解析結果を返す"""
+    saved = app.EpisodeList, app.BodyLines, app.RubyLines
+    app.EpisodeList = app.BodyLines = app.RubyLines = list
+    try:
+        return func()
+    finally:
+        app.EpisodeList, app.BodyLines, app.RubyLines = saved
+
+
+def parse_bodies(pages):
+    with app.app.test_request_context():
+        return [app.parse_viewer_page(content, WORK_ID)[0] for content in pages]
+
+
+def cache_bytes(value):
+    """キャッシュの使用量として数えるバイト数: (pickle, zlib圧縮後)"""
+    blob = pickle.dumps(value, protocol=pickle.HIGHEST_PROTOCOL)
+    return len(blob), len(zlib.compress(blob, app.CACHE_COMPRESS_LEVEL))
+
+
+def report(label, count, old, new):
+    print(f"{label:>12} {old[0] / count:>10.0f} {new[0] / count:>10.0f} "
+          f"{old[1] / count:>10.0f} {new[1] / count:>10.0f} {new[2] / count:>10.0f}")
+
+
+def main():
+    toc_content = fixtures.toc_page(WORK_ID, episodes=EPISODES)
+    old_toc, old_toc_size = retained(lambda: legacy(lambda: app.parse_toc_page(toc_content, WORK_ID)))
+    new_toc, new_toc_size = retained(lambda: app.parse_toc_page(toc_content, WORK_ID))
+    # 出力一致の確認: 各項目の値と、目次ページの描画結果
+    assert len(old_toc['episodes']) == len(new_toc['episodes'])
+    for old, new in zip(old_toc['episodes'], new_toc['episodes']):
+        assert all(new[name] == old.get(name) for name in app.TocEntry.__slots__), (old, new)
+    with app.app.test_request_context(f'/novel/{WORK_ID}'):
+        assert (app.render_template('toc.html', novel=old_toc, collapsible=False)
+                == app.render_template('toc.html', novel=new_toc, collapsible=False))
+
+    pages = [fixtures.episode_page(WORK_ID, str(1000 + i), ruby_per_paragraph=i % 5, seed=i) for i in range(BODY_PAGES)]
+    old_bodies, old_body_size = retained(lambda: legacy(lambda: parse_bodies(pages)))
+    new_bodies, new_body_size = retained(lambda: parse_bodies(pages))
+    for old, new in zip(old_bodies, new_bodies):
+        assert list(new['body']) == old['body'] and list(new['ruby_body']) == old['ruby_body']
+        assert app.export_line_segments(new) == app.export_line_segments(old)
+    print(f"golden: {EPISODES} TOC entries and {BODY_PAGES} episode bodies identical")
+
+    toc_count = sum(not item['is_chapter'] for item in new_toc['episodes'])
+    print(f"{'bytes per':>12} {'resident':>10} {'resident':>10} {'pickled':>10} {'pickled':>10} {'zlib':>10}")
+    print(f"{'episode':>12} {'(before)':>10} {'(after)':>10} {'(before)':>10} {'(after)':>10} {'(after)':>10}")
+    report('TOC entry', toc_count, (old_toc_size, cache_bytes(old_toc)[0]),
+           (new_toc_size, *cache_bytes(new_toc)))
+    report('body', BODY_PAGES, (old_body_size, sum(cache_bytes(body)[0] for body in old_bodies)),
+           (new_body_size, sum(cache_bytes(body)[0] for body in new_bodies),
+            sum(cache_bytes(body)[1] for body in new_bodies)))
+
+
+if __name__ == '__main__':
+    main()
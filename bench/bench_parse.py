@@ -0,0 +1,53 @@
+"""本文ページ解析のスループット（ページ/秒）を、解析プロセス数ごとに計測するベンチマーク
+
+使い方: python bench/bench_parse.py
+（本文ページはHTML_PARSERの設定によらずEpisodePageParserで解析するため、パーサー別には計測しない）
+"""
+import os
+import sys
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import app  # noqa: E402
+import fixtures  # noqa: E402
+
+WORK_ID = '1177354054880000000'
+PAGES = 16
+CONCURRENCY = 8  # 同時にリクエストを処理するスレッド数
+
+
+def run(pages):
+    """CONCURRENCY本のスレッドから app.run_parse を呼び、ページ/秒を返す"""
+    def parse(content):
+        with app.app.test_request_context():
+            return app.run_parse(app.parse_viewer_page, content, WORK_ID)
+
+    start = time.perf_counter()
+    with ThreadPoolExecutor(CONCURRENCY) as executor:
+        list(executor.map(parse, pages))
+    return len(pages) / (time.perf_counter() - start)
+
+
+def main():
+    pages = [fixtures.episode_page(WORK_ID, str(1000 + i), seed=i) for i in range(PAGES)]
+    worker_counts = sorted({0, 1, 2, 4, os.cpu_count() or 1})
+    print(f"CPU: {os.cpu_count()}  pages: {PAGES}  concurrency: {CONCURRENCY}")
+    print(f"{'processes':>9} {'pages/sec':>10}")
+    for workers in worker_counts:
+        app.PARSE_PROCESSES = workers
+        app.parse_process_pool = None
+        if workers:
+            # プロセス起動時間を計測に含めないよう、先に全ワーカーを温める
+            pool = app.get_parse_process_pool()
+            list(pool.map(app.init_parse_worker, [app.HTML_PARSER] * workers))
+        rate = run(pages)
+        if workers:
+            app.parse_process_pool.shutdown()
+        label = workers if workers else 'inline'
+        print(f"{label:>9} {rate:>10.1f}")
+
+
+if __name__ == '__main__':
+    main()
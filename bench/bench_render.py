@@ -0,0 +1,67 @@
+"""大きな目次ページの描画について、最初の1バイトまでの時間(TTFB)と描画中のピークメモリを描画方式ごとに計測するベンチマーク
+
+使い方: python bench/bench_render.py
+（cachedは描画済みページのキャッシュにある場合。ブラウザがETagを送る場合は、これに代わって本文なしの304になる）
+（ピークメモリは、解放済み領域の再利用で増分が見えにくいRSSの代わりにtracemallocで計測する）
+"""
+import os
+import sys
+import time
+import tracemalloc
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import app  # noqa: E402
+import fixtures  # noqa: E402
+from flask import render_template_string  # noqa: E402
+
+WORK_ID = '1177354054880000000'
+EPISODES = 5000
+MODES = {
+    'string': '毎回テンプレート文字列から描画（従来）',
+    'compiled': '登録済みテンプレートで一括描画',
+    'stream': '登録済みテンプレートでストリーミング描画（キャッシュにない場合のルート）',
+    'cached': '描画済みページのキャッシュから送信（2回目以降のルート）',
+}
+
+
+def render(mode, novel):
+    """目次ページを描画して送信したものとして、(TTFB, 全体の時間, バイト数)を返す"""
+    size = 0
+    ttfb = None
+    with app.app.test_request_context(f'/novel/{WORK_ID}'):
+        start = time.perf_counter()
+        if mode == 'string':
+            chunks = [render_template_string(app.TOC_TEMPLATE, novel=novel)]
+        elif mode == 'compiled':
+            chunks = [app.render_template('toc.html', novel=novel)]
+        elif mode == 'stream':
+            chunks = app.stream_page('toc.html', novel=novel, sections=None, current=0, collapsible=False).response
+        else:
+            chunks = app.table_of_contents(WORK_ID).response
+        for chunk in chunks:
+            if ttfb is None:
+                ttfb = time.perf_counter() - start
+            # ソケットへの書き込みの代わりにエンコードして捨てる
+            size += len(chunk.encode('utf-8') if isinstance(chunk, str) else chunk)
+        return ttfb, time.perf_counter() - start, size
+
+
+def main():
+    novel = app.parse_toc_page(fixtures.toc_page(WORK_ID, episodes=EPISODES), WORK_ID)
+    app.response_cache.set(app.scrape_toc_page.cache_key(WORK_ID), novel, 3600)
+    app.TOC_COLLAPSE_THRESHOLD = len(novel['episodes'])  # 全件表示のページで比較する
+    print(f"TOC episodes: {EPISODES}")
+    print(f"{'mode':>9} {'size(KB)':>9} {'ttfb(ms)':>9} {'total(ms)':>10} {'peak(KB)':>9}")
+    for mode, description in MODES.items():
+        render(mode, novel)  # 初回のテンプレートのコンパイルを計測から除く
+        ttfb, total, size = render(mode, novel)
+        tracemalloc.start()
+        render(mode, novel)
+        peak = tracemalloc.get_traced_memory()[1]
+        tracemalloc.stop()
+        print(f"{mode:>9} {size / 1024:>9.0f} {ttfb * 1000:>9.1f} {total * 1000:>10.1f} {peak / 1024:>9.0f}  {description}")
+
+
+if __name__ == '__main__':
+    main()
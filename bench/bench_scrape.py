@@ -0,0 +1,193 @@
+"""scrape_*ごとの解析時間と、代替サーバーを相手にしたルートのレイテンシ・同時アクセス時のスループットを計測するベンチマーク
+
+使い方: python bench/bench_scrape.py [--check] [--json 結果.json]
+（--checkを付けると bench/thresholds.json の閾値と比べ、超えた項目があれば終了コード1で終わる。
+  --jsonで結果を保存しておくと、リリースごとの推移を追える）
+"""
+import argparse
+import json
+import os
+import random
+import sys
+import threading
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import app  # noqa: E402
+import fixtures  # noqa: E402
+import requests  # noqa: E402
+import standin  # noqa: E402
+from werkzeug.serving import WSGIRequestHandler, make_server  # noqa: E402
+
+REPEAT = 5
+UPSTREAM_LATENCY = 0.02  # 代替サーバーの応答時間（秒）
+CONCURRENCY = [1, 4, 16]
+LOAD_REQUESTS = 400  # 同時アクセスの計測1回あたりのリクエスト数
+THRESHOLDS_PATH = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'thresholds.json')
+
+
+class QuietRequestHandler(WSGIRequestHandler):
+    def log_request(self, *args):
+        pass
+
+
+def parse_cases():
+    """(項目名, scrape関数名, 解析関数, ページ, 解析関数の引数) の並び"""
+    path = lambda *parts: '/' + '/'.join(parts)  # noqa: E731
+    return [
+        ('ranking', 'scrape_ranking_page', app.parse_ranking_page,
+         fixtures.page_for(path('rankings', 'all', 'daily')), (1,)),
+        ('search', 'scrape_search_page', app.parse_search_page,
+         fixtures.page_for(path('search'), query=fixtures.SEARCH_QUERY), (1,)),
+        ('toc_small', 'scrape_toc_page', app.parse_toc_page,
+         fixtures.page_for(path('works', fixtures.SMALL_WORK_ID)), (fixtures.SMALL_WORK_ID,)),
+        ('toc_large', 'scrape_toc_page', app.parse_toc_page,
+         fixtures.page_for(path('works', fixtures.LARGE_WORK_ID)), (fixtures.LARGE_WORK_ID,)),
+        ('episode', 'scrape_viewer_page', app.parse_viewer_page,
+         fixtures.page_for(path('works', fixtures.EPISODE_WORK_ID, 'episodes', fixtures.EPISODE_ID)),
+         (fixtures.EPISODE_WORK_ID,)),
+    ]
+
+
+def bench_parse(results):
+    print(f"{'page':>10} {'function':>20} {'size(KB)':>9} {'parse(ms)':>10}")
+    for name, function, parse, content, args in parse_cases():
+        best = float('inf')
+        with app.app.test_request_context():
+            assert parse(content, *args), name
+            for _ in range(REPEAT):
+                start = time.perf_counter()
+                parse(content, *args)
+                best = min(best, time.perf_counter() - start)
+        results[f'parse_ms.{name}'] = best * 1000
+        print(f"{name:>10} {function:>20} {len(content) / 1024:>9.0f} {best * 1000:>10.1f}")
+
+
+def route_paths():
+    """計測するルート: {項目名: パス}"""
+    return {
+        'ranking': '/ranking/all/daily',
+        'search': f'/search?q={fixtures.SEARCH_QUERY}',
+        'toc_small': f'/novel/{fixtures.SMALL_WORK_ID}',
+        'toc_large': f'/novel/{fixtures.LARGE_WORK_ID}',
+        'episode': f'/novel/{fixtures.EPISODE_WORK_ID}/{fixtures.EPISODE_ID}',
+    }
+
+
+def percentile(values, fraction):
+    values = sorted(values)
+    return values[min(int(len(values) * fraction), len(values) - 1)]
+
+
+def load(base_url, paths, concurrency):
+    """concurrency本のスレッドから合計LOAD_REQUESTS回リクエストし、(リクエスト/秒, 各リクエストの秒数)を返す"""
+    latencies = []
+    lock = threading.Lock()
+    remaining = [LOAD_REQUESTS]
+
+    def client(seed):
+        rnd = random.Random(seed)
+        session = requests.Session()
+        while True:
+            with lock:
+                if remaining[0] == 0:
+                    return
+                remaining[0] -= 1
+            start = time.perf_counter()
+            response = session.get(base_url + rnd.choice(paths).lstrip('/'))
+            elapsed = time.perf_counter() - start
+            assert response.status_code == 200, response.status_code
+            with lock:
+                latencies.append(elapsed)
+
+    threads = [threading.Thread(target=client, args=(seed,)) for seed in range(concurrency)]
+    start = time.perf_counter()
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    return LOAD_REQUESTS / (time.perf_counter() - start), latencies
+
+
+def bench_routes(results):
+    upstream, upstream_url = standin.serve(latency=UPSTREAM_LATENCY)
+    standin.point(app, upstream_url)
+    app.RATE_LIMIT_RATE = app.RATE_LIMIT_BURST = 10000
+    app.rate_limiter = app.create_rate_limiter()
+    app.PREFETCH_ENABLED = False
+    app.RANKING_WARM_ENABLED = False
+    app.RANKING_SNAPSHOT_PATH = None
+    app.SEARCH_INDEX_PATH = None
+    server = make_server('127.0.0.1', 0, app.app, threaded=True, request_handler=QuietRequestHandler)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    base_url = f'http://127.0.0.1:{server.server_port}/'
+
+    # 初回（上流から取得・解析する）と2回目（キャッシュ済み）のレイテンシ
+    print(f"upstream latency: {UPSTREAM_LATENCY * 1000:.0f} ms")
+    print(f"{'route':>10} {'cold(ms)':>9} {'warm(ms)':>9}")
+    session = requests.Session()
+    for name, path in route_paths().items():
+        timings = []
+        for _ in range(2):
+            start = time.perf_counter()
+            assert session.get(base_url + path.lstrip('/')).status_code == 200, path
+            timings.append(time.perf_counter() - start)
+        results[f'cold_ms.{name}'] = timings[0] * 1000
+        results[f'warm_ms.{name}'] = timings[1] * 1000
+        print(f"{name:>10} {timings[0] * 1000:>9.1f} {timings[1] * 1000:>9.1f}")
+
+    # 同時アクセス: 各ルートに加え、小さい作品の全話（初回は上流から取得）を混ぜる
+    toc = app.scrape_toc_page(fixtures.SMALL_WORK_ID)
+    paths = list(route_paths().values()) + [f'/novel/{fixtures.SMALL_WORK_ID}/{item["episode_id"]}'
+                                            for item in toc['episodes'] if not item['is_chapter']]
+    print(f"{'clients':>10} {'req/sec':>9} {'p50(ms)':>9} {'p95(ms)':>9}")
+    for concurrency in CONCURRENCY:
+        rate, latencies = load(base_url, paths, concurrency)
+        results[f'rps.c{concurrency}'] = rate
+        results[f'p95_ms.c{concurrency}'] = percentile(latencies, 0.95) * 1000
+        print(f"{concurrency:>10} {rate:>9.1f} {percentile(latencies, 0.5) * 1000:>9.1f} "
+              f"{percentile(latencies, 0.95) * 1000:>9.1f}")
+    server.shutdown()
+    upstream.shutdown()
+
+
+def check(results):
+    """閾値と比べ、超えた項目の説明のリストを返す"""
+    with open(THRESHOLDS_PATH, encoding='utf-8') as f:
+        thresholds = json.load(f)
+    failures = []
+    for name, limit in thresholds['max'].items():
+        if name in results and results[name] > limit:
+            failures.append(f"{name}: {results[name]:.1f} > {limit}")
+    for name, limit in thresholds['min'].items():
+        if name in results and results[name] < limit:
+            failures.append(f"{name}: {results[name]:.1f} < {limit}")
+    return failures
+
+
+def main():
+    parser = argparse.ArgumentParser(description='スクレイピングとルートのベンチマーク')
+    parser.add_argument('--check', action='store_true', help='bench/thresholds.jsonの閾値と比較する')
+    parser.add_argument('--json', help='結果を保存するパス')
+    args = parser.parse_args()
+
+    recorded = os.path.exists(os.path.join(fixtures.RECORDED_DIR, 'ids.json'))
+    print(f"fixtures: {'recorded' if recorded else 'generated'}  CPU: {os.cpu_count()}")
+    results = {}
+    bench_parse(results)
+    bench_routes(results)
+    if args.json:
+        with open(args.json, 'w', encoding='utf-8') as f:
+            json.dump(results, f, indent=2, sort_keys=True)
+    if args.check:
+        failures = check(results)
+        for failure in failures:
+            print(f"FAIL {failure}")
+        if failures:
+            sys.exit(1)
+        print("all thresholds passed")
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,59 @@
+"""カクヨムの検索について、検索語の正規化と件数による最終ページの判定で上流への取得が何回減るかを計測するベンチマーク
+
+使い方: python bench/bench_search.py
+（件数が1ページの件数の倍数の場合に、空のページを取得しに行かないことも確認する）
+"""
+import os
+import sys
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import app  # noqa: E402
+import fixtures  # noqa: E402
+import standin  # noqa: E402
+
+# 同じ検索語の表記の揺れ（全角・半角、英字の大小、空白）
+QUERY_VARIANTS = ['Isekai 転生', 'ＩＳＥＫＡＩ　転生', 'isekai  転生', ' ISEKAI 転生 ']
+TOTALS = (40, 45, 7)  # 1ページの件数の倍数・倍数でない・1ページに収まる件数
+
+
+def session(total):
+    """1ページ目から「次のページ」をたどり、続けて各表記・各ページを検索したときの上流への取得数を返す"""
+    fixtures.SEARCH_TOTAL = total
+    standin.cached_page.cache_clear()
+    app.response_cache = app.ResponseCache(app.CACHE_MAX_BYTES)
+    app.search_result_sets = app.SearchResultSets(app.SEARCH_RESULT_SETS_MAX)
+    before = standin.StandInHandler.requests
+    page = 1
+    while page:
+        data = app.search_results(QUERY_VARIANTS[0], page)
+        assert len(data['results']) == min(app.SEARCH_PER_PAGE, total - (page - 1) * app.SEARCH_PER_PAGE)
+        page = data['pagination']['next']
+    pages = app.search_page_count(total)
+    for query in QUERY_VARIANTS:
+        for page in range(1, pages + 3):
+            data = app.search_results(query, page)
+            assert data['results'] or page > pages, (query, page)
+    return standin.StandInHandler.requests - before, pages
+
+
+def main():
+    upstream, upstream_url = standin.serve()
+    standin.point(app, upstream_url)
+    app.RATE_LIMIT_RATE = app.RATE_LIMIT_BURST = 10000
+    app.rate_limiter = app.create_rate_limiter()
+    app.PREFETCH_ENABLED = False
+    app.SEARCH_INDEX_PATH = None
+
+    print(f"{'total':>6} {'pages':>6} {'requests':>9} {'fetched':>8} {'hit rate':>9}")
+    for total in TOTALS:
+        fetched, pages = session(total)
+        # 正規化した検索語ごとに、結果のあるページだけを1回ずつ取得する
+        assert fetched == pages, f"total {total}: {fetched} upstream fetches for {pages} pages"
+        stats = app.search_result_sets.stats()
+        print(f"{total:>6} {pages:>6} {stats['queries']:>9} {fetched:>8} {stats['hit_rate']:>9.2f}")
+    upstream.shutdown()
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,40 @@
+"""目次ページの__NEXT_DATA__抽出（高速経路とBeautifulSoup経路）を比較するベンチマーク
+
+使い方: python bench/bench_toc.py
+"""
+import os
+import sys
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import app  # noqa: E402
+import fixtures  # noqa: E402
+
+SIZES = [100, 1000, 5000]
+REPEAT = 5
+
+
+def best_of(func, content):
+    best = float('inf')
+    for _ in range(REPEAT):
+        start = time.perf_counter()
+        func(content)
+        best = min(best, time.perf_counter() - start)
+    return best
+
+
+def main():
+    print(f"JSON decoder: {'orjson' if app.orjson else 'json'}")
+    print(f"{'episodes':>8} {'size(KB)':>9} {'soup(ms)':>9} {'fast(ms)':>9} {'speedup':>8}")
+    for size in SIZES:
+        content = fixtures.toc_page('1177354054880000000', episodes=size)
+        assert app.extract_next_data(content) == app.extract_next_data_from_soup(content)
+        soup_time = best_of(app.extract_next_data_from_soup, content)
+        fast_time = best_of(app.extract_next_data, content)
+        print(f"{size:>8} {len(content) / 1024:>9.0f} {soup_time * 1000:>9.1f} "
+              f"{fast_time * 1000:>9.1f} {soup_time / fast_time:>7.0f}x")
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,154 @@
+"""本番サーバー（python app.py serve）のワーカー数ごとのスループットと、ワーカー間の状態共有・ウォームスタートを計測するベンチマーク
+
+使い方: python bench/bench_workers.py [--workers 1 2 4] [--threads 8]
+（ワーカー数の既定は1からCPU数まで。代替サーバーを相手に、ワーカー数ごとにサーバーを起動し直して計測する）
+"""
+import argparse
+import os
+import signal
+import socket
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import app  # noqa: E402
+import bench_scrape  # noqa: E402
+import fixtures  # noqa: E402
+import requests  # noqa: E402
+import standin  # noqa: E402
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+UPSTREAM_LATENCY = 0.02
+CONCURRENCY = 16
+COALESCE_CLIENTS = 16  # 同じ未取得のページに同時にアクセスするクライアント数
+# サーバーのプロセスで実行するコード（ベンチマーク用に上流へのレート制限と裏での取得を無効にする）
+LAUNCH = '''
+import sys
+sys.path.insert(0, {root!r})
+import app
+app.RATE_LIMIT_RATE = app.RATE_LIMIT_BURST = 10000
+app.PREFETCH_ENABLED = False
+app.RANKING_WARM_ENABLED = False
+app.SEARCH_INDEX_PATH = None
+app.DATA_DIR = {data_dir!r}
+app.serve('127.0.0.1', {port}, {workers}, {threads}, {shared_dir!r}, warm={warm})
+'''
+
+
+def free_port():
+    with socket.socket() as sock:
+        sock.bind(('127.0.0.1', 0))
+        return sock.getsockname()[1]
+
+
+def start_server(upstream_url, workers, threads, shared_dir, warm=True):
+    """サーバーを起動し、応答するようになるまで待って (プロセス, ベースURL) を返す"""
+    port = free_port()
+    code = LAUNCH.format(root=ROOT, port=port, workers=workers, threads=threads, shared_dir=shared_dir,
+                         data_dir=os.path.dirname(shared_dir), warm=warm)
+    process = subprocess.Popen([sys.executable, '-c', code], cwd=os.path.dirname(shared_dir),
+                               env=dict(os.environ, KAKUYOMU_BASE_URL=upstream_url),
+                               stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+    base_url = f'http://127.0.0.1:{port}/'
+    deadline = time.monotonic() + 30
+    while time.monotonic() < deadline:
+        try:
+            if requests.get(base_url, timeout=1).status_code == 200:
+                return process, base_url
+        except requests.ConnectionError:
+            time.sleep(0.1)
+    process.kill()
+    sys.exit("server did not start")
+
+
+def stop_server(process):
+    process.send_signal(signal.SIGTERM)
+    process.wait(timeout=10)
+
+
+def upstream_fetches(func):
+    """funcの実行中に代替サーバーが受けたリクエスト数"""
+    before = standin.StandInHandler.requests
+    func()
+    return standin.StandInHandler.requests - before
+
+
+def concurrent_get(url, clients):
+    """同じURLに同時にリクエストする"""
+    barrier = threading.Barrier(clients)
+
+    def client():
+        barrier.wait()
+        assert requests.get(url).status_code == 200
+
+    threads = [threading.Thread(target=client) for _ in range(clients)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+
+
+def timed_get(url):
+    start = time.perf_counter()
+    assert requests.get(url).status_code == 200
+    return time.perf_counter() - start
+
+
+def main():
+    parser = argparse.ArgumentParser(description='本番サーバーのワーカー数ごとのベンチマーク')
+    parser.add_argument('--workers', type=int, nargs='+', default=list(range(1, (os.cpu_count() or 1) + 1)))
+    parser.add_argument('--threads', type=int, default=app.SERVER_THREADS)
+    args = parser.parse_args()
+
+    upstream, upstream_url = standin.serve(latency=UPSTREAM_LATENCY)
+    paths = list(bench_scrape.route_paths().values())
+    print(f"CPU: {os.cpu_count()}  upstream latency: {UPSTREAM_LATENCY * 1000:.0f} ms  clients: {CONCURRENCY}")
+    print(f"{'workers':>8} {'coalesced':>10} {'req/sec':>9} {'p50(ms)':>9} {'p95(ms)':>9}")
+    with tempfile.TemporaryDirectory() as tmp:
+        for workers in args.workers:
+            shared_dir = os.path.join(tmp, f'w{workers}', 'shared')
+            os.makedirs(shared_dir)
+            process, base_url = start_server(upstream_url, workers, args.threads, shared_dir)
+            try:
+                # 未取得の同じページへの同時アクセスは、ワーカーをまたいでも上流への取得1回にまとまる
+                cold = f'{base_url}novel/{int(fixtures.SMALL_WORK_ID) + 100 + workers}'
+                fetched = upstream_fetches(lambda: concurrent_get(cold, COALESCE_CLIENTS))
+                assert fetched == 1, f"{COALESCE_CLIENTS} concurrent requests caused {fetched} upstream fetches"
+                for path in paths:
+                    requests.get(base_url + path.lstrip('/'))
+                rate, latencies = bench_scrape.load(base_url, paths, CONCURRENCY)
+            finally:
+                stop_server(process)
+            print(f"{workers:>8} {f'{COALESCE_CLIENTS}->{fetched}':>10} {rate:>9.1f} "
+                  f"{bench_scrape.percentile(latencies, 0.5) * 1000:>9.1f} "
+                  f"{bench_scrape.percentile(latencies, 0.95) * 1000:>9.1f}")
+
+        # ウォームスタート: ライブラリの作品の目次を、再起動後の最初のリクエストの前にメモリへ読み込む
+        shared_dir = os.path.join(tmp, 'restart', 'shared')
+        os.makedirs(shared_dir)
+        app.Library(os.path.join(os.path.dirname(shared_dir), app.LIBRARY_PATH)).add(fixtures.LARGE_WORK_ID)
+        url_path = f'novel/{fixtures.LARGE_WORK_ID}'
+        workers = max(args.workers)
+        process, base_url = start_server(upstream_url, workers, args.threads, shared_dir)
+        timed_get(base_url + url_path)
+        stop_server(process)
+        print(f"restart with {workers} workers: first {url_path}")
+        for warm in (False, True):
+            process, base_url = start_server(upstream_url, workers, args.threads, shared_dir, warm)
+            try:
+                fetched = upstream_fetches(lambda: timings.append(timed_get(base_url + url_path)))
+            finally:
+                stop_server(process)
+            print(f"  {'warm start' if warm else 'no warm start':>14}: {timings[-1] * 1000:>7.1f} ms, "
+                  f"upstream fetches {fetched}")
+    upstream.shutdown()
+
+
+timings = []
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,174 @@
+"""ベンチマーク用のカクヨム風HTMLフィクスチャを生成する
+
+bench/recorded/ に実際のページを保存してあれば（record_fixtures.py を参照）、load() はそちらを優先する。
+"""
+import json
+import os
+import random
+
+RECORDED_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'recorded')
+
+# ベンチマークで使う作品（録画済みのページがあれば、録画したときのIDに置き換わる）
+SMALL_WORK_ID = '1177354054880000000'
+LARGE_WORK_ID = '1177354054880000001'
+EPISODE_WORK_ID, EPISODE_ID = SMALL_WORK_ID, '16816700000000000000'
+SMALL_TOC_EPISODES = 30
+LARGE_TOC_EPISODES = 3200
+SEARCH_QUERY = '異世界'
+SEARCH_TOTAL = 45
+RANKING_PAGES = 3
+
+if os.path.exists(os.path.join(RECORDED_DIR, 'ids.json')):
+    with open(os.path.join(RECORDED_DIR, 'ids.json'), encoding='utf-8') as f:
+        _ids = json.load(f)
+    SMALL_WORK_ID, LARGE_WORK_ID = _ids['small_work'], _ids['large_work']
+    EPISODE_WORK_ID, EPISODE_ID = _ids['episode']
+    SEARCH_QUERY = _ids['search_query']
+
+
+def toc_page(work_id, episodes=1000, per_chapter=50):
+    """__NEXT_DATA__に目次を埋め込んだ作品ページを生成する"""
+    apollo = {}
+    toc_refs = []
+    for chapter_index, offset in enumerate(range(0, episodes, per_chapter)):
+        episode_refs = []
+        for number in range(offset, min(offset + per_chapter, episodes)):
+            episode_id = str(16816700000000000000 + number)
+            apollo[f'Episode:{episode_id}'] = {
+                '__typename': 'Episode',
+                'id': episode_id,
+                'title': f'第{number + 1}話 「{"長い" * 5}エピソードタイトル」',
+                'publishedAt': f'2024-{number % 12 + 1:02d}-{number % 28 + 1:02d}T09:00:00Z',
+            }
+            episode_refs.append({'__ref': f'Episode:{episode_id}'})
+        apollo[f'Chapter:{chapter_index}'] = {'__typename': 'Chapter', 'title': f'第{chapter_index + 1}章'}
+        apollo[f'TableOfContentsChapter:{chapter_index}'] = {
+            'chapter': {'__ref': f'Chapter:{chapter_index}'} if chapter_index else None,
+            'episodeUnions': episode_refs,
+        }
+        toc_refs.append({'__ref': f'TableOfContentsChapter:{chapter_index}'})
+    apollo['UserAccount:1'] = {'activityName': '作者名'}
+    apollo[f'Work:{work_id}'] = {
+        'title': '作品タイトル',
+        'introduction': 'あらすじ\\n' * 20,
+        'author': {'__ref': 'UserAccount:1'},
+        'tableOfContents': toc_refs,
+    }
+    next_data = json.dumps({'props': {'pageProps': {'__APOLLO_STATE__': apollo}}}, ensure_ascii=False)
+    # 実際のページと同様に、__NEXT_DATA__の前に大量のマークアップを置く
+    filler = ''.join(f'<div class="Layout_box"><a href="/works/{work_id}/episodes/{i}"><span>項目{i}</span></a></div>'
+                     for i in range(episodes))
+    return (
+        '<!DOCTYPE html><html lang="ja"><head><meta charset="utf-8"><title>作品タイトル</title>'
+        '<script>window.dataLayer = window.dataLayer || [];</script></head>'
+        f'<body><div id="__next">{filler}</div>'
+        f'<script id="__NEXT_DATA__" type="application/json">{next_data}</script></body></html>'
+    ).encode('utf-8')
+
+
+def episode_page(work_id, episode_id, paragraphs=300, ruby_per_paragraph=4, seed=0):
+    """ルビを多用した本文ページを生成する"""
+    rnd = random.Random(seed)
+    body = []
+    for index in range(paragraphs):
+        parts = ['　']
+        for number in range(ruby_per_paragraph):
+            parts.append(f'彼女は{"静かに" * rnd.randint(1, 3)}')
+            parts.append(f'<ruby><rb>魔導書{number}</rb><rp>（</rp><rt>グリモワール</rt><rp>）</rp></ruby>')
+            if rnd.random() < 0.2:
+                parts.append('<em class="emphasisDots"><span>傍</span><span>点</span></em>')
+            if rnd.random() < 0.1:
+                parts.append('を&lt;開いた&gt;。<br />')
+        body.append(f'<p id="p{index}">{"".join(parts)}</p>')
+        if rnd.random() < 0.2:
+            body.append(f'<p id="p{index}-blank" class="blank"><br /></p>')
+    return (
+        '<!DOCTYPE html><html lang="ja"><head><meta charset="utf-8"><title>エピソード</title>'
+        f'<link rel="prev" href="https://kakuyomu.jp/works/{work_id}/episodes/{int(episode_id) - 1}">'
+        f'<link rel="next" href="https://kakuyomu.jp/works/{work_id}/episodes/{int(episode_id) + 1}">'
+        '</head><body>'
+        f'<div id="worksEpisodesEpisodeHeader-breadcrumbs"><h1><a href="/works/{work_id}">作品タイトル</a></h1></div>'
+        '<p class="widget-episodeTitle js-vertical-composition-item">第1話 はじまり</p>'
+        f'<div class="widget-episodeBody js-episode-body">{"".join(body)}</div>'
+        '</body></html>'
+    ).encode('utf-8')
+
+
+def ranking_page(page=1, per_page=20, more=True, title='総合 日間ランキング'):
+    """ランキングページを生成する（広告枠、作者・あらすじのない作品、空の要素を含むメタ情報を含む）"""
+    items = []
+    for index in range(per_page):
+        rank = (page - 1) * per_page + index + 1
+        work_id = 1177354054880000000 + rank
+        author = '' if index % 7 == 6 else f'<a class="widget-workCard-authorLabel" href="/users/author{index}">作者{index}</a>'
+        summary = ('' if index % 9 == 8 else
+                   f'<p class="widget-workCard-introduction"><a href="/works/{work_id}">あらすじ{index}\n　二行目 &amp; 続き</a></p>')
+        items.append(
+            f'<div class="widget-work float-parent"><div class="widget-workCard">'
+            f'<p class="widget-work-rank">{rank}</p>'
+            f'<h3 class="widget-workCard-title"><a class="widget-workCard-titleLabel bookWalker-work-title" '
+            f'href="/works/{work_id}">作品{rank} &lt;第{index % 3 + 1}部&gt;</a></h3>{author}'
+            f'<p class="widget-workCard-tags"><a href="/tags/a">タグ</a></p>{summary}'
+            f'<p class="widget-workCard-meta"><span class="widget-workCard-episodeCount">{index + 3}話</span> '
+            f'<span> </span>\n<span class="widget-workCard-dateUpdated">2024年1月{index % 28 + 1}日 更新</span>'
+            f'<span>{"完結済" if index % 2 else "連載中"}</span></p>'
+            f'</div></div>'
+        )
+        if index == per_page // 2:
+            # 途中に挟まる広告枠の作品は結果に含めない
+            items.append(
+                '<div class="widget-workRankingBoxForNext"><div class="widget-work float-parent">'
+                '<p class="widget-work-rank">PR</p><h3 class="widget-workCard-title">'
+                '<a class="widget-workCard-titleLabel" href="/works/999">広告の作品</a></h3></div></div>'
+            )
+    pager = f'<p class="widget-pagerNext"><a href="?page={page + 1}">次へ</a></p>' if more else ''
+    return (
+        '<!DOCTYPE html><html lang="ja"><head><meta charset="utf-8"><title>ランキング</title></head><body>'
+        f'<header class="widget-media-genresWorkList-listTitle"><h3>{title}</h3></header>'
+        f'<div class="widget-media-genresWorkList-right">{"".join(items)}</div>{pager}</body></html>'
+    ).encode('utf-8')
+
+
+def search_page(query, page=1, total=45, per_page=20):
+    """検索結果ページを生成する（全total件のうちpageページ目）"""
+    items = []
+    for index in range((page - 1) * per_page, min(page * per_page, total)):
+        work_id = 1177354054880100000 + index
+        items.append(
+            f'<div class="WorkListItem_container__p1fa2"><div class="NewBox_box__45ont">'
+            f'<h3 class="Heading_heading__lQ85n Heading_left__RVp4h"><a href="/works/{work_id}">{query}の作品{index + 1}</a></h3>'
+            f'<div class="WorkTitle_workLabel__abc"><span class="WorkTitle_workLabelAuthor__Kxy5E">'
+            f'<a href="/users/user{index}">著者{index}</a></span></div>'
+            f'<a href="/works/{work_id}"><div class="partialGiftWidgetWeakText__1xYf3">'
+            f'一行目のあらすじ<br>二行目{index}&amp;続き</div></a></div></div>'
+        )
+    return (
+        '<!DOCTYPE html><html lang="ja"><head><meta charset="utf-8"><title>検索</title></head><body>'
+        f'<div class="Typography_align-right__abc">全{total}件</div>'
+        f'<div id="search-result-main">{"".join(items)}</div></body></html>'
+    ).encode('utf-8')
+
+
+def recorded_name(path, page=1):
+    """URLのパスとページ番号に対応する、録画済みのページのファイル名"""
+    name = path.strip('/').replace('/', '_') or 'index'
+    return f'{name}_p{page}.html' if page != 1 else f'{name}.html'
+
+
+def page_for(path, page=1, query=''):
+    """カクヨムのURLのパスに対応するページを返す（代替サーバー用）。録画済みのページがあればそれを優先し、未知のパスはNone"""
+    recorded = os.path.join(RECORDED_DIR, recorded_name(path, page))
+    if os.path.exists(recorded):
+        with open(recorded, 'rb') as f:
+            return f.read()
+    parts = path.strip('/').split('/')
+    if parts[0] == 'rankings' and len(parts) == 3:
+        return ranking_page(page, more=page < RANKING_PAGES)
+    if parts == ['search']:
+        return search_page(query, page, total=SEARCH_TOTAL)
+    if parts[0] == 'works' and len(parts) == 2:
+        episodes = LARGE_TOC_EPISODES if parts[1] == LARGE_WORK_ID else SMALL_TOC_EPISODES
+        return toc_page(parts[1], episodes=episodes)
+    if parts[0] == 'works' and len(parts) == 4 and parts[2] == 'episodes' and parts[3].isdigit():
+        return episode_page(parts[1], parts[3], seed=int(parts[3]) % 1000)
+    return None
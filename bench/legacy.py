@@ -0,0 +1,114 @@
+"""置き換え前の解析処理（BeautifulSoupによる実装）
+
+tests/ の出力一致テストと、bench/ のベンチマークの比較対象として使う。
+"""
+import re
+
+from bs4 import BeautifulSoup
+
+import app
+
+
+def legacy_parse_episode(content):
+    """置き換え前の実装（BeautifulSoupでルビ要素を書き換える）による(タイトル, サブタイトル, 本文, 前, 次)"""
+    soup = BeautifulSoup(content, 'html.parser')
+    title_tag = soup.select_one('#worksEpisodesEpisodeHeader-breadcrumbs h1 a')
+    subtitle_tag = soup.select_one('.widget-episodeTitle, p[class*="WorkEpisode_title__"]')
+    title = title_tag.get_text(strip=True) if title_tag else '作品タイトル不明'
+    subtitle = subtitle_tag.get_text(strip=True) if subtitle_tag else 'サブタイトル不明'
+    novel_honbun = soup.select_one('div.widget-episodeBody, div[class*="Viewer_viewer__"]')
+    if novel_honbun:
+        for ruby in novel_honbun.find_all('ruby'):
+            rt = ruby.find('rt')
+            if not rt: continue
+            for rp in ruby.find_all('rp'): rp.decompose()
+            rt_text = rt.get_text(strip=True)
+            rt.decompose()
+            rb_text = ruby.get_text(strip=True)
+            ruby.replace_with(f'{rb_text}({rt_text})')
+        body_lines = [p.get_text('\n', strip=True) for p in novel_honbun.find_all('p') if p.get_text(strip=True)]
+    else:
+        body_lines = ['本文が取得できませんでした。']
+    prev_tag = soup.select_one('link[rel="prev"], a[class*="ChapterLink_prev__"]')
+    next_tag = soup.select_one('link[rel="next"], a[class*="ChapterLink_next__"]')
+    return (title, subtitle, body_lines,
+            prev_tag.get('href') if prev_tag else None, next_tag.get('href') if next_tag else None)
+
+
+def legacy_parse_ranking(content, page):
+    """置き換え前の実装（selectと作品ごとのfind_parent・select_one）によるランキングページの解析"""
+    soup = app.make_soup(content)
+    results = []
+    for item in soup.select('div.widget-work.float-parent'):
+        if item.find_parent(class_='widget-workRankingBoxForNext'):
+            continue
+        rank_tag = item.select_one('p.widget-work-rank')
+        title_tag = item.select_one('h3.widget-workCard-title a.widget-workCard-titleLabel')
+        author_tag = item.select_one('a.widget-workCard-authorLabel')
+        summary_tag = item.select_one('p.widget-workCard-introduction a')
+        meta_tag = item.select_one('p.widget-workCard-meta')
+        if not (rank_tag and title_tag and title_tag.get('href')):
+            continue
+        work_id = app.get_work_id_from_url(title_tag['href'])
+        if work_id:
+            meta_text = ""
+            if meta_tag:
+                meta_text_raw = meta_tag.get_text(separator=' | ', strip=True)
+                meta_text = ' | '.join(part for part in meta_text_raw.split(' | ') if part)
+            results.append({
+                'rank': rank_tag.get_text(strip=True),
+                'title': title_tag.get_text(strip=True),
+                'work_id': work_id,
+                'author': author_tag.get_text(strip=True) if author_tag else '作者不明',
+                'summary': summary_tag.get_text(strip=True) if summary_tag else 'あらすじなし',
+                'meta': meta_text
+            })
+    pagination = {'prev': None, 'next': None}
+    next_page_tag = soup.select_one('p.widget-pagerNext a')
+    if next_page_tag and next_page_tag.get('href'):
+        pagination['next'] = page + 1
+    if page > 1:
+        pagination['prev'] = page - 1
+    title_tag = soup.select_one('header.widget-media-genresWorkList-listTitle h3')
+    title = title_tag.get_text(strip=True) if title_tag else 'ランキング'
+    return {'results': results, 'pagination': pagination, 'title': title}
+
+
+def legacy_parse_search(content, page):
+    """置き換え前の実装（selectと代替時の全体のselect・find_parent）による検索結果ページの解析"""
+    soup = app.make_soup(content)
+    results = []
+    search_results = soup.select('#search-result-main div[class*="WorkListItem_container"]')
+    if not search_results:
+        title_links = soup.select('h3[class*="Heading_heading"] a[href^="/works/"]')
+        search_results = [tag.find_parent('div', class_=lambda c: c and 'NewBox_box' in c and 'padding-py-m' in c)
+                          for tag in title_links]
+    for item in search_results:
+        if not item:
+            continue
+        title_tag = item.select_one('h3[class*="Heading_heading"] a')
+        author_tag = item.select_one('span[class*="WorkTitle_workLabelAuthor"] a')
+        summary_tag = item.select_one('a[href^="/works/"] > div[class*="partialGiftWidgetWeakText"]')
+        if title_tag and title_tag.get('href'):
+            work_id = app.get_work_id_from_url(title_tag['href'])
+            if work_id:
+                results.append({
+                    'title': title_tag.get_text(strip=True),
+                    'work_id': work_id,
+                    'author': author_tag.get_text(strip=True) if author_tag else '作者不明',
+                    'summary': summary_tag.get_text(strip=True, separator='\n') if summary_tag else 'あらすじなし'
+                })
+    pagination = {'prev': None, 'next': None}
+    total_text_container = soup.select_one('div[class*="Typography_align-right"]')
+    total_text = total_text_container.get_text(strip=True) if total_text_container else ""
+    total_count_match = re.search(r'全(\d+)件', total_text)
+    total = total_count_match.group(1) if total_count_match else '多数'
+    # 次のページの判定は件数による現在の規則に合わせる（比較するのは要素の走査の違いのみ）
+    if total_count_match:
+        if page < app.search_page_count(int(total)):
+            pagination['next'] = page + 1
+    elif len(results) >= 20:
+        pagination['next'] = page + 1
+    if page > 1:
+        pagination['prev'] = page - 1
+    return {'results': results, 'pagination': pagination, 'total': total}
@@ -0,0 +1,59 @@
+"""カクヨムの実際のページを bench/recorded/ に保存する（以後、代替サーバーとベンチマークは生成したページの代わりにこれを使う）
+
+使い方: python bench/record_fixtures.py --small-work 作品ID --large-work 作品ID [--episode 作品ID/エピソードID] [--query 検索語]
+（--large-workには3,000話以上の作品を指定する。取得はアプリのレート制限に従い、合計7ページだけ取得する）
+"""
+import argparse
+import json
+import os
+import sys
+from urllib.parse import urlsplit
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import app  # noqa: E402
+import fixtures  # noqa: E402
+
+
+def record(url, params=None):
+    """ページを取得して保存する"""
+    page = (params or {}).get('page', 1)
+    content = app.fetch_page(url, params)
+    if content is None:
+        sys.exit(f"failed to fetch {url}")
+    name = fixtures.recorded_name(urlsplit(url).path, page)
+    with open(os.path.join(fixtures.RECORDED_DIR, name), 'wb') as f:
+        f.write(content)
+    print(f"{name:>60} {len(content) / 1024:>8.0f} KB")
+    return content
+
+
+def main():
+    parser = argparse.ArgumentParser(description='ベンチマーク用にカクヨムのページを保存する')
+    parser.add_argument('--small-work', required=True, help='話数の少ない作品のID')
+    parser.add_argument('--large-work', required=True, help='3,000話以上の作品のID')
+    parser.add_argument('--episode', help='ルビの多い本文の「作品ID/エピソードID」（省略時は--small-workの最初の話）')
+    parser.add_argument('--query', default=fixtures.SEARCH_QUERY, help='検索語')
+    args = parser.parse_args()
+
+    os.makedirs(fixtures.RECORDED_DIR, exist_ok=True)
+    for page in (1, 2):
+        record(*app.ranking_page_request('all', 'daily', page))
+        record(*app.search_page_request(args.query, page))
+    small = app.parse_toc_page(record(*app.toc_page_request(args.small_work)), args.small_work)
+    record(*app.toc_page_request(args.large_work))
+    if args.episode:
+        work_id, episode_id = args.episode.split('/')
+    else:
+        work_id = args.small_work
+        episode_id = next(item['episode_id'] for item in small['episodes'] if not item['is_chapter'])
+    record(*app.viewer_page_request(work_id, episode_id))
+
+    ids = {'small_work': args.small_work, 'large_work': args.large_work,
+           'episode': [work_id, episode_id], 'search_query': args.query}
+    with open(os.path.join(fixtures.RECORDED_DIR, 'ids.json'), 'w', encoding='utf-8') as f:
+        json.dump(ids, f, ensure_ascii=False, indent=2)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,101 @@
+"""ベンチマーク用に、カクヨムの代わりにフィクスチャのページを返すローカルHTTPサーバー
+
+使い方: python bench/standin.py [--port 8001] [--latency 0.05]
+（起動後、KAKUYOMU_BASE_URL=http://127.0.0.1:8001/ python app.py のようにアプリの取得先を向ける）
+"""
+import argparse
+import functools
+import hashlib
+import os
+import sys
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import urlsplit, parse_qs
+
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+
+import fixtures  # noqa: E402
+
+
+@functools.lru_cache(maxsize=256)
+def cached_page(path, page, query):
+    """生成したページとETag（数千話の目次の生成を毎回繰り返さないよう保持する）"""
+    content = fixtures.page_for(path, page, query)
+    if content is None:
+        return None, None
+    return content, '"%s"' % hashlib.blake2b(content, digest_size=8).hexdigest()
+
+
+class StandInHandler(BaseHTTPRequestHandler):
+    """カクヨムと同じパスでフィクスチャを返す。ETagによる条件付きGETにも応じる"""
+    protocol_version = 'HTTP/1.1'  # 接続を再利用させる
+    latency = 0.0  # 応答前に待つ秒数（上流の応答時間の代わり）
+    requests = 0
+    lock = threading.Lock()
+
+    def do_GET(self):
+        url = urlsplit(self.path)
+        query = parse_qs(url.query)
+        try:
+            page = int(query.get('page', ['1'])[0])
+        except ValueError:
+            page = 1
+        with StandInHandler.lock:
+            StandInHandler.requests += 1
+        if self.latency:
+            time.sleep(self.latency)
+        content, etag = cached_page(url.path, page, query.get('q', [''])[0])
+        if content is None:
+            self.send_response(404)
+            self.send_header('Content-Length', '0')
+            self.end_headers()
+            return
+        if self.headers.get('If-None-Match') == etag:
+            self.send_response(304)
+            self.send_header('ETag', etag)
+            self.end_headers()
+            return
+        self.send_response(200)
+        self.send_header('Content-Type', 'text/html; charset=utf-8')
+        self.send_header('Content-Length', str(len(content)))
+        self.send_header('ETag', etag)
+        self.end_headers()
+        self.wfile.write(content)
+
+    def log_message(self, format, *args):
+        pass
+
+
+def serve(port=0, latency=0.0):
+    """代替サーバーをバックグラウンドで起動し、(サーバー, ベースURL)を返す"""
+    StandInHandler.latency = latency
+    server = ThreadingHTTPServer(('127.0.0.1', port), StandInHandler)
+    server.daemon_threads = True
+    threading.Thread(target=server.serve_forever, name='standin', daemon=True).start()
+    return server, f'http://127.0.0.1:{server.server_address[1]}/'
+
+
+def point(app, base_url):
+    """アプリの取得先を代替サーバーに向ける（起動済みのプロセス内で使う場合）"""
+    app.BASE_URL = base_url
+    app.SEARCH_URL = base_url + 'search'
+    app.RANKING_URL_BASE = base_url + 'rankings'
+
+
+def main():
+    parser = argparse.ArgumentParser(description='ベンチマーク用のカクヨムの代替サーバー')
+    parser.add_argument('--port', type=int, default=8001)
+    parser.add_argument('--latency', type=float, default=0.0, help='応答前に待つ秒数')
+    args = parser.parse_args()
+    server, base_url = serve(args.port, args.latency)
+    print(f"serving fixtures at {base_url}")
+    print(f"  KAKUYOMU_BASE_URL={base_url} python app.py")
+    try:
+        threading.Event().wait()
+    except KeyboardInterrupt:
+        server.shutdown()
+
+
+if __name__ == '__main__':
+    main()
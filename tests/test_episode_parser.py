@@ -0,0 +1,96 @@
+"""本文ページの解析（1回走査のEpisodePageParser）が、置き換え前のBeautifulSoupの実装と同じ結果になることを確認する"""
+import pytest
+
+import app
+import fixtures
+from legacy import legacy_parse_episode
+
+WORK_ID = '1177354054880000000'
+
+# 出力一致を確認する本文の断片（境界的なマークアップを含む）
+EDGE_CASES = [
+    '<p>　本文<ruby><rb>漢字</rb><rp>（</rp><rt>かんじ</rt><rp>）</rp></ruby>です</p>',
+    '<p><ruby>無<rt></rt></ruby>と<ruby><rb> 空 </rb><rt> </rt></ruby></p>',
+    '<p><ruby>rtなし<rp>（</rp><rp>）</rp></ruby>の<ruby><rb>親</rb><rb>文字</rb></ruby></p>',
+    '<p><ruby>親<rt>一</rt>字<rt>二</rt></ruby>|<ruby><rb>外<ruby>内<rt>う</rt></ruby></rb><rt>そと</rt></ruby></p>',
+    '<p><ruby><rb>親</rb><rt><span>よ</span>み<rp>x</rp></rt></ruby></p>',
+    '<p>前<!-- コメント -->後<br>改行<br/>終わり</p>',
+    '<p>&lt;タグ&gt; &amp; &#12354;&#x3042; &#150; &unknown; &amp</p>',
+    '<p>外<p>入れ子</p>続き</p><p>閉じていない段落',
+    '<p>　</p><p> \n </p><p><br /></p><p><ruby><rt></rt></ruby></p>',
+    '<p><script>var a = "<p>x</p>";</script>本文<style>p { color: red }</style></p>',
+    '<div><p><em class="emphasisDots"><span>傍</span><span>点</span></em>付き</p></div></span></p>末尾',
+    '<p><template>雛形</template><rt>単独のrt</rt><rp>単独のrp</rp>文</p>',
+    '<p><br>一行目<ruby>漢<rt>かん</rt></ruby><br>二行目<ruby><rb>字</rb><rt>じ</rt></ruby><br/><br>三行目<br></p>',
+]
+
+
+def edge_pages():
+    """境界的な断片を埋め込んだページと、ページ構造自体の変種を返す"""
+    pages = [
+        ('<html><head><link rel="prev" href="/works/1/episodes/1"></head><body>'
+         '<div id="worksEpisodesEpisodeHeader-breadcrumbs"><h1><a href="/works/1">題<ruby>名<rt>な</rt></ruby></a></h1></div>'
+         f'<p class="widget-episodeTitle">副題</p><div class="widget-episodeBody">{case}</div></body></html>').encode('utf-8')
+        for case in EDGE_CASES
+    ]
+    pages += [
+        # 新しいデザインのクラス名、aタグによる前後リンク
+        ('<div id="worksEpisodesEpisodeHeader-breadcrumbs"><a>h1の外</a><h1><span><a>作品</a></span></h1></div>'
+         '<p class="WorkEpisode_title__abc">新副題</p><a class="ChapterLink_next__x" href="/works/1/episodes/3">次</a>'
+         '<link rel="next" href="/works/1/episodes/9"><div class="Viewer_viewer__q"><p>本文</p></div>'
+         '<div class="widget-episodeBody"><p>2つ目の本文要素</p></div>').encode('utf-8'),
+        # 本文・タイトルが見つからない、hrefのないリンク
+        b'<html><body><h1 id="worksEpisodesEpisodeHeader-breadcrumbs"><a>x</a></h1><link rel="prev"><p>none</p></body></html>',
+        # 空のページとShift_JISのページ
+        b'',
+        '<meta charset="shift_jis"><div class="widget-episodeBody"><p>日本語&#151;<ruby>漢<rt>かん</rt></ruby></p></div>'.encode('shift_jis'),
+    ]
+    return pages
+
+
+def parse(content):
+    """parse_viewer_pageの結果を、置き換え前の実装と比べられる形にする"""
+    novel, nav = app.parse_viewer_page(content, WORK_ID)
+    return novel['title'], novel['subtitle'], list(novel['body']), nav['prev'], nav['next']
+
+
+def legacy(content):
+    title, subtitle, body_lines, prev_href, next_href = legacy_parse_episode(content)
+    return title, subtitle, body_lines, app.get_episode_id_from_url(prev_href), app.get_episode_id_from_url(next_href)
+
+
+@pytest.mark.parametrize('content', edge_pages())
+def test_edge_pages_match_legacy(content):
+    assert parse(content) == legacy(content)
+
+
+@pytest.mark.parametrize('ruby_count', [0, 1, 4, 16])
+def test_generated_pages_match_legacy(ruby_count):
+    content = fixtures.episode_page(WORK_ID, '1000', paragraphs=100, ruby_per_paragraph=ruby_count, seed=ruby_count)
+    assert parse(content) == legacy(content)
+
+
+def test_ruby_segments_keep_reading():
+    content = edge_pages()[0]
+    novel, _ = app.parse_viewer_page(content, WORK_ID)
+    assert novel['ruby_body'][0] == ['本文', ('漢字', 'かんじ'), 'です']
+
+
+def test_ruby_segments_keep_line_breaks():
+    content = edge_pages()[len(EDGE_CASES) - 1]
+    novel, _ = app.parse_viewer_page(content, WORK_ID)
+    assert novel['ruby_body'][0] == ['一行目', ('漢', 'かん'), '\n', '二行目', ('字', 'じ'), '\n', '三行目']
+
+
+def test_process_pool_matches_inline(monkeypatch):
+    content = fixtures.episode_page(WORK_ID, '1000', paragraphs=20, seed=1)
+    inline = app.run_parse(app.parse_viewer_page, content, WORK_ID)
+    monkeypatch.setattr(app, 'PARSE_PROCESSES', 1)
+    monkeypatch.setattr(app, 'parse_process_pool', None)
+    try:
+        pooled = app.run_parse(app.parse_viewer_page, content, WORK_ID)
+    finally:
+        app.parse_process_pool.shutdown()
+    assert list(pooled[0]['body']) == list(inline[0]['body'])
+    assert list(pooled[0]['ruby_body']) == list(inline[0]['ruby_body'])
+    assert pooled[1] == inline[1]
@@ -0,0 +1,31 @@
+"""作品全体のエクスポート（テキスト・EPUB）で、ルビと段落内の改行が残ることを確認する"""
+import io
+import zipfile
+
+import app
+
+WORK_ID = '1177354054880000000'
+EPISODE_PAGE = ('<div class="widget-episodeBody">'
+                '<p>一行目<ruby>漢<rt>かん</rt></ruby><br>二行目</p>'
+                '<p>ルビなし<br>二行目</p>'
+                '</div>').encode('utf-8')
+NOVEL = {'title': '作品', 'author': '作者', 'summary': 'あらすじ', 'work_id': WORK_ID}
+ITEM = {'is_chapter': False, 'title': '第1話', 'episode_id': '1'}
+
+
+def episodes():
+    body, _ = app.parse_viewer_page(EPISODE_PAGE, WORK_ID)
+    return [(ITEM, body, 'fetched')]
+
+
+def test_text_export_keeps_ruby_and_line_breaks():
+    text = b''.join(app.iter_export_text(NOVEL, episodes())).decode('utf-8')
+    assert '一行目｜漢《かん》\n二行目\nルビなし\n二行目' in text
+
+
+def test_epub_export_keeps_ruby_and_line_breaks():
+    with app.app.test_request_context():
+        archive = zipfile.ZipFile(io.BytesIO(b''.join(app.iter_export_epub(NOVEL, episodes()))))
+    episode = archive.read('OEBPS/text/episode-00001.xhtml').decode('utf-8')
+    assert '<p>一行目<ruby>漢<rp>(</rp><rt>かん</rt><rp>)</rp></ruby><br/>二行目</p>' in episode
+    assert '<p>ルビなし<br/>二行目</p>' in episode
@@ -0,0 +1,71 @@
+"""ランキング・検索結果ページの解析（要素を1回走査する実装）が、置き換え前のselect/find_parentによる実装と同じ結果になることを確認する"""
+import random
+
+import pytest
+
+import app
+import fixtures
+from legacy import legacy_parse_ranking, legacy_parse_search
+
+PAGES = (1, 2, 3)
+MUTATIONS = 30  # 一部を削って崩したページの数（ページごと）
+PARSERS = {'ranking': (legacy_parse_ranking, app.parse_ranking_page),
+           'search': (legacy_parse_search, app.parse_search_page)}
+
+# 出力一致を確認するページ（境界的なマークアップを含む）
+EDGE_RANKING = '''<html><head><meta charset="utf-8"></head><body>
+<header class="widget-media-genresWorkList-listTitle"><h3> 総合 <!--x--> 日間 &amp; 週間</h3></header>
+<div class="widget-workRankingBoxForNext"><div class="widget-work float-parent"><p class="widget-work-rank">AD</p>
+<h3 class="widget-workCard-title"><a class="widget-workCard-titleLabel" href="/works/999">広告</a></h3></div></div>
+<div class="float-parent  widget-work"><p class="widget-work-rank"> 1 <script>var x = 1</script>位</p>
+ <h3 class="widget-workCard-title"><a class="widget-workCard-titleLabel bold" href="/works/1177354054880000001">タイ<ruby>ト<rt>と</rt></ruby>ル<style>.a{}</style></a></h3>
+ <a class="widget-workCard-authorLabel">作者</a><p class="widget-workCard-introduction"><a>あらすじ<br>二行目</a></p>
+ <p class="widget-workCard-meta"><span>3話</span> <span> </span><span>更新<!--c-->日</span><template><b>t</b></template></p>
+ <div class="widget-work float-parent"><p class="widget-work-rank">2</p><h3 class="widget-workCard-title"><a class="widget-workCard-titleLabel" href="/works/1177354054880000002">入れ子</a></h3></div>
+</div>
+<div class="widget-work float-parent"><p class="widget-work-rank">3</p><a class="widget-workCard-titleLabel" href="/works/1177354054880000003">見出しなし</a></div>
+<div class="widget-work float-parent"><h3 class="widget-workCard-title"><a class="widget-workCard-titleLabel" href="/works/1177354054880000004">順位なし</a></h3></div>
+<p class="widget-pagerNext"><a href="?page=2">次</a></p>
+</body></html>'''
+EDGE_SEARCH = '''<html><body><div class="Typography_align-right__x">全 <b>40</b>件</div><div class="Typography_align-right__y">全41件</div>
+<div class="NewBox_box__1 padding-py-m"><h3 class="Heading_heading__a"><a href="/works/1177354054880000010">A<!--x-->B</a><a href="/works/1177354054880000010">重複</a></h3>
+<span class="WorkTitle_workLabelAuthor__q"><a>著者</a></span><a href="/works/1177354054880000010"><div class="x partialGiftWidgetWeakText__z">一行<br>二行 &lt;3</div></a></div>
+<h3 class="Heading_heading__a"><a href="/works/1177354054880000011">枠なし</a></h3>
+<div class="NewBox_box__1"><div class="padding-py-m NewBox_box__2"><div class="NewBox_box__3 padding-py-m"><h3 class="Heading_heading"><span><a href="/works/1177354054880000012">深い</a></span></h3></div></div></div>
+</body></html>'''
+EDGE_SEARCH_MAIN = '''<html><body><div id="search-result-main" class="WorkListItem_container">
+<div class="WorkListItem_container__a NewBox_box padding-py-m"><h3 class="Heading_heading"><a href="/works/1177354054880000020">X</a></h3>
+<div class="WorkListItem_container__b"><span class="WorkTitle_workLabelAuthor"><a>入れ子</a></span></div></div></div>
+<div class="WorkListItem_container"><h3 class="Heading_heading"><a href="/works/1177354054880000021">枠外</a></h3></div></body></html>'''
+
+
+def cases():
+    """(ページ種別, HTML) の並び。保存・生成したページ、境界的なページと、それらを崩したもの"""
+    pages = []
+    for page in PAGES:
+        pages.append(('ranking', fixtures.page_for('/rankings/all/daily', page)))
+        pages.append(('search', fixtures.page_for('/search', page, query=fixtures.SEARCH_QUERY)))
+    pages += [('ranking', EDGE_RANKING.encode()), ('ranking', EDGE_RANKING), ('search', EDGE_SEARCH.encode()),
+              ('search', EDGE_SEARCH_MAIN.encode()), ('ranking', EDGE_RANKING.encode('shift_jis', 'replace')),
+              ('ranking', b''), ('search', b'<p>x')]
+    rnd = random.Random(0)
+    for kind, content in pages[:2 * len(PAGES)]:
+        for _ in range(MUTATIONS):
+            mutated = bytearray(content)
+            for _ in range(5):
+                start = rnd.randrange(len(mutated))
+                del mutated[start:start + rnd.randrange(200)]
+            pages.append((kind, bytes(mutated)))
+    return pages
+
+
+@pytest.mark.parametrize('html_parser', [
+    'html.parser',
+    pytest.param('lxml', marks=pytest.mark.skipif(app.lxml is None, reason='lxmlがインストールされていない')),
+])
+@pytest.mark.parametrize('kind, content', cases())
+def test_pages_match_legacy(monkeypatch, html_parser, kind, content):
+    monkeypatch.setattr(app, 'HTML_PARSER', html_parser)
+    legacy, current = PARSERS[kind]
+    for page in (1, 2):
+        assert current(content, page) == legacy(content, page)